@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+'''
+Functions for finding the CDX data for a SURT using the common crawl's cluster.idx files.
+
+Each line of a cluster.idx file summarizes one block of a compressed CDX file:
+
+    com,example)/path 20210101000000	cdx-00000.gz	1234	5678	1
+
+The first field is the SURT key of the first entry in the block,
+and the remaining tab-separated fields are the CDX file, the byte offset and length of the block within the file, and a sequence number.
+The lines are sorted by SURT key, so we can binary search the file for the blocks that might contain a SURT prefix.
+'''
+
+import aiohttp
+import asyncio
+import gzip
+import logging
+import mmap
+import os
+import random
+import tempfile
+import zlib
+
+
+def _line_bounds(mm, pos):
+    '''
+    Returns the (start, stop) byte offsets of the line in mm that contains position pos;
+    the stop offset does not include the newline.
+    '''
+    start = mm.rfind(b'\n', 0, pos) + 1
+    stop = mm.find(b'\n', pos)
+    if stop == -1:
+        stop = len(mm)
+    return start, stop
+
+
+def _bisect_left(mm, key):
+    '''
+    Returns the byte offset of the first line in mm whose SURT key is >= key,
+    or len(mm) if there is no such line.
+    '''
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start, stop = _line_bounds(mm, mid)
+        line_key = mm[start:stop].split(b' ', 1)[0]
+        if line_key < key:
+            lo = stop + 1
+        else:
+            hi = start
+    return min(lo, len(mm))
+
+
+def backoff(failures, max_sleep):
+    '''
+    Returns the time to sleep before retrying a request that has failed `failures` times.
+    The exponential backoff is capped at `max_sleep` seconds and randomized (full jitter),
+    so that many requests that failed at the same moment do not all retry at the same moment.
+
+    >>> all(0 <= backoff(failures, 60) <= min(2**failures, 60) for failures in range(20))
+    True
+    '''
+    return random.uniform(0, min(2**failures, max_sleep))
+
+
+class FetchError(Exception):
+    '''
+    Raised by fetch_block when a CDX block cannot be downloaded,
+    either because the server's response can never succeed (e.g. 403 or 404)
+    or because all `max_attempts` attempts failed.
+    '''
+
+
+def locate_blocks(idx_path, surt):
+    '''
+    Returns a list of (file, offset, length) tuples,
+    one for each CDX block that may contain entries whose SURT begins with `surt`.
+
+    The file is memory-mapped and binary searched,
+    so only O(log n) lines of the (multi-GB) index are ever read.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile() as f:
+    ...     _ = f.write(b'com,a)/ 2021\\tcdx-00000.gz\\t0\\t10\\t1\\n')
+    ...     _ = f.write(b'com,b)/ 2021\\tcdx-00000.gz\\t10\\t10\\t2\\n')
+    ...     _ = f.write(b'com,b)/z 2021\\tcdx-00000.gz\\t20\\t10\\t3\\n')
+    ...     _ = f.write(b'com,c)/ 2021\\tcdx-00001.gz\\t0\\t10\\t4\\n')
+    ...     _ = f.write(b'com,d)/ 2021\\tcdx-00001.gz\\t10\\t10\\t5\\n')
+    ...     f.flush()
+    ...     locate_blocks(f.name, 'com,b)/')
+    ...     locate_blocks(f.name, 'com,c)/')
+    ...     locate_blocks(f.name, 'com,a')
+    ...     locate_blocks(f.name, 'org,')
+    [('cdx-00000.gz', 0, 10), ('cdx-00000.gz', 10, 10), ('cdx-00000.gz', 20, 10)]
+    [('cdx-00000.gz', 20, 10), ('cdx-00001.gz', 0, 10)]
+    [('cdx-00000.gz', 0, 10)]
+    [('cdx-00001.gz', 10, 10)]
+    '''
+    surt = surt.encode()
+    with open(idx_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+            # the first block we need is the block immediately before the first line >= surt,
+            # since that block may contain entries for surt that sort before the next block's first key;
+            # the last block we need is the block immediately before the first line that sorts after every key with the surt prefix
+            start = _bisect_left(mm, surt)
+            if start > 0:
+                start, _ = _line_bounds(mm, start - 1)
+            stop = _bisect_left(mm, surt + b'\xff')
+
+            blocks = []
+            for line in mm[start:stop].splitlines():
+                fields = line.split(b'\t')
+                blocks.append((fields[1].decode(), int(fields[2]), int(fields[3])))
+
+    logging.debug(f'locate_blocks: idx_path={idx_path}, surt={surt}, len(blocks)={len(blocks)}')
+    return blocks
+
+
+async def fetch_block(session, url, offset, length, surt, chunk_size=2**16, max_attempts=10, max_sleep=60):
+    '''
+    Downloads the CDX block of `length` bytes at `offset` within `url`,
+    and returns the list of lines in the block that begin with `surt`.
+
+    The block is decompressed as it streams in,
+    and only the matching lines are kept in memory.
+
+    Connection errors, timeouts, and throttling responses (429 and 5XX) are retried with jittered exponential backoff (see backoff);
+    any other error status raises FetchError immediately, as does failing `max_attempts` times.
+    '''
+    prefix = surt.encode()
+    for failures in range(max_attempts):
+        try:
+            headers = { 'Range': f'bytes={offset}-{offset+length-1}' }
+            async with session.get(url, headers=headers) as response:
+
+                # the server is overloaded, and so we should slow down and retry;
+                # any other error will never succeed
+                if response.status == 429 or response.status >= 500:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status, message=response.reason)
+                if response.status >= 400:
+                    raise FetchError(f'url={url}, offset={offset}, length={length}, status={response.status}')
+
+                # the block may contain several gzip members,
+                # so we start a new decompressor whenever the previous member ends
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                lines = []
+                partial = b''
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    data = []
+                    while chunk:
+                        data.append(decompressor.decompress(chunk))
+                        if not decompressor.eof:
+                            break
+                        chunk = decompressor.unused_data
+                        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+                    # only complete lines can be filtered;
+                    # the incomplete last line is saved for the next chunk
+                    *complete, partial = (partial + b''.join(data)).split(b'\n')
+                    lines.extend(line for line in complete if line.startswith(prefix))
+                if partial.startswith(prefix):
+                    lines.append(partial)
+                return lines
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f'exception={type(e).__name__}: {e}'
+            sleep_time = backoff(failures, max_sleep)
+            logging.warning(f'{error}; url={url}; failures={failures}; sleep_time={sleep_time:.2f}')
+            await asyncio.sleep(sleep_time)
+
+    raise FetchError(f'url={url}, offset={offset}, length={length}, max_attempts={max_attempts} reached; last error: {error}')
+
+
+async def fetch_blocks(blocks, url_prefix, surt, write, semsize=100, window=None):
+    '''
+    Concurrently downloads the blocks (a list of (file, offset, length) tuples as returned by locate_blocks),
+    with at most `semsize` downloads in flight,
+    and calls write(lines) with the matching lines of each block in the same order as blocks.
+    Returns the total number of lines written.
+
+    A block is only started when it is within `window` blocks (by default 2*semsize) of the next block to write,
+    so at most `window` blocks are held in memory even when one slow block holds up the writes.
+    '''
+    if window is None:
+        window = 2 * semsize
+    num_lines = 0
+    next_block = 0
+    next_write = 0
+    pending = {}
+    finished = {}
+    connector = aiohttp.TCPConnector(limit=semsize)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        try:
+            while next_write < len(blocks):
+
+                # start new downloads until the window is full
+                while next_block < len(blocks) and len(pending) < semsize and next_block < next_write + window:
+                    file, offset, length = blocks[next_block]
+                    logging.debug(f'fetch_block: file={file}, offset={offset}, length={length}')
+                    task = asyncio.ensure_future(fetch_block(session, url_prefix + file, offset, length, surt))
+                    pending[task] = next_block
+                    next_block += 1
+
+                # write the finished blocks that are next in order
+                done, _ = await asyncio.wait(set(pending), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    finished[pending.pop(task)] = task.result()
+                while next_write in finished:
+                    lines = finished.pop(next_write)
+                    write(lines)
+                    num_lines += len(lines)
+                    next_write += 1
+
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+    return num_lines
+
+
+def download_cdx(crawl, surt, *, data_dir='/data/common-crawl', semsize=100, base_url='https://commoncrawl.s3.amazonaws.com/', force=False):
+    '''
+    Downloads all CDX entries of crawl that begin with surt into the file data_dir/cdx/{surt}/{surt}-{crawl}.cdx.gz,
+    and returns the path of the file.
+
+    The output is first written to a temporary file in the same directory and then renamed,
+    so a partially downloaded file never appears at the output path.
+    The blocks are written as they are downloaded (see fetch_blocks),
+    so the memory used does not grow with the number of lines for the surt.
+    If the output file already exists, nothing is downloaded unless `force` is set.
+    '''
+    outdir = data_dir + f'/cdx/{surt}'
+    outfile = outdir + f'/{surt}-{crawl}.cdx.gz'
+    if os.path.exists(outfile) and not force:
+        logging.info(f'{outfile} already exists, skipping')
+        return outfile
+    os.makedirs(outdir, exist_ok=True)
+
+    # find the blocks
+    idx_path = data_dir + f'/cc-index/collections/{crawl}/indexes/cluster.idx'
+    blocks = locate_blocks(idx_path, surt)
+    url_prefix = base_url + f'cc-index/collections/{crawl}/indexes/'
+
+    # download the blocks and atomically write the output;
+    # gzip.open does not close a file object that it is given, so the raw file is closed separately
+    fd, tmpfile = tempfile.mkstemp(dir=outdir, prefix=os.path.basename(outfile) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fraw:
+            with gzip.open(fraw, 'wb') as f:
+                def write(lines):
+                    for line in lines:
+                        f.write(line)
+                        f.write(b'\n')
+                num_lines = asyncio.run(fetch_blocks(blocks, url_prefix, surt, write, semsize))
+        os.replace(tmpfile, outfile)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+    logging.info(f'download_cdx: crawl={crawl}, surt={surt}, len(blocks)={len(blocks)}, num_lines={num_lines}')
+    return outfile
+
+
+def locate(crawl, surt, *, data_dir='/data/common-crawl'):
+    '''
+    Prints the file, offset, and length of every CDX block of crawl that may contain entries for surt.
+    '''
+    idx_path = data_dir + f'/cc-index/collections/{crawl}/indexes/cluster.idx'
+    for file, offset, length in locate_blocks(idx_path, surt):
+        print(file, offset, length)
+
+
+################################################################################
+# standalone executable code
+################################################################################
+
+if __name__ == '__main__':
+
+    # setup logging
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        )
+
+    from clize import run
+    run(locate, download_cdx)
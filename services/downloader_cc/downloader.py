@@ -13,25 +13,146 @@ import logging
 import re
 import psutil
 import os
-import psycopg2
-import sqlalchemy
+import queue
+import statistics
+import threading
 import time
-import traceback
-
-import chajda.tsvector
-import metahtml
-import metahtml.adblock
-
+import zlib
+
+import cdx_index
+import metrics
+import warc_index
+from bloom import BloomFilter
+from ingest import get_source, recorditr_to_pg
+from warc_cache import RangeCache
 from urllib.parse import urlparse
-from collections import Counter
+from collections import Counter, defaultdict, deque
 
 ################################################################################
 # async downloader
 ################################################################################
 
-async def get(url, offset, length):
+async def mk_session(
+        limit=400,
+        limit_per_host=0,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        timeout_total=None,
+        timeout_connect=60,
+        timeout_sock_read=60,
+        ):
+    '''
+    Creates a long-lived aiohttp.ClientSession whose connection pool is shared by every call to get().
+
+    Creating a new session for each request forces a new TCP+TLS handshake for every WARC record.
+    A shared session instead keeps connections alive between requests,
+    caches DNS lookups,
+    and bounds the total number of open connections (`limit`) and the number per host (`limit_per_host`; 0 means unbounded).
+
+    The session must be created (and closed) from within the event loop that will use it,
+    which is why this is a coroutine.
+    '''
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=ttl_dns_cache,
+        keepalive_timeout=keepalive_timeout,
+        )
+    timeout = aiohttp.ClientTimeout(
+        total=timeout_total,
+        connect=timeout_connect,
+        sock_read=timeout_sock_read,
+        )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class FetchError(Exception):
+    '''
+    Raised by get() when a byte range cannot be downloaded,
+    either because the server's response can never succeed (e.g. 404 or 416)
+    or because all `max_attempts` attempts failed.
+    '''
+
+
+class AdaptiveLimiter:
+    '''
+    Chooses how many requests may be in flight using AIMD (additive increase, multiplicative decrease),
+    the same congestion control that TCP uses.
+
+    Every successful request increases the limit by `increase/limit`,
+    so the limit grows by about `increase` per window of requests.
+    A throttling response from the server (429 or 503 Slow Down),
+    or a request that takes longer than `latency_target` seconds,
+    multiplies the limit by `decrease`;
+    the limit is decreased at most once per `cooldown` seconds,
+    since all of the requests in flight when the server became overloaded will report the overload.
+
+    If `latency_target` is None, it is derived from the baseline latency:
+    `latency_factor` times the median latency of the first `baseline_samples` successful requests.
+    The median (rather than the minimum) is used because the requested ranges vary a lot in size.
+
+    >>> limiter = AdaptiveLimiter(initial=10, max_limit=20)
+    >>> for i in range(100):
+    ...     limiter.on_success(0.1)
+    >>> limiter.limit
+    17
+    >>> limiter.latency_target
+    0.4
+    >>> limiter.on_throttle()
+    >>> limiter.limit
+    8
+    >>> limiter.on_throttle()
+    >>> limiter.limit
+    8
+
+    >>> limiter = AdaptiveLimiter(initial=10, latency_target=1, cooldown=0)
+    >>> limiter.on_success(2)
+    >>> limiter.limit
+    5
+    '''
+
+    def __init__(self, initial=50, min_limit=1, max_limit=400, increase=1, decrease=0.5, latency_target=None, latency_factor=4, baseline_samples=100, cooldown=1):
+        self.value = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.latency_factor = latency_factor
+        self.baseline_samples = baseline_samples
+        self.baseline = []
+        self.cooldown = cooldown
+        self.last_decrease = -cooldown
+
+    @property
+    def limit(self):
+        return int(self.value)
+
+    def on_success(self, latency):
+        if self.latency_target is None:
+            self.baseline.append(latency)
+            if len(self.baseline) >= self.baseline_samples:
+                self.latency_target = self.latency_factor * statistics.median(self.baseline)
+                self.baseline = []
+                logging.info(f'latency_target={self.latency_target:.2f}s')
+        if self.latency_target is not None and latency > self.latency_target:
+            self.on_throttle()
+        else:
+            self.value = min(self.max_limit, self.value + self.increase / self.value)
+        metrics.set_gauge('downloader_concurrency_limit', self.limit)
+
+    def on_throttle(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= self.cooldown:
+            self.value = max(self.min_limit, self.value * self.decrease)
+            self.last_decrease = now
+        metrics.set_gauge('downloader_concurrency_limit', self.limit)
+
+
+async def get(session, url, offset, length, limiter=None, max_attempts=10, max_sleep=60):
     '''
     Downloads only the `length` bytes of the data at `url` starting at position `offset`.
+    The `session` should be created with mk_session() and reused between calls.
 
     RFC2616 specifies how to use HTTP headers to specify which bytes to download from the file.
     For details, see: https://datatracker.ietf.org/doc/html/rfc2616#section-14.35
@@ -40,22 +161,52 @@ async def get(url, offset, length):
     https://julien.danjou.info/python-and-fast-http-clients/
     https://pawelmhm.github.io/asyncio/python/aiohttp/2016/04/22/asyncio-aiohttp.html
 
+    Connection errors, timeouts, and throttling responses (429 and 5XX) are retried
+    with exponential backoff that is capped at `max_sleep` seconds and randomized (see cdx_index.backoff),
+    so that many failed requests do not all retry at the same moment.
+    Every other unexpected status raises FetchError immediately,
+    as does failing `max_attempts` times.
+    If `limiter` is an AdaptiveLimiter, it is told about every success and throttling response.
     '''
-
-    for failures in itertools.count():
+    headers = { 'Range': f'bytes={offset}-{int(offset)+int(length)-1}' }
+    for failures in range(max_attempts):
+        start = time.time()
         try:
-            async with aiohttp.ClientSession() as session:
-                headers = { 'Range': f'bytes={offset}-{int(offset)+int(length)-1}' }
-                async with session.get(url, headers=headers) as response:
-                    return await response.content.read()
-        except (aiohttp.client_exceptions.ClientConnectorError, asyncio.exceptions.TimeoutError) as e:
-            sleep_time = 2**failures
-            logging.warning(f'exception={e}; sleep_time={sleep_time}')
-            await asyncio.sleep(sleep_time)
+            async with session.get(url, headers=headers) as response:
+
+                # 206 is the normal response to a range request;
+                # a server that ignores the range header responds with 200 and the full file,
+                # which we only accept if it happens to be exactly the requested range
+                if response.status == 206 or (response.status == 200 and response.content_length == int(length)):
+                    content = await response.content.read()
+                    if limiter is not None:
+                        limiter.on_success(time.time() - start)
+                    return content
+
+                # the server is overloaded, and so we should slow down and retry
+                elif response.status == 429 or response.status >= 500:
+                    if limiter is not None:
+                        limiter.on_throttle()
+                    error = f'status={response.status}'
+                    metrics.inc('downloader_throttled_total', status=response.status)
+
+                # any other response will never succeed
+                else:
+                    raise FetchError(f'url={url}, offset={offset}, length={length}, status={response.status}')
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f'exception={type(e).__name__}: {e}'
+            metrics.inc('downloader_retries_total', exception=type(e).__name__)
+
+        sleep_time = cdx_index.backoff(failures, max_sleep)
+        logging.warning(f'{error}; url={url}; failures={failures}; sleep_time={sleep_time:.2f}')
+        await asyncio.sleep(sleep_time)
+
+    raise FetchError(f'url={url}, offset={offset}, length={length}, max_attempts={max_attempts} reached; last error: {error}')
 
 
 ################################################################################
-# postgres functions
+# warc functions
 ################################################################################
 
 from warcio.recordloader import ArcWarcRecordLoader
@@ -64,7 +215,15 @@ import io
 warcio_loader = ArcWarcRecordLoader()
 
 def warcitr_to_recorditr(warcitr):
+    '''
+    Parses each gzipped warc entry in warcitr into a warcio record.
+    Entries that are None (see cdxiter_to_warcitr) or cannot be parsed yield None,
+    so that the position of a record in the output always matches the position of the entry in warcitr.
+    '''
     for warc_entry in warcitr:
+        if warc_entry is None:
+            yield None
+            continue
         try:
             stream = io.BytesIO(warc_entry)
             with gzip.open(stream) as f:
@@ -72,267 +231,202 @@ def warcitr_to_recorditr(warcitr):
                 yield record
         except gzip.BadGzipFile:
             logging.warning('gzip.BadGzipFile')
+            yield None
 
 
-def recorditr_to_pg(recorditr, connection, source_name, batch_size=100):
-    '''
-    Insert each record in recorditr into the database.
-    This function will create a new entry in the source table if source_name does not already exist.
-    If source_name already exists,
-    then the existing entry will be used to skip the first records in recorditr to prevent duplicates from being inserted.
+################################################################################
+# common crawl functions
+################################################################################
 
-    FIXME:
-    WARC entries are already downloaded from the common crawl by the time we are skipping them in the recorditr here.
-    This means that we don't actually save any time/bandwidth by doing the skip.
+# the fields of a cdx entry that the downloader uses;
+# the values of these fields are always strings,
+# so each one can be extracted from the raw line without decoding the full json
+CDX_FIELDS = ('url', 'mime', 'status', 'filename', 'offset', 'length')
+_cdx_field_keys = { field: b'"' + field.encode() + b'": "' for field in CDX_FIELDS }
+_cdx_field_res = {
+    field: re.compile(rb'"' + field.encode() + rb'":\s*"((?:[^"\\]|\\.)*)"')
+    for field in CDX_FIELDS
+    }
+_cdx_fields_re = re.compile(rb'"(' + '|'.join(CDX_FIELDS).encode() + rb')": "([^"\\]*)"')
+
+
+def cdxline_field(line, field):
+    r'''
+    Returns the value of `field` in the raw bytes of a cdx line without json decoding the line,
+    or None if the field is not present.
+
+    A `"` character can only appear unescaped in json as part of the syntax,
+    so the key `"field": "` can never be matched inside of another value.
+
+    >>> line = b'com,example)/ 20210101000000 {"url": "https://example.com/", "mime": "text/html", "mime-detected": "application/xhtml+xml", "status": "200"}'
+    >>> cdxline_field(line, 'mime')
+    'text/html'
+    >>> cdxline_field(line, 'status')
+    '200'
+    >>> cdxline_field(line, 'length')
+    >>> cdxline_field(b'a 1 {"url":"https://example.com/"}', 'url')
+    'https://example.com/'
+    >>> cdxline_field(b'a 1 {"url": "https://example.com/\\"\\u00e9"}', 'url')
+    'https://example.com/"\xe9'
     '''
-    
-    # create a new entry in the source table for this warc file if no entry exists
-    try:
-        sql = sqlalchemy.sql.text('''
-        INSERT INTO source (name) VALUES (:name) RETURNING id;
-        ''')
-        res = connection.execute(sql,{'name':source_name})
-        id_source = res.first()['id']
-        finished_at = None
-        urls_inserted = 0
-
-    # if an entry already exists in source
-    except sqlalchemy.exc.IntegrityError:
-
-        logging.info(f"name='{source_name}' exists in source")
-
-        # get info from the source table about previous runs
-        sql = sqlalchemy.sql.text('''
-        SELECT id,urls_inserted,finished_at FROM source WHERE name=:name;
-        ''')
-        res = connection.execute(sql,{'name':source_name})
-        row = res.first()
-        id_source = row['id']
-        finished_at = row['finished_at']
-        urls_inserted = row['urls_inserted']
-
-        # if finished_at has a timestamp, then we've already fully processed the file and can skip it
-        if finished_at is not None:
-            logging.info(f'finished_at is {finished_at}, skipping')
-            return
-
-    logging.debug(f'id_source={id_source}')
-
-    # for efficiency, we will not insert items into the db one at a time;
-    # instead, we add them to the batch list,
-    # and then bulk insert the batch list when it reaches len(batch)==batch_size
-    batch = []
-    for record_i,record in enumerate(recorditr):
-
-        '''
-        # skip WARC entries that are not responses
-        if record.rec_type != 'response':
-            logging.debug(f'skip record.rec_type={record.rec_type}')
-            continue
-
-        # skip WARC responses that are not successful (status code 2XX)
-        if record.http_headers.statusline[0] != '2':
-            logging.debug(f'skip statusline={record.http_headers.statusline} url={record.rec_headers.get_header("WARC-Target-URI")}')
-            continue
-
-        # skip WARC responses that are not text/html
-        headers = dict(record.http_headers.headers)
-        content_type = headers.get('Content-Type','')
-        if 'html' not in content_type and 'text' not in content_type and len(content_type)>0:
-            logging.debug(f'skip content_type={content_type} url={record.rec_headers.get_header("WARC-Target-URI")}')
-            continue
-        '''
-
-        # extract the contents of the WARC record
-        html = record.content_stream().read()
-        url = record.rec_headers.get_header('WARC-Target-URI')
-        accessed_at = record.rec_headers.get_header('WARC-Date')
-        if html is None or url is None or accessed_at is None:
-            logging.error(f'invalid values found in WARC record; html is None={html is None}, url={url}, accessed_at={accessed_at}')
-            continue
-
-        # skip responses that have already been added
-        if record_i < urls_inserted:
-            logging.debug(f'skip already inserted record_i={record_i} url={record.rec_headers.get_header("WARC-Target-URI")}')
-            continue
-
-        # we're now committed to processing this url, and we log that fact
-        logging.debug(f'processing url={url}')
-
-        # extract the meta
-        try:
-            meta = metahtml.parse(html, url)
+    # the common crawl always formats fields as `"key": "value"`,
+    # and the fast path below uses only bytes.find
+    key = _cdx_field_keys[field]
+    i = line.find(key)
+    if i != -1:
+        i += len(key)
+        j = line.find(b'"', i)
+        value = line[i:j]
+        if b'\\' not in value:
+            return value.decode()
+
+    # the slow path handles escape sequences and other whitespace
+    match = _cdx_field_res[field].search(line)
+    if match is None:
+        return None
+    return json.loads(b'"' + match.group(1) + b'"')
+
+
+def cdxline_to_dict(line):
+    '''
+    Returns a dictionary containing only the CDX_FIELDS of a raw cdx line.
 
-        # if there was an error in metahtml, log it
-        except Exception as e:
-            logging.exception(f'exception when calling metahtml.parse() on url={url}')
-            meta = { 
-                'exception' : {
-                    'str(e)' : str(e),
-                    'type' : type(e).__name__,
-                    'location' : 'metahtml',
-                    'traceback' : traceback.format_exc()
-                    }
-                }
-
-        # add the results to the batch
-        meta_json = json.dumps(meta, default=str)
-        batch.append({
-            'accessed_at' : accessed_at,
-            'id_source' : id_source,
-            'url' : url,
-            'jsonb' : meta_json,
-            })
-
-        # bulk insert the batch
-        if len(batch)>=batch_size:
-            bulk_insert(connection, id_source, batch)
-            batch = []
-
-    # we have finished looping over the recorditr;
-    # we should bulk insert everything in the batch list that hasn't been inserted
-    if len(batch)>0:
-        bulk_insert(connection, id_source, batch)
-
-    # finished loading the file, so update the source table
-    sql = sqlalchemy.sql.text('''
-    UPDATE source SET finished_at=now() where id=:id;
-    ''')
-    res = connection.execute(sql,{'id':id_source})
+    >>> cdxline_to_dict(b'com,example)/ 20210101000000 {"url": "https://example.com/", "mime": "text/html", "status": "200", "digest": "ABC", "length": "10", "offset": "20", "filename": "a.warc.gz"}')
+    {'url': 'https://example.com/', 'mime': 'text/html', 'status': '200', 'length': '10', 'offset': '20', 'filename': 'a.warc.gz'}
+    '''
+    # a single regex pass extracts every field that has no escape sequences;
+    # this is called on every line that passes the filters, so it is worth avoiding a function call per field
+    data = { key.decode(): value.decode() for key, value in _cdx_fields_re.findall(line) }
+    if len(data) < len(CDX_FIELDS):
+        for field in CDX_FIELDS:
+            if field not in data:
+                value = cdxline_field(line, field)
+                if value is not None:
+                    data[field] = value
+    return data
+
+
+def cdxline_to_dict_json(line):
+    '''
+    Returns the full json dictionary of a raw cdx line.
+    This is much slower than cdxline_to_dict, and is kept for comparison in the benchmarks.
 
+    >>> cdxline_to_dict_json(b'com,example)/ 20210101000000 {"url": "https://example.com/", "mime": "text/html"}')
+    {'url': 'https://example.com/', 'mime': 'text/html'}
+    '''
+    # remove non-json content from start of line
+    i = line.find(b' ')
+    i = line.find(b' ', i+1)
+    return json.loads(line[i+1:])
 
-def bulk_insert(connection, id_source, batch):
 
-    # compute the entries for the metahtml_view table
-    batch_view = []
-    for item in batch:
-        meta = json.loads(item['jsonb'])
-        url = item['url']
-        try:
-            lang_iso = meta['language']['best']['value'][:2]
-            batch_view.append({
-                'url' : url,
-                'language' :  meta['language']['best']['value'],
-                'timestamp_published' : meta['timestamp.published']['best']['value']['lo'],
-                'title' : meta['title']['best']['value'],
-                'description' : meta['description']['best']['value'],
-                'content' : meta['content']['best']['value']['html'],
-                'tsv_title' : chajda.tsvector.lemmatize(lang_iso, meta['title']['best']['value']),
-                'tsv_content' : chajda.tsvector.lemmatize(lang_iso, meta['content']['best']['value']['text']),
-                })
-        except (TypeError,KeyError):
-            logging.debug(f'no lang/title/content for url={url}')
-
-    # wrap the actual insert in an infinite loop;
-    # the insert code can deadlock due to unique constraints,
-    # and we will keep attempting to insert with exponential backoff until the insert actually works
-    for attempt_count in itertools.count():
-        try:
-            # enter a transaction so that we update both the metahtml tables and the source table consistently
-            with connection.begin():
-
-                # update urls_inserted in the source table
-                sql = sqlalchemy.sql.text('''
-                SELECT urls_inserted FROM source WHERE id=:id_source FOR UPDATE;
-                ''')
-                res = connection.execute(sql,{'id_source':id_source})
-                urls_inserted = res.first()['urls_inserted']
-
-                sql = sqlalchemy.sql.text('''
-                UPDATE source SET urls_inserted=:urls_inserted WHERE id=:id_source;
-                ''')
-                res = connection.execute(sql,{'id_source':id_source, 'urls_inserted':urls_inserted+len(batch)})
-
-                # log our update
-                logging.info(f'bulk_insert: id_source={id_source}, urls_inserted={urls_inserted}, len(batch)={len(batch)}, len(batch_view)={len(batch_view)}')
-
-                # insert into metahtml
-                keys = ['accessed_at', 'id_source', 'url', 'jsonb']
-                sql = sqlalchemy.sql.text(f'''
-                    INSERT INTO metahtml ({','.join(keys)}) VALUES'''+
-                    ','.join(['(' + ','.join([f':{key}{i}' for key in keys]) + ')' for i in range(len(batch))])
-                    )
-                res = connection.execute(sql,{
-                    key+str(i) : d[key]
-                    for key in keys
-                    for i,d in enumerate(batch)
-                    })
-
-                # insert into metahtml_view
-                if len(batch_view) > 0:
-                    sql = sqlalchemy.sql.text(f'''
-                        INSERT INTO metahtml_view (timestamp_published, hostpath_surt, language, title, description, content, tsv_title, tsv_content) VALUES'''+
-                        ','.join([f'(:timestamp_published{i}, url_hostpath_surt(:url{i}), language_iso639(:language{i}), :title{i}, :description{i}, :content{i}, :tsv_title{i}, :tsv_content{i})' for i in range(len(batch_view))])
-                        + 'ON CONFLICT DO NOTHING'
-                        )
-                    res = connection.execute(sql,{
-                        key+str(i) : d[key]
-                        for i,d in enumerate(batch_view)
-                        for key in d.keys()
-                        })
-
-                # if we've made it to this point in the code,
-                # the insert was successful,
-                # and we return from the function
-                return
+def cdxline_shard(line, num_workers):
+    '''
+    Returns the worker in range(num_workers) that owns a raw cdx line.
 
-        # in the event of deadlock, perform the exponential backoff
-        except psycopg2.errors.DeadlockDetected:
-            sleep_time = 2**attempt_count
-            logging.error(f'psycopg2.errors.DeadlockDetected, sleep_time={sleep_time}')
-            time.sleep(sleep_time)
+    Lines are assigned by a stable hash of their SURT key with the query string and port removed.
+    Every url with the same hostname+path has the same such key,
+    so all duplicates of a url are owned by the same worker
+    and each worker can run the duplicate filter of mk_cdxiter on its own lines only.
 
+    >>> cdxline_shard(b'com,example)/a?b=1 20210101000000 {}', 20) == cdxline_shard(b'com,example:8080)/a 20210102000000 {}', 20)
+    True
+    >>> sorted(set(cdxline_shard(f'com,example)/{i} 20210101000000 {{}}'.encode(), 4) for i in range(100)))
+    [0, 1, 2, 3]
+    '''
+    key = line[:line.find(b' ')]
+    key = key.split(b'?', 1)[0]
+    host, sep, path = key.partition(b')')
+    host = host.split(b':', 1)[0]
+    return zlib.crc32(host + sep + path) % num_workers
 
-################################################################################
-# common crawl functions
-################################################################################
 
-def mk_cdxiter(cdxfiles, filter_mime=True, filter_status=True, filter_duplicates=True):
+def mk_cdxiter(cdxfiles, filter_mime=True, filter_status=True, filter_duplicates=True, prefilter=True, dedup_capacity=10**7, dedup_error_rate=1e-4, worker=0, num_workers=1):
     '''
     Generator function that loops over the lines in the cdxfile.
     Each yielded entry is the json dictionary corresponding a cdxfile entry,
     but many of these cdxentries may be filtered out based on the other parameters.
     These filters help reduce the file size of downloaded warc files.
+
+    prefilter:
+        If True, the mime/status filters are applied to the raw bytes of each line,
+        and only the lines that pass are parsed (with cdxline_to_dict);
+        the yielded dictionaries then contain only the CDX_FIELDS.
+        If False, every line is fully json decoded before filtering.
+
+    dedup_capacity, dedup_error_rate:
+        The duplicate filter stores the hostpaths it has seen in BloomFilters sized for `dedup_capacity` hostpaths,
+        so that memory usage is fixed (about 24MB per filter for the defaults) no matter how many urls the surt has.
+        A new url is wrongly dropped as a duplicate with probability at most `dedup_error_rate`
+        (while fewer than `dedup_capacity` urls have been kept),
+        and the estimated number of these drops is logged with the url_counts.
+        If dedup_error_rate is None, exact python sets are used instead.
+        Both filters are allocated once per call, not once per cdx file;
+        the duplicates within a single cdx file are found by adding each hostpath prefixed with the index of its cdx file.
+
+    worker, num_workers:
+        Only the lines owned by `worker` (see cdxline_shard) are parsed and yielded;
+        the remaining lines are skipped before any parsing.
     '''
+    def mk_hostpaths():
+        if dedup_error_rate is None:
+            return set()
+        return BloomFilter(dedup_capacity, dedup_error_rate)
+
     url_counts = Counter()
-    hostpaths_all = set()
-    logging.info(f"cdx_iter()")
-    for cdxfile in cdxfiles:
+    false_positives = 0
+    hostpaths_all = mk_hostpaths()
+    hostpaths_cdx = mk_hostpaths()
+    logging.info("cdx_iter()")
+    for i, cdxfile in enumerate(cdxfiles):
         logging.info(f'cdxfile={cdxfile}')
-        hostpaths_cdx = set()
-        with gzip.open(cdxfile, 'rt') as f:
+        with gzip.open(cdxfile, 'rb') as f:
             for line in f:
 
-                # remove non-json content from start of line
-                i = line.find(' ')
-                line = line[i+1:]
-                i = line.find(' ')
-                line = line[i+1:]
-
-                # extract the json
-                data = json.loads(line)
+                if num_workers > 1 and cdxline_shard(line, num_workers) != worker:
+                    continue
 
                 # run the filters
-                if filter_mime and data.get('mime') != 'text/html':
-                    url_counts['filter_mime'] += 1
-                    continue
+                if prefilter:
+                    # the substring checks accept almost all lines that pass the filters without any function calls
+                    if filter_mime and b'"mime": "text/html"' not in line and cdxline_field(line, 'mime') != 'text/html':
+                        url_counts['filter_mime'] += 1
+                        continue
 
-                if filter_status and data.get('status') != '200':
-                    url_counts['filter_status'] += 1
-                    continue
+                    if filter_status and b'"status": "200"' not in line and cdxline_field(line, 'status') != '200':
+                        url_counts['filter_status'] += 1
+                        continue
+
+                    data = cdxline_to_dict(line)
+
+                else:
+                    data = cdxline_to_dict_json(line)
+
+                    if filter_mime and data.get('mime') != 'text/html':
+                        url_counts['filter_mime'] += 1
+                        continue
+
+                    if filter_status and data.get('status') != '200':
+                        url_counts['filter_status'] += 1
+                        continue
 
                 if filter_duplicates:
                     url_parsed = urlparse(data['url'])
                     hostpath = url_parsed.hostname + url_parsed.path
-                    if hostpath in hostpaths_cdx:
+                    hostpath_cdx = f'{i} {hostpath}'
+                    if hostpath_cdx in hostpaths_cdx:
                         url_counts['filter_duplicates_cdx'] += 1
                         continue
                     elif hostpath in hostpaths_all:
                         url_counts['filter_duplicates_all'] += 1
                         continue
                     else:
+                        # each new hostpath had a chance of being a false positive of the filters above,
+                        # so summing these chances estimates the number of new hostpaths that were wrongly dropped
+                        if dedup_error_rate is not None:
+                            false_positives += hostpaths_all.false_positive_rate + hostpaths_cdx.false_positive_rate
                         hostpaths_all.add(hostpath)
-                        hostpaths_cdx.add(hostpath)
+                        hostpaths_cdx.add(hostpath_cdx)
 
                 url_counts['no_filter'] += 1
                 yield data
@@ -342,91 +436,563 @@ def mk_cdxiter(cdxfiles, filter_mime=True, filter_status=True, filter_duplicates
     total_urls = sum(url_counts.values())
     for k,v in sorted(url_counts.items()):
         logging.info(f"url_counts['{k}'] = {v}  or  {100*v/total_urls:0.2f}%")
+    if filter_duplicates and dedup_error_rate is not None:
+        logging.info(f"url_counts['filter_duplicates_false_positives'] ~= {false_positives:0.2f}  or  {100*false_positives/max(1,total_urls):0.4f}%")
 
 
-def cdxiter_to_warcitr(cdxiter, semsize=400, batchsize=1000):
+def coalesce_cdxiter(cdxiter, window=1000, max_gap=4096, max_length=8*1024**2):
+    '''
+    Generator function that groups the entries in cdxiter into byte ranges that can be downloaded with a single request.
+
+    Entries that point into the same WARC `filename` at nearby offsets are merged into a single range
+    whenever the gap between them is at most `max_gap` bytes and the merged range is at most `max_length` bytes.
+    Only entries within the same `window` consecutive entries of cdxiter are considered for merging,
+    which bounds the memory used by the planner.
+    Setting `max_gap=None` disables merging.
+
+    Each yielded range is a dictionary with the keys `filename`, `offset`, `length`,
+    `entries` (the list of cdx entries contained in the range),
+    and `positions` (the index of each entry within cdxiter).
+
+    >>> cdxs = [
+    ...     {'filename': 'a', 'offset': '0', 'length': '10'},
+    ...     {'filename': 'b', 'offset': '0', 'length': '10'},
+    ...     {'filename': 'a', 'offset': '15', 'length': '10'},
+    ...     {'filename': 'a', 'offset': '100', 'length': '10'},
+    ...     {'filename': 'a', 'offset': '10', 'length': '5'},
+    ...     ]
+    >>> for r in coalesce_cdxiter(cdxs, max_gap=10):
+    ...     print(r['filename'], r['offset'], r['length'], [d['offset'] for d in r['entries']])
+    a 0 25 ['0', '10', '15']
+    a 100 10 ['100']
+    b 0 10 ['0']
+    >>> for r in coalesce_cdxiter(cdxs, max_gap=None):
+    ...     print(r['filename'], r['offset'], r['length'], [d['offset'] for d in r['entries']])
+    a 0 10 ['0']
+    a 10 5 ['10']
+    a 15 10 ['15']
+    a 100 10 ['100']
+    b 0 10 ['0']
+    '''
+    cdxiter = enumerate(cdxiter)
+    while True:
+
+        # group the entries in the window by filename
+        cdxs = list(itertools.islice(cdxiter, window))
+        if len(cdxs) == 0:
+            break
+        cdxs_by_filename = defaultdict(list)
+        for position, data in cdxs:
+            cdxs_by_filename[data['filename']].append((position, data))
+
+        # within a file, merge the entries in sorted order;
+        # merged_stop is the end of the merged range, which can be past the end of its last entry when entries overlap
+        for filename in sorted(cdxs_by_filename):
+            merged = None
+            merged_stop = None
+            for position, data in sorted(cdxs_by_filename[filename], key=lambda x: int(x[1]['offset'])):
+                start = int(data['offset'])
+                stop = start + int(data['length'])
+                if (merged is not None
+                        and max_gap is not None
+                        and start - merged_stop <= max_gap
+                        and max(stop, merged_stop) - merged['offset'] <= max_length):
+                    merged_stop = max(stop, merged_stop)
+                    merged['length'] = merged_stop - merged['offset']
+                    merged['entries'].append(data)
+                    merged['positions'].append(position)
+                else:
+                    if merged is not None:
+                        yield merged
+                    merged_stop = stop
+                    merged = {
+                        'filename': filename,
+                        'offset': start,
+                        'length': stop - start,
+                        'entries': [data],
+                        'positions': [position],
+                        }
+            yield merged
+
+
+def cdxiter_to_warcitr(cdxiter, semsize=400, batchsize=1000, max_gap=4096, max_length=8*1024**2, ordered=False, queuesize=100, stats=None, cache=None, limiter=None, max_attempts=10, dead_letter_path=None, base_url='https://commoncrawl.s3.amazonaws.com/', session_kwargs=None, stop_interval=0.1):
     '''
     Iterates over the data in cdxiter in order to download the warc entries from common crawl;
     then combines these warc entries into a single warc file.
+
+    All downloads share a single connection pool created by mk_session();
+    the `session_kwargs` are passed to mk_session() to configure the pool.
+    Nearby entries in the same WARC file are downloaded with a single request;
+    see coalesce_cdxiter() for the meaning of `max_gap` and `max_length`.
+
+    The downloads happen in a background thread that keeps a sliding window of requests in flight;
+    a new request starts as soon as any previous request finishes,
+    so one slow request never stalls the other downloads.
+    The size of the window is chosen by `limiter` (by default, an AdaptiveLimiter that starts at 50 requests),
+    and is never larger than `semsize`.
+    Downloaded entries are passed to the consumer through a queue holding at most `queuesize` responses;
+    when the consumer falls behind and the queue fills up, no new requests are started.
+    When the consumer stops iterating, the requests in flight are cancelled within `stop_interval` seconds.
+
+    By default, entries are yielded in the order that their downloads finish;
+    if `ordered` is True, entries are yielded in the same order as cdxiter
+    (at the cost of buffering at most `batchsize` out-of-order entries).
+
+    If `stats` is a Counter, it will be updated in place with the download statistics;
+    in particular, `idle_sec` is the total time that no requests were in flight,
+    `backpressure_sec` is the time spent waiting for the consumer to make room in the queue,
+    and `consumer_wait_sec` is the time the consumer spent waiting on downloads.
+
+    If `cache` is a warc_cache.RangeCache, it is consulted before any download,
+    and every downloaded entry is stored in it.
+    Only the part of a range that contains uncached entries is downloaded;
+    `cache_hits` and `cache_misses` count entries, and `cache_bytes_saved` counts the bytes that were not downloaded.
+
+    A range that cannot be downloaded within `max_attempts` attempts (see get()) is not retried again;
+    instead, its cdx entries are appended as json lines to `dead_letter_path` (if given),
+    and None is yielded in place of each of its warc entries,
+    so that the positions of the other entries do not change.
     '''
+    if stats is None:
+        stats = Counter()
+    if limiter is None:
+        limiter = AdaptiveLimiter(initial=min(50, semsize), max_limit=semsize)
+    stop = threading.Event()
+    results = queue.Queue(maxsize=queuesize)
+    done_sentinel = object()
+
+    # the get_warcfile function is a wrapper around the get function defined above;
+    # it downloads an entire merged range and then slices the range back into the individual warc entries;
+    # it also tracks the number of requests in flight so that we can measure the time when the network is idle
+    in_flight = 0
+    idle_since = time.time()
+    async def get_warcfile(byterange):
+        nonlocal in_flight, idle_since
+        loop = asyncio.get_running_loop()
+
+        # load the cached entries;
+        # the download is then shrunk to the span of the uncached entries
+        filename = byterange['filename']
+        offset = byterange['offset']
+        length = byterange['length']
+        warc_entries = [None] * len(byterange['entries'])
+        if cache is not None:
+            # the cache does blocking file I/O, so it runs in the default executor instead of on the event loop
+            warc_entries = await loop.run_in_executor(None, lambda: [
+                cache.get(filename, int(data['offset']), int(data['length']))
+                for data in byterange['entries']
+                ])
+            missing = [ data for data, warc_entry in zip(byterange['entries'], warc_entries) if warc_entry is None ]
+            stats['cache_hits'] += len(warc_entries) - len(missing)
+            stats['cache_misses'] += len(missing)
+            metrics.inc('downloader_cache_hits_total', len(warc_entries) - len(missing))
+            metrics.inc('downloader_cache_misses_total', len(missing))
+            if len(missing) == 0:
+                stats['cache_bytes_saved'] += length
+                return byterange, warc_entries
+            offset = min(int(data['offset']) for data in missing)
+            length = max(int(data['offset']) + int(data['length']) for data in missing) - offset
+            stats['cache_bytes_saved'] += byterange['length'] - length
+
+        if in_flight == 0:
+            stats['idle_sec'] += time.time() - idle_since
+        in_flight += 1
+        metrics.set_gauge('downloader_in_flight', in_flight)
+        stats['requests_made'] += 1
+        start = time.time()
+        try:
+            url = base_url + filename
+            content = await get(session, url, offset, length, limiter=limiter, max_attempts=max_attempts)
+            logging.debug(f"get('{url}', {offset}, {length})")
+
+        # the range could not be downloaded, so we record its entries in the dead letter file
+        except FetchError as e:
+            logging.error(f'FetchError: {e}')
+            stats['dead_letters'] += len(byterange['entries'])
+            metrics.inc('downloader_dead_letters_total', len(byterange['entries']))
+            if dead_letter_path is not None:
+                with open(dead_letter_path, 'a') as f:
+                    for data in byterange['entries']:
+                        f.write(json.dumps(dict(data, error=str(e))) + '\n')
+            return byterange, warc_entries
+
+        finally:
+            in_flight -= 1
+            metrics.set_gauge('downloader_in_flight', in_flight)
+            if in_flight == 0:
+                idle_since = time.time()
+        metrics.observe('downloader_request_seconds', time.time() - start)
+        metrics.inc('downloader_requests_total')
+        metrics.inc('downloader_bytes_total', len(content))
+        if len(content) != length:
+            logging.warning(f"len(content)={len(content)} but length={length} for url={url}")
+
+        # slice the content back into the entries, and cache the new entries
+        new_entries = []
+        for i, data in enumerate(byterange['entries']):
+            if warc_entries[i] is None:
+                start = int(data['offset']) - offset
+                warc_entries[i] = content[start:start+int(data['length'])]
+                new_entries.append((int(data['offset']), int(data['length']), warc_entries[i]))
+        if cache is not None:
+            def put_entries():
+                for entry_offset, entry_length, warc_entry in new_entries:
+                    cache.put(filename, entry_offset, entry_length, warc_entry)
+            await loop.run_in_executor(None, put_entries)
+        return byterange, warc_entries
+
+    # the put function passes a list of warc entries to the consumer;
+    # the results queue is a thread-safe queue.Queue, and so we cannot block on it inside the event loop;
+    # instead we poll, which lets the in-flight downloads continue while we wait for the consumer
+    async def put(item):
+        start = time.time()
+        while not stop.is_set():
+            try:
+                results.put_nowait(item)
+                break
+            except queue.Full:
+                await asyncio.sleep(0.01)
+        stats['backpressure_sec'] += time.time() - start
+
+    # the producer function runs in the background thread;
+    # it keeps the window of in-flight requests full until rangeiter is exhausted or the consumer stops iterating
+    rangeiter = coalesce_cdxiter(cdxiter, window=batchsize, max_gap=max_gap, max_length=max_length)
+    def read_ranges():
+        return list(itertools.islice(rangeiter, semsize))
+
+    async def producer():
+        nonlocal session
+        session = await mk_session(**session_kwargs)
+        loop = asyncio.get_running_loop()
+        pending = set()
+        buffer = {}
+        next_position = 0
+        exhausted = False
+
+        # reading rangeiter decompresses and parses the cdx file, which would block the event loop;
+        # so the byteranges are read in batches in the default executor,
+        # and the next batch is read while the requests for the current batch are in flight
+        ranges = deque()
+        reader = None
+        try:
+            while not stop.is_set():
+
+                # start new requests until the window is full;
+                # we only wait on the reader when there are no requests in flight
+                while not exhausted and len(pending) < limiter.limit and len(buffer) < batchsize:
+                    if len(ranges) == 0:
+                        if reader is None:
+                            reader = loop.run_in_executor(None, read_ranges)
+                        if not reader.done() and len(pending) > 0:
+                            break
+                        byteranges = await reader
+                        reader = None
+                        if len(byteranges) == 0:
+                            exhausted = True
+                            break
+                        ranges.extend(byteranges)
+                    pending.add(asyncio.ensure_future(get_warcfile(ranges.popleft())))
+                if len(pending) == 0:
+                    break
+                if not exhausted and len(ranges) == 0 and reader is None:
+                    reader = loop.run_in_executor(None, read_ranges)
+
+                # wait for the first request to finish, and pass its entries to the consumer;
+                # a finished read also wakes us up, so that the new ranges can fill the window;
+                # the wait times out every `stop_interval` seconds to check whether the consumer has stopped,
+                # so that the requests in flight are cancelled without waiting for a slow request to finish
+                waiting = pending if reader is None or reader.done() else pending | {reader}
+                done, _ = await asyncio.wait(waiting, timeout=stop_interval, return_when=asyncio.FIRST_COMPLETED)
+                pending -= done
+                for task in done:
+                    if task is reader:
+                        continue
+                    byterange, warc_entries = task.result()
+                    if ordered:
+                        buffer.update(zip(byterange['positions'], warc_entries))
+                        warc_entries = []
+                        while next_position in buffer:
+                            warc_entries.append(buffer.pop(next_position))
+                            next_position += 1
+                    metrics.set_gauge('downloader_reorder_buffer_depth', len(buffer))
+                    if len(warc_entries) > 0:
+                        await put(warc_entries)
+            await put(done_sentinel)
 
-    # the get_warcfile function is a wrapper around the get function defined above
-    # that uses a semaphore to ensure that only `semsize` calls can happen simultaneously
-    import asyncio
-    sem = asyncio.Semaphore(semsize)
-    async def get_warcfile(data):
-        async with sem:
-            url = 'https://commoncrawl.s3.amazonaws.com/' + data['filename']
-            content = await get(url, data['offset'], data['length'])
-            logging.debug(f"get('{url}', {data['offset']}, {data['length']})")
-            return content
-
-    # use an infinite loop to process the input cdxiter generator;
-    # internally to the infinite loop we will process the generator in batches,
-    # and break out of the loop when the batch size is 0
+        except Exception as e:
+            await put(e)
+
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if reader is not None:
+                await asyncio.gather(reader, return_exceptions=True)
+            await session.close()
+
+    # create the connection pool;
+    # the pool is never larger than the number of simultaneous requests allowed by the window
+    session_kwargs = dict(session_kwargs or {})
+    session_kwargs.setdefault('limit', semsize)
+    session = None
+    thread = threading.Thread(target=asyncio.run, args=(producer(),), daemon=True)
+    thread.start()
+
+    # the consumer loop yields the entries as they arrive from the producer
     last_time = time.time()
     last_mb_downloaded = 0
+    last_log = 0
     mb_downloaded = 0
     urls_downloaded = 0
-    for batch_counter in itertools.count():
-
-        # get the batch
-        batch = list(itertools.islice(cdxiter, batchsize))
-        if len(batch) == 0:
-            break
-        urls_downloaded += len(batch)
-
-        # process the next batch
-        loop = asyncio.get_event_loop()
-        batch_tasks = asyncio.wait([ asyncio.ensure_future(get_warcfile(data)) for data in batch ])
-        done, pending = loop.run_until_complete(batch_tasks)
-        for future in done:
-            downloaded_warc_entry = future.result()
-            mb_downloaded += len(downloaded_warc_entry)/(1024**2)
-            yield downloaded_warc_entry
+    try:
+        while True:
+            metrics.set_gauge('downloader_results_queue_depth', results.qsize())
+            start = time.time()
+            warc_entries = results.get()
+            stats['consumer_wait_sec'] += time.time() - start
+            if warc_entries is done_sentinel:
+                break
+            if isinstance(warc_entries, Exception):
+                raise warc_entries
+
+            for downloaded_warc_entry in warc_entries:
+                urls_downloaded += 1
+                if downloaded_warc_entry is not None:
+                    mb_downloaded += len(downloaded_warc_entry)/(1024**2)
+                stats['urls_downloaded'] = urls_downloaded
+                yield downloaded_warc_entry
+
+            # generate logging info
+            if urls_downloaded - last_log >= batchsize:
+                mem = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+                curtime = time.time()
+                rate = (mb_downloaded-last_mb_downloaded)/(curtime-last_time)
+                logging.info(f"urls_downloaded={urls_downloaded}; requests_made={stats['requests_made']}; in_flight={in_flight}; limit={limiter.limit}; idle_sec={stats['idle_sec']:.2f}; backpressure_sec={stats['backpressure_sec']:.2f}; mem={mem:.2f}MB; mb_downloaded={mb_downloaded:.2f}MB; rate={rate:.2f}MB/sec")
+                if cache is not None:
+                    logging.info(f"cache_hits={stats['cache_hits']}; cache_misses={stats['cache_misses']}; cache_bytes_saved={stats['cache_bytes_saved']/1024**2:.2f}MB")
+                last_time = curtime
+                last_mb_downloaded = mb_downloaded
+                last_log = urls_downloaded
+
+    # stop the producer (and close the connection pool) even if the consumer stops iterating early
+    finally:
+        stop.set()
+        thread.join()
+
+
+def warcitr_to_warcfile(warcitr, out_filename, force=False, append=False, buffering=2**20, flush_every=1000):
+    '''
+    Writes each warc entry in warcitr to out_filename, and yields the entries.
 
-        # generate logging info
-        mem = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
-        curtime = time.time()
-        rate = (mb_downloaded-last_mb_downloaded)/(curtime-last_time)
-        logging.info(f"batch_counter={batch_counter}; urls_downloaded={urls_downloaded}; mem={mem:.2f}MB; mb_downloaded={mb_downloaded:.2f}MB; rate={rate:.2f}MB/sec")
-        last_time = curtime
-        last_mb_downloaded = mb_downloaded
+    A sidecar index of the records is written to out_filename + '.idx' at the same time,
+    and is sorted by surt when the files are closed;
+    see warc_index.py for the format and the lookup functions.
 
+    The WARC file is buffered, and is only flushed every `flush_every` entries;
+    the index lines of those entries are held back until the WARC file has been flushed,
+    and are then written to the line-buffered index all at once,
+    so the index never refers to a record that is not in the WARC file.
 
-def warcitr_to_warcfile(warcitr, out_filename, force=False):
-    '''
+    If append is True, then the entries are added to the end of an existing file (after warc_index.repair);
+    this is used when resuming a download,
+    and records that were written after the last checkpoint of the interrupted run will appear twice in the file.
     '''
     # if the force flag is not set, then we use 'xb' permissions,
     # which will fail if the file already exists;
     # otherwise we use 'wb' permissions to open the file,
     # which will truncate the existing file without an error
-    if not force:
+    offset = 0
+    if append:
+        if os.path.exists(out_filename):
+            offset = warc_index.repair(out_filename)
+        permissions = 'ab'
+    elif not force:
         permissions = 'xb'
     else:
         if os.path.exists(out_filename):
             logging.warning(f'out_filename exists, truncating: {out_filename}')
         permissions = 'wb'
 
-    # load out_filename and write the warc entries
-    with open(out_filename, permissions) as fwarc:
-        for warc_entry in warcitr:
-            fwarc.write(warc_entry)
-            fwarc.flush()
-            yield warc_entry
+    # load out_filename and write the warc entries;
+    # the files are closed in the reverse order that they are opened, so the WARC file is closed first
+    try:
+        with open(out_filename + '.idx', permissions.replace('b', ''), buffering=1) as fidx, \
+             open(out_filename, permissions, buffering=buffering) as fwarc:
+            index_lines = []
+            def flush():
+                fwarc.flush()
+                fidx.write(''.join(index_lines))
+                index_lines.clear()
+
+            # the index lines are also written when the consumer stops early or raises an exception
+            try:
+                for i, warc_entry in enumerate(warcitr):
+                    if warc_entry is None:
+                        yield warc_entry
+                        continue
+                    fwarc.write(warc_entry)
+                    index_lines.append(warc_index.index_line(warc_entry, offset))
+                    offset += len(warc_entry)
+                    if i % flush_every == flush_every - 1:
+                        flush()
+                    yield warc_entry
+            finally:
+                flush()
+
+    # the index is also sorted when the consumer stops early or raises an exception,
+    # since both files have been completely written by the with statement
+    finally:
+        if os.path.exists(out_filename + '.idx'):
+            warc_index.sort_index(out_filename)
+
+
+def get_cdx_paths(surt, crawl=None, data_dir='/data/common-crawl'):
+    '''
+    Returns the list of cdx files for the surt.
+
+    If crawl is None, then all of the cdx files in the data dir are returned;
+    the crawls are sorted from newest to oldest,
+    so that when we discard duplicates in downstream steps,
+    we are discarding the older crawls.
+    '''
+    if crawl:
+        return [data_dir + f'/cdx/{surt}/{surt}-{crawl}.cdx.gz']
+    else:
+        dirpath = data_dir + f'/cdx/{surt}/'
+        cdx_paths = [ dirpath + filename for filename in os.listdir(dirpath) ]
+        cdx_paths.sort(reverse=True)
+        return cdx_paths
+
+
+def get_shard_path(cdx_path, worker, num_workers, data_dir='/data/common-crawl'):
+    '''
+    Returns the path where plan_shards stores the lines of cdx_path owned by worker.
+    '''
+    surt = os.path.basename(os.path.dirname(cdx_path))
+    return data_dir + f'/cdx_shards/{surt}-of-{num_workers:04}/{worker:04}/' + os.path.basename(cdx_path)
+
+
+def plan_shards(surt, *, num_workers, crawl=None, data_dir='/data/common-crawl', force=False):
+    '''
+    Splits each cdx file of the surt into num_workers shard files with cdxline_shard.
+
+    This is a one-time pass over the cdx files that lets each worker of download_warc read only the lines it owns,
+    rather than every worker decompressing all of the cdx files.
+    The shards of each cdx file are written to temporary files and then renamed,
+    and cdx files whose shards already exist are skipped (unless force is set),
+    so an interrupted run can simply be restarted.
+    '''
+    for cdx_path in get_cdx_paths(surt, crawl, data_dir):
+        shard_paths = [ get_shard_path(cdx_path, worker, num_workers, data_dir) for worker in range(num_workers) ]
+        if all(os.path.exists(shard_path) for shard_path in shard_paths) and not force:
+            logging.info(f'shards of {cdx_path} already exist, skipping')
+            continue
+
+        logging.info(f'plan_shards: cdx_path={cdx_path}')
+        for shard_path in shard_paths:
+            os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        tmp_paths = [ shard_path + '.tmp' for shard_path in shard_paths ]
+        shard_counts = Counter()
+        with gzip.open(cdx_path, 'rb') as fin:
+            fouts = [ gzip.open(tmp_path, 'wb') for tmp_path in tmp_paths ]
+            try:
+                for line in fin:
+                    shard = cdxline_shard(line, num_workers)
+                    fouts[shard].write(line)
+                    shard_counts[shard] += 1
+            finally:
+                for fout in fouts:
+                    fout.close()
+        for tmp_path, shard_path in zip(tmp_paths, shard_paths):
+            os.replace(tmp_path, shard_path)
+        logging.info(f'plan_shards: min(shard_counts)={min(shard_counts.values(), default=0)}, max(shard_counts)={max(shard_counts.values(), default=0)}')
+
+
+def check_sources(connection, surt, crawl, num_workers, data_dir):
+    '''
+    Raises ValueError if the database has progress for surt/crawl that download_warc cannot resume from,
+    since starting over at position 0 would insert duplicate rows into metahtml (which has no unique key).
+
+    Before the source_progress table existed, each worker stored its progress under the name of its warcfile
+    (see services/pg/migrations/0001_source_progress.sql),
+    and the cdx lines were partitioned between the workers with `i % num_workers` instead of cdxline_shard;
+    so the old checkpoints are positions in different sequences of cdx lines.
+    Such a surt/crawl has to be finished with the old downloader,
+    or its rows have to be deleted from metahtml (and its sources from the source table) before it is loaded again.
+
+    For the same reason, a surt/crawl that was partially loaded with one value of num_workers
+    cannot be resumed with another value,
+    since cdxline_shard assigns the lines to different workers.
+    '''
+    import sqlalchemy
+    prefix = data_dir + f'/warc_new2/{surt}-{crawl}-'
+    sql = sqlalchemy.sql.text('''
+    SELECT name FROM source WHERE left(name, length(:prefix)) = :prefix AND name LIKE '%.warc.gz' ORDER BY name;
+    ''')
+    old_names = [ row['name'] for row in connection.execute(sql, {'prefix': prefix}) ]
+    if len(old_names) > 0:
+        raise ValueError(f'surt={surt}, crawl={crawl} was loaded by the old downloader (sources: {old_names}); its progress cannot be resumed')
+
+    sql = sqlalchemy.sql.text('''
+    SELECT DISTINCT name
+    FROM source
+    JOIN source_progress ON source.id = source_progress.id_source
+    WHERE left(name, length(:prefix)) = :prefix AND name <> :name AND urls_inserted > 0
+    ORDER BY name;
+    ''')
+    other_names = [ row['name'] for row in connection.execute(sql, {'prefix': prefix + 'of-', 'name': prefix + f'of-{num_workers:04}'}) ]
+    if len(other_names) > 0:
+        raise ValueError(f'surt={surt}, crawl={crawl} was partially loaded with a different num_workers (sources: {other_names}); the cdx lines are sharded differently, so its progress cannot be resumed with num_workers={num_workers}')
 
 
-def download_warc(surt, *, worker=0, num_workers=1, write_warcfile=False, load_pg=False, crawl=None, data_dir='/data/common-crawl', force=False, dryrun=False):
+def download_warc(surt, *, worker=0, num_workers=1, write_warcfile=False, load_pg=False, parse_workers=0, crawl=None, download_cdx=False, dedup_capacity=10**7, cache_dir=None, cache_gb=100, latency_target=None, metrics_port=None, metrics_dir=None, metrics_interval=60, data_dir='/data/common-crawl', base_url='https://commoncrawl.s3.amazonaws.com/', db_url=None, force=False, dryrun=False):
     '''
     Constructs a warc file that contains all useful urls from the given surt/crawl combination.
 
     crawl:
         If crawl is None, then it will use the entirety of the common crawl;
         If crawl is a specific crawl name, then it will only generate a warc file for that crawl.
+
+    parse_workers:
+        The number of processes used to run metahtml when loading into postgres;
+        0 runs metahtml in the main process.
+
+    download_cdx:
+        If True, the cdx file for the surt is first downloaded with cdx_index.download_cdx (if it doesn't already exist);
+        this requires that crawl is specified and its cluster.idx file is in data_dir.
+
+    dedup_capacity:
+        The number of unique urls the duplicate filter of mk_cdxiter is sized for;
+        this should be raised for surts with more urls to keep the false positive rate low.
+
+    cache_dir, cache_gb:
+        If cache_dir is given, the downloaded warc entries are stored in a warc_cache.RangeCache of at most cache_gb GB in that directory,
+        and later runs (for example, re-ingesting a surt after metahtml improves) read the entries from disk instead of the network.
+
+    latency_target:
+        Downloads that take longer than latency_target seconds shrink the number of requests in flight (see AdaptiveLimiter);
+        by default, it is 4 times the median latency of the first 100 downloads.
+
+    metrics_port, metrics_dir, metrics_interval:
+        If metrics_port is given, the metrics (see metrics.py) are served at http://localhost:{metrics_port+worker}/metrics;
+        if metrics_dir is given, they are written as json to metrics_dir every metrics_interval seconds.
+
+    base_url, db_url:
+        The common crawl server to download from and the database to load into;
+        by default, the database is given by the POSTGRES_* environment variables.
+        These are overridden by the benchmarks in tests/test_benchmark.py to use a local stand-in and a scratch database.
+
+    worker, num_workers:
+        The cdx lines are partitioned between the workers with cdxline_shard,
+        so a partially loaded surt/crawl must be resumed with the same num_workers (see check_sources).
+        If plan_shards has already been run for num_workers, then each worker reads only its own shard files;
+        otherwise each worker reads every cdx file but skips the lines it doesn't own before parsing them.
     '''
 
-    # compute the output filename
+    # compute the output filename;
+    # all workers share a single entry in the source table, and each worker's progress is tracked as a separate shard
     warcfile = data_dir + f'/warc_new2/{surt}-{crawl}-{worker:04}-of-{num_workers:04}.warc.gz'
+    source_name = data_dir + f'/warc_new2/{surt}-{crawl}-of-{num_workers:04}'
 
     # make output directory if it doesn't exist
     try:
@@ -434,21 +1000,29 @@ def download_warc(surt, *, worker=0, num_workers=1, write_warcfile=False, load_p
     except FileExistsError:
         pass
 
+    # export the metrics;
+    # every worker gets its own port and file
+    if metrics_port is not None:
+        metrics.serve(metrics_port + worker)
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics.dump_periodically(metrics_dir + f'/downloader-{surt}-{crawl}-{worker:04}-of-{num_workers:04}.json', metrics_interval)
+
     # create an iterator over the cdx file(s)
-    if crawl:
-        cdx_paths = [data_dir + f'/cdx/{surt}/{surt}-{crawl}.cdx.gz']
+    if download_cdx:
+        if not crawl:
+            raise ValueError('download_cdx requires a crawl')
+        cdx_index.download_cdx(crawl, surt, data_dir=data_dir, base_url=base_url)
+    cdx_paths = get_cdx_paths(surt, crawl, data_dir)
+
+    # only the entries owned by the current worker are traversed;
+    # both branches below yield exactly the same entries
+    shard_paths = [ get_shard_path(cdx_path, worker, num_workers, data_dir) for cdx_path in cdx_paths ]
+    if num_workers > 1 and all(os.path.exists(shard_path) for shard_path in shard_paths):
+        logging.info('using the shard files from plan_shards')
+        cdxiter = mk_cdxiter(shard_paths, dedup_capacity=dedup_capacity)
     else:
-        # when no crawl is specified, we search the data dir for all crawls;
-        # we sort the crawls from oldest to newest;
-        # this way, when if discard duplicates in downstream steps,
-        # we are discarding the older crawls
-        dirpath = data_dir + f'/cdx/{surt}/'
-        cdx_paths = [ dirpath + filename for filename in os.listdir(dirpath) ]
-        cdx_paths.sort(reverse=True)
-    cdxiter = mk_cdxiter(cdx_paths)
-
-    # filter the cdxiter so that only the entries applicable to the current worker are traversed
-    cdxiter = (x for i,x in enumerate(cdxiter) if i%num_workers == worker)
+        cdxiter = mk_cdxiter(cdx_paths, dedup_capacity=dedup_capacity, worker=worker, num_workers=num_workers)
 
     # in a dryrun, we'll just process the cdxiter;
     # this will log statistics about what the actual run would compute,
@@ -459,26 +1033,52 @@ def download_warc(surt, *, worker=0, num_workers=1, write_warcfile=False, load_p
     # not a dryrun, so actually download the data
     else:
 
-        # stream the iterators
-        warcitr = cdxiter_to_warcitr(cdxiter)
-
-        if write_warcfile:
-            warcitr = warcitr_to_warcfile(warcitr, warcfile, force)
-
-        # load into the database
+        # when loading into the database, we resume from the checkpoint stored in the source_progress table;
+        # the already processed prefix of the cdxiter is skipped before anything is downloaded
+        start_position = 0
         if load_pg:
             # create database connection
             import sqlalchemy
-            dburl = f'postgresql://{os.environ["POSTGRES_USER"]}:{os.environ["POSTGRES_PASSWORD"]}@pg:5432/{os.environ["POSTGRES_NAME"]}'
-            engine = sqlalchemy.create_engine(dburl, connect_args={
+            if db_url is None:
+                db_url = f'postgresql://{os.environ["POSTGRES_USER"]}:{os.environ["POSTGRES_PASSWORD"]}@pg:5432/{os.environ["POSTGRES_NAME"]}'
+            engine = sqlalchemy.create_engine(db_url, connect_args={
                 'application_name': 'metahtml',
                 'connect_timeout': 60*60
                 })  
             connection = engine.connect()
 
-            # load the records
+            check_sources(connection, surt, crawl, num_workers, data_dir)
+            id_source, start_position, finished_at = get_source(connection, source_name, shard=worker)
+            if finished_at is not None:
+                logging.info(f'finished_at is {finished_at}, skipping')
+                return
+            if start_position > 0:
+                logging.info(f'resuming from start_position={start_position}')
+                cdxiter = itertools.islice(cdxiter, start_position, None)
+
+        # stream the iterators;
+        # the records must arrive in cdx order for the checkpoint to be a valid resume position
+        cache = RangeCache(cache_dir, max_bytes=cache_gb*1024**3) if cache_dir else None
+        # ranges that cannot be downloaded are recorded in the dead letter file so that they can be retried later
+        dead_letter_path = data_dir + f'/dead_letter/{surt}-{crawl}-{worker:04}-of-{num_workers:04}.jsonl'
+        os.makedirs(os.path.dirname(dead_letter_path), exist_ok=True)
+        limiter = AdaptiveLimiter(latency_target=latency_target)
+        warcitr = cdxiter_to_warcitr(cdxiter, ordered=load_pg, cache=cache, limiter=limiter, dead_letter_path=dead_letter_path, base_url=base_url)
+
+        # when resuming, the records before start_position are already in the warcfile,
+        # so the new records must be appended instead of overwriting the file
+        if write_warcfile:
+            warcitr = warcitr_to_warcfile(warcitr, warcfile, force, append=start_position > 0)
+
+        # load into the database
+        if load_pg:
             recorditr = warcitr_to_recorditr(warcitr)
-            recorditr_to_pg(recorditr, connection, warcfile)
+            recorditr_to_pg(recorditr, connection, source_name, start_position=start_position, parse_workers=parse_workers, shard=worker)
+
+        # otherwise nothing else consumes the warcitr, and so we must loop over it to download the data
+        else:
+            for warc_entry in warcitr:
+                pass
 
 ################################################################################
 # standalone executable code
@@ -492,7 +1092,8 @@ if __name__ == '__main__':
         level=logging.INFO,
         )
 
-    # run the downloader
+    # run the downloader;
+    # the shards are planned with `downloader.py --plan-shards`
     from clize import run
-    run(download_warc)
+    run(download_warc, alt=[plan_shards])
 
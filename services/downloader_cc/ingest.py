@@ -0,0 +1,668 @@
+'''
+The ingest core shared by downloader.py (streaming from the common crawl) and downloader_warc.py (local WARC files).
+
+The pipeline is:
+1. recorditr_to_pg() extracts the (picklable) contents of each WARC record;
+1. parse_page() runs metahtml and the lemmatizer on each page, possibly in parallel worker processes,
+   and returns a Page that holds both the serialized JSON and the fields for the metahtml_view table;
+   repeated texts are lemmatized only once per process (see LemmaCache);
+1. bulk_insert() loads batches of pages into postgres.
+
+Each page's meta is serialized to JSON exactly once (inside parse_page) and is never parsed again.
+'''
+
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import psycopg2
+import random
+import sqlalchemy
+import time
+import traceback
+
+import chajda.tsvector
+import metahtml
+import metrics
+
+from collections import Counter, OrderedDict, deque
+
+################################################################################
+# parallel processing
+################################################################################
+
+def parallel_map(func, iterable, num_workers=0, ordered=True, queuesize=None):
+    '''
+    Generator function that yields func(x) for each x in iterable,
+    where the calls to func are computed in a pool of `num_workers` processes.
+    If num_workers is None, then one process per core is used;
+    if num_workers is 0, then func is called in the current process.
+
+    At most `queuesize` inputs (by default, 4 per worker) are submitted to the pool at once,
+    so memory usage stays bounded when the consumer is slower than the pool.
+    If `ordered` is True, the results are yielded in the same order as the inputs;
+    otherwise, each result is yielded as soon as it is available.
+
+    >>> list(parallel_map(abs, [-1, 2, -3]))
+    [1, 2, 3]
+    >>> list(parallel_map(abs, [-1, 2, -3], num_workers=2))
+    [1, 2, 3]
+    >>> sorted(parallel_map(abs, [-1, 2, -3], num_workers=2, ordered=False))
+    [1, 2, 3]
+    '''
+    if num_workers == 0:
+        yield from map(func, iterable)
+        return
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if queuesize is None:
+        queuesize = 4*num_workers
+
+    # the downloader runs in a background thread, and forking a multithreaded process is unsafe;
+    # the forkserver context starts the workers from a clean single-threaded process instead
+    mp_context = multiprocessing.get_context('forkserver')
+    with concurrent.futures.ProcessPoolExecutor(num_workers, mp_context=mp_context) as pool:
+        pending = deque()
+
+        def pop_results():
+            if ordered:
+                yield pending.popleft().result()
+            else:
+                done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                pending.clear()
+                pending.extend(not_done)
+                for future in done:
+                    yield future.result()
+
+        for x in iterable:
+            pending.append(pool.submit(func, x))
+            metrics.set_gauge('parallel_map_pending', len(pending), func=func.__name__)
+            while len(pending) >= queuesize:
+                yield from pop_results()
+        while len(pending) > 0:
+            yield from pop_results()
+
+
+################################################################################
+# page processing
+################################################################################
+
+class Page:
+    '''
+    The processed contents of a single WARC record.
+
+    `jsonb` is the serialized output of metahtml (or None if the record had no contents).
+    The remaining fields are the columns of the metahtml_view table;
+    they are all None unless metahtml found a language, title, and content for the page
+    (see the has_view property).
+
+    Using __slots__ keeps these objects small,
+    which matters because batches of thousands of them are held in memory and pickled between processes.
+
+    >>> page = Page(3, 'https://example.com', '2021-01-01T00:00:00Z', '{}')
+    >>> page.has_view
+    False
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(page)).url
+    'https://example.com'
+    '''
+    __slots__ = (
+        'position',
+        'url',
+        'accessed_at',
+        'jsonb',
+        'language',
+        'timestamp_published',
+        'title',
+        'description',
+        'content',
+        'tsv_title',
+        'tsv_content',
+        'parse_sec',
+        'lemmatize_sec',
+        'lemmatize_cache_hits',
+        )
+
+    def __init__(self, position, url=None, accessed_at=None, jsonb=None):
+        self.position = position
+        self.url = url
+        self.accessed_at = accessed_at
+        self.jsonb = jsonb
+        self.language = None
+        self.timestamp_published = None
+        self.title = None
+        self.description = None
+        self.content = None
+        self.tsv_title = None
+        self.tsv_content = None
+        self.parse_sec = None
+        self.lemmatize_sec = None
+        self.lemmatize_cache_hits = None
+
+    def __getstate__(self):
+        return tuple(getattr(self, key) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key, value in zip(self.__slots__, state):
+            setattr(self, key, value)
+
+    @property
+    def has_view(self):
+        return self.language is not None
+
+
+def record_to_page(record, filter_records=False):
+    '''
+    Extracts the tuple (url, accessed_at, html) from a warcio record,
+    or returns None if the record should not be processed.
+
+    If `filter_records` is True, then records that are not successful text/html responses are also skipped;
+    the common crawl downloader does not need these filters because the cdx files have already been filtered.
+    '''
+    if filter_records:
+
+        # skip WARC entries that are not responses
+        if record.rec_type != 'response':
+            logging.debug(f'skip record.rec_type={record.rec_type}')
+            return None
+
+        # skip WARC responses that are not successful (status code 2XX)
+        if record.http_headers.statusline[0] != '2':
+            logging.debug(f'skip statusline={record.http_headers.statusline} url={record.rec_headers.get_header("WARC-Target-URI")}')
+            return None
+
+        # skip WARC responses that are not text/html
+        headers = dict(record.http_headers.headers)
+        content_type = headers.get('Content-Type','')
+        if 'html' not in content_type and 'text' not in content_type and len(content_type)>0:
+            logging.debug(f'skip content_type={content_type} url={record.rec_headers.get_header("WARC-Target-URI")}')
+            return None
+
+    # extract the contents of the WARC record
+    html = record.content_stream().read()
+    url = record.rec_headers.get_header('WARC-Target-URI')
+    accessed_at = record.rec_headers.get_header('WARC-Date')
+    if html is None or url is None or accessed_at is None:
+        logging.error(f'invalid values found in WARC record; html is None={html is None}, url={url}, accessed_at={accessed_at}')
+        return None
+
+    return url, accessed_at, html
+
+
+class LemmaCache:
+    '''
+    A bounded LRU cache in front of a lemmatizer.
+
+    Many pages from the same host share identical titles and boilerplate content,
+    so the cache makes lemmatizing a repeated text cost a dictionary lookup instead of a spacy run.
+    The keys are the language and a hash of the text, so the cache never stores the (possibly long) texts themselves;
+    the cache holds at most max_bytes characters of lemmatized output.
+
+    >>> cache = LemmaCache(lambda lang, text: text.upper(), max_bytes=6)
+    >>> cache.lemmatize('en', 'abc'), cache.lemmatize('en', 'abc'), cache.lemmatize('de', 'abc')
+    ('ABC', 'ABC', 'ABC')
+    >>> cache.lemmatize('en', 'xyz')
+    'XYZ'
+    >>> dict(cache.stats)
+    {'misses': 3, 'hits': 1, 'evictions': 1}
+    >>> cache.hit_rate
+    0.25
+    '''
+
+    def __init__(self, lemmatizer, max_bytes=64*1024**2):
+        self.lemmatizer = lemmatizer
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = Counter()
+
+    def lemmatize(self, lang, text):
+        if text is None:
+            return self.lemmatizer(lang, text)
+        key = (lang, hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest())
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return self.entries[key]
+
+        self.stats['misses'] += 1
+        lemmas = self.lemmatizer(lang, text)
+        self.entries[key] = lemmas
+        self.total_bytes += len(lemmas or '')
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted or '')
+            self.stats['evictions'] += 1
+        return lemmas
+
+    @property
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / max(1, lookups)
+
+
+# every parse_page worker process has its own cache
+lemma_cache = LemmaCache(chajda.tsvector.lemmatize)
+
+
+def parse_page(page):
+    '''
+    Runs metahtml and the lemmatizer on the page tuple (position, url, accessed_at, html),
+    and returns a Page.
+    If html is None, then the returned Page has no contents.
+
+    This function runs inside the parallel_map workers,
+    and so its inputs and outputs must be picklable.
+    '''
+    position, url, accessed_at, html = page
+    if html is None:
+        return Page(position, url, accessed_at)
+
+    # we're now committed to processing this url, and we log that fact
+    logging.debug(f'processing url={url}')
+
+    # extract the meta
+    start = time.time()
+    try:
+        meta = metahtml.parse(html, url)
+
+    # if there was an error in metahtml, log it
+    except Exception as e:
+        logging.exception(f'exception when calling metahtml.parse() on url={url}')
+        meta = {
+            'exception' : {
+                'str(e)' : str(e),
+                'type' : type(e).__name__,
+                'location' : 'metahtml',
+                'traceback' : traceback.format_exc()
+                }
+            }
+
+    ret = Page(position, url, accessed_at, json.dumps(meta, default=str))
+    ret.parse_sec = time.time() - start
+
+    # compute the entries for the metahtml_view table directly from the meta dictionary
+    try:
+        language = meta['language']['best']['value']
+        timestamp_published = meta['timestamp.published']['best']['value']['lo']
+        title = meta['title']['best']['value']
+        description = meta['description']['best']['value']
+        content = meta['content']['best']['value']['html']
+        text = meta['content']['best']['value']['text']
+    except (TypeError,KeyError):
+        logging.debug(f'no lang/title/content for url={url}')
+        return ret
+    lang_iso = language[:2]
+    ret.language = language
+    ret.timestamp_published = None if timestamp_published is None else str(timestamp_published)
+    ret.title = title
+    ret.description = description
+    ret.content = content
+    start = time.time()
+    hits = lemma_cache.stats['hits']
+    ret.tsv_title = lemma_cache.lemmatize(lang_iso, title)
+    ret.tsv_content = lemma_cache.lemmatize(lang_iso, text)
+    ret.lemmatize_sec = time.time() - start
+    ret.lemmatize_cache_hits = lemma_cache.stats['hits'] - hits
+    return ret
+
+
+################################################################################
+# postgres functions
+################################################################################
+
+def get_source(connection, source_name, shard=0):
+    '''
+    Returns the tuple (id_source, urls_inserted, finished_at) for the given shard of source_name,
+    creating new entries in the source and source_progress tables if they do not already exist.
+    '''
+
+    # create a new entry in the source table for this warc file if no entry exists;
+    # several workers may be creating the same source at the same time,
+    # and so we cannot assume that our insert will be the one that succeeds
+    sql = sqlalchemy.sql.text('''
+    INSERT INTO source (name) VALUES (:name) ON CONFLICT (name) DO NOTHING;
+    ''')
+    connection.execute(sql,{'name':source_name})
+    sql = sqlalchemy.sql.text('''
+    SELECT id FROM source WHERE name=:name;
+    ''')
+    id_source = connection.execute(sql,{'name':source_name}).first()['id']
+
+    # get info from the source_progress table about previous runs of this shard
+    sql = sqlalchemy.sql.text('''
+    INSERT INTO source_progress (id_source, shard) VALUES (:id_source, :shard) ON CONFLICT DO NOTHING;
+    ''')
+    connection.execute(sql,{'id_source':id_source, 'shard':shard})
+    sql = sqlalchemy.sql.text('''
+    SELECT urls_inserted,finished_at FROM source_progress WHERE id_source=:id_source AND shard=:shard;
+    ''')
+    row = connection.execute(sql,{'id_source':id_source, 'shard':shard}).first()
+    if row['urls_inserted'] > 0:
+        logging.info(f"name='{source_name}' shard={shard} exists in source_progress")
+    return id_source, row['urls_inserted'], row['finished_at']
+
+
+def recorditr_to_pg(recorditr, connection, source_name, batch_size=1000, start_position=0, parse_workers=0, ordered=True, filter_records=False, shard=0):
+    '''
+    Insert each record in recorditr into the database.
+    This function will create a new entry in the source table if source_name does not already exist.
+    If source_name already exists,
+    then the existing entry will be used to skip the first records in recorditr to prevent duplicates from being inserted.
+
+    Progress is tracked separately for each `shard` of the source in the source_progress table,
+    so that many workers can load the same source without contending on a single row.
+    The `urls_inserted` column counts every record of the shard that has been processed
+    (including records that could not be inserted),
+    so that it is always a valid position to resume from.
+    Callers that have already skipped the processed records before downloading them
+    should pass the position of the first record of recorditr as `start_position`.
+    Entries of recorditr that are None are counted but otherwise ignored.
+
+    The records are parsed by metahtml in `parse_workers` processes (see parallel_map).
+    If `ordered` is False, records are inserted in the order that they finish parsing;
+    this avoids stalling on slow pages,
+    but a crash may cause some records after the checkpoint to be inserted twice on resume.
+    See record_to_page for the meaning of `filter_records`.
+    '''
+
+    id_source, urls_inserted, finished_at = get_source(connection, source_name, shard)
+
+    # if finished_at has a timestamp, then we've already fully processed the file and can skip it
+    if finished_at is not None:
+        logging.info(f'finished_at is {finished_at}, skipping')
+        return
+
+    logging.debug(f'id_source={id_source}')
+
+    # the pageitr generator extracts the contents of each record that still needs to be processed;
+    # the records themselves are backed by open streams,
+    # so we extract the (picklable) contents here before passing them to the parse_page workers;
+    # records that are not processed are still passed on so that the checkpoint advances past them
+    def pageitr():
+        for position,record in enumerate(recorditr, start_position):
+
+            # skip responses that have already been added
+            if position < urls_inserted:
+                logging.debug(f'skip already inserted position={position}')
+                continue
+
+            contents = None
+            if record is not None:
+                # reading the record's contents is where warcio decompresses it
+                start = time.time()
+                contents = record_to_page(record, filter_records)
+                metrics.observe('ingest_read_seconds', time.time() - start)
+            if contents is None:
+                yield position, None, None, None
+            else:
+                yield (position,) + contents
+
+    # run metahtml on the pages, possibly in parallel
+    pages = parallel_map(parse_page, pageitr(), num_workers=parse_workers, ordered=ordered)
+
+    # for efficiency, we will not insert items into the db one at a time;
+    # instead, we add them to the batch list,
+    # and then bulk insert the batch list when it reaches len(batch)==batch_size;
+    # the checkpoint is the first position that has not been processed,
+    # and when the pages arrive out of order we only advance it past the contiguous processed positions
+    batch = []
+    checkpoint = max(urls_inserted, start_position)
+    next_checkpoint = checkpoint
+    processed_positions = set()
+    lemmatize_cache = Counter()
+    for page in pages:
+        processed_positions.add(page.position)
+        if page.parse_sec is not None:
+            metrics.observe('ingest_parse_seconds', page.parse_sec)
+        if page.lemmatize_sec is not None:
+            metrics.observe('ingest_lemmatize_seconds', page.lemmatize_sec)
+
+            # each page lemmatizes its title and its text;
+            # the caches live in the parse_page workers, so their hits are reported through the pages
+            lemmatize_cache['lookups'] += 2
+            lemmatize_cache['hits'] += page.lemmatize_cache_hits
+            metrics.inc('ingest_lemmatize_cache_lookups_total', 2)
+            metrics.inc('ingest_lemmatize_cache_hits_total', page.lemmatize_cache_hits)
+        metrics.set_gauge('ingest_batch_depth', len(batch))
+        while next_checkpoint in processed_positions:
+            processed_positions.remove(next_checkpoint)
+            next_checkpoint += 1
+
+        # skip pages without contents
+        if page.jsonb is None:
+            continue
+        batch.append(page)
+
+        # bulk insert the batch;
+        # the source's progress is advanced past every record we have looked at, not just the ones in the batch
+        if len(batch)>=batch_size:
+            bulk_insert(connection, id_source, batch, num_records=next_checkpoint-checkpoint, shard=shard)
+            checkpoint = next_checkpoint
+            batch = []
+
+    # we have finished looping over the recorditr;
+    # we should bulk insert everything in the batch list that hasn't been inserted
+    if len(batch)>0 or next_checkpoint>checkpoint:
+        bulk_insert(connection, id_source, batch, num_records=next_checkpoint-checkpoint, shard=shard)
+
+    logging.info(f"lemmatize cache: lookups={lemmatize_cache['lookups']}; hits={lemmatize_cache['hits']}; hit_rate={lemmatize_cache['hits']/max(1,lemmatize_cache['lookups']):.2f}")
+
+    # finished loading the file, so update the source_progress table
+    sql = sqlalchemy.sql.text('''
+    UPDATE source_progress SET finished_at=now() WHERE id_source=:id_source AND shard=:shard;
+    ''')
+    connection.execute(sql,{'id_source':id_source, 'shard':shard})
+
+
+def copy_escape(value):
+    r'''
+    Formats a python value as a field for postgres's COPY text format.
+
+    >>> copy_escape(None)
+    '\\N'
+    >>> print(copy_escape('a\tb\\c\nd'))
+    a\tb\\c\nd
+    >>> copy_escape(5)
+    '5'
+    '''
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(connection, table, keys, rows):
+    '''
+    Streams the rows (an iterable of tuples whose entries correspond to keys) into table using postgres's COPY command.
+    COPY is much faster than INSERT for large batches because postgres does not have to parse a statement per row.
+    '''
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(copy_escape, row)))
+        buf.write('\n')
+    buf.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY {table} ({",".join(keys)}) FROM STDIN', buf)
+
+
+def insert_copy(connection, id_source, pages):
+    '''
+    Inserts the pages into metahtml and metahtml_view using COPY.
+    '''
+    if len(pages) > 0:
+        copy_rows(connection, 'metahtml', ['accessed_at', 'id_source', 'url', 'jsonb'], [
+            (page.accessed_at, id_source, page.url, page.jsonb)
+            for page in pages
+            ])
+    copy_view(connection, pages)
+
+
+def copy_view(connection, pages, update=False):
+    '''
+    Inserts the pages that have a view into metahtml_view using COPY.
+
+    The metahtml_view table needs some columns computed in the database and uses ON CONFLICT DO NOTHING,
+    neither of which are supported by COPY;
+    so the rows are first copied into a temporary staging table
+    and then moved into metahtml_view set-wise with a single INSERT statement.
+
+    If `update` is True, then the existing rows for the pages' hostpaths are first updated in place;
+    a row is left unchanged if its new title would conflict with another row of the same host,
+    since the unique index on (host, title) would otherwise make the whole update fail.
+    '''
+    pages_view = [ page for page in pages if page.has_view ]
+    if len(pages_view) > 0:
+        keys = ['timestamp_published', 'url', 'language', 'title', 'description', 'content', 'tsv_title', 'tsv_content']
+        connection.execute(sqlalchemy.sql.text('''
+            CREATE TEMPORARY TABLE metahtml_view_staging (
+                timestamp_published TIMESTAMPTZ,
+                url TEXT,
+                language TEXT,
+                title TEXT,
+                description TEXT,
+                content TEXT,
+                tsv_title tsvector,
+                tsv_content tsvector
+            ) ON COMMIT DROP;
+            '''))
+        copy_rows(connection, 'metahtml_view_staging', keys, [
+            tuple(getattr(page, key) for key in keys)
+            for page in pages_view
+            ])
+        if update:
+            connection.execute(sqlalchemy.sql.text('''
+                UPDATE metahtml_view
+                SET
+                    timestamp_published = staging.timestamp_published,
+                    language = language_iso639(staging.language),
+                    title = staging.title,
+                    description = staging.description,
+                    content = staging.content,
+                    tsv_title = staging.tsv_title,
+                    tsv_content = staging.tsv_content
+                FROM (
+                    SELECT DISTINCT ON (url_host(unsurt(url_hostpath_surt(url))), title) *
+                    FROM metahtml_view_staging
+                    ORDER BY url_host(unsurt(url_hostpath_surt(url))), title, url
+                ) AS staging
+                WHERE
+                    metahtml_view.hostpath_surt = url_hostpath_surt(staging.url) AND
+                    NOT EXISTS (
+                        SELECT 1
+                        FROM metahtml_view AS other
+                        WHERE
+                            url_host(unsurt(other.hostpath_surt)) = url_host(unsurt(metahtml_view.hostpath_surt)) AND
+                            other.title = staging.title AND
+                            other.hostpath_surt <> metahtml_view.hostpath_surt
+                    );
+                '''))
+        connection.execute(sqlalchemy.sql.text('''
+            INSERT INTO metahtml_view (timestamp_published, hostpath_surt, language, title, description, content, tsv_title, tsv_content)
+            SELECT timestamp_published, url_hostpath_surt(url), language_iso639(language), title, description, content, tsv_title, tsv_content
+            FROM metahtml_view_staging
+            ON CONFLICT DO NOTHING;
+            '''))
+        connection.execute(sqlalchemy.sql.text('''
+            DROP TABLE metahtml_view_staging;
+            '''))
+
+
+def insert_values(connection, id_source, pages):
+    '''
+    Inserts the pages into metahtml and metahtml_view using multi-row INSERT statements.
+    This is slower than insert_copy, and is kept for comparison.
+    '''
+    # insert into metahtml
+    if len(pages) > 0:
+        keys = ['accessed_at', 'url', 'jsonb']
+        sql = sqlalchemy.sql.text(f'''
+            INSERT INTO metahtml (id_source,{','.join(keys)}) VALUES'''+
+            ','.join(['(:id_source,' + ','.join([f':{key}{i}' for key in keys]) + ')' for i in range(len(pages))])
+            )
+        binds = {
+            key+str(i) : getattr(page, key)
+            for key in keys
+            for i,page in enumerate(pages)
+            }
+        binds['id_source'] = id_source
+        connection.execute(sql, binds)
+
+    # insert into metahtml_view
+    pages_view = [ page for page in pages if page.has_view ]
+    if len(pages_view) > 0:
+        keys = ['timestamp_published', 'url', 'language', 'title', 'description', 'content', 'tsv_title', 'tsv_content']
+        sql = sqlalchemy.sql.text('''
+            INSERT INTO metahtml_view (timestamp_published, hostpath_surt, language, title, description, content, tsv_title, tsv_content) VALUES'''+
+            ','.join([f'(:timestamp_published{i}, url_hostpath_surt(:url{i}), language_iso639(:language{i}), :title{i}, :description{i}, :content{i}, :tsv_title{i}, :tsv_content{i})' for i in range(len(pages_view))])
+            + 'ON CONFLICT DO NOTHING'
+            )
+        connection.execute(sql,{
+            key+str(i) : getattr(page, key)
+            for i,page in enumerate(pages_view)
+            for key in keys
+            })
+
+
+def retry_deadlocks(func, max_sleep=60):
+    '''
+    Calls func() until it does not raise a deadlock error, and returns its result.
+
+    Inserts can deadlock due to unique constraints on metahtml_view,
+    so we keep retrying with exponential backoff until the call actually works;
+    the sleep time is capped at max_sleep seconds and randomized so that the deadlocked workers do not retry in lockstep.
+    '''
+    for attempt_count in itertools.count():
+        try:
+            return func()
+
+        # sqlalchemy wraps the psycopg2 exception, so we must check the original exception's type;
+        # copy_rows uses the raw psycopg2 cursor, so a deadlock during a COPY is not wrapped
+        except (sqlalchemy.exc.OperationalError, psycopg2.errors.DeadlockDetected) as e:
+            if not isinstance(getattr(e, 'orig', e), psycopg2.errors.DeadlockDetected):
+                raise
+            metrics.inc('ingest_deadlocks_total')
+            sleep_time = random.uniform(0, min(2**attempt_count, max_sleep))
+            logging.error(f'psycopg2.errors.DeadlockDetected, sleep_time={sleep_time:.2f}')
+            time.sleep(sleep_time)
+
+
+def bulk_insert(connection, id_source, pages, num_records=None, insert=insert_copy, shard=0, max_sleep=60):
+    '''
+    Inserts the pages into the metahtml and metahtml_view tables,
+    and increments the shard's urls_inserted by `num_records` (by default, the number of pages).
+    The `insert` parameter is the function that performs the actual inserts (insert_copy or insert_values).
+    '''
+    if num_records is None:
+        num_records = len(pages)
+
+    # enter a transaction so that we update both the metahtml tables and the source_progress table consistently;
+    # the whole transaction is retried if it deadlocks
+    def transaction():
+        with connection.begin():
+
+            # update urls_inserted in the source_progress table;
+            # only this worker ever updates this row, so this never waits on another worker
+            sql = sqlalchemy.sql.text('''
+            UPDATE source_progress
+            SET urls_inserted=urls_inserted+:num_records, updated_at=now()
+            WHERE id_source=:id_source AND shard=:shard
+            RETURNING urls_inserted;
+            ''')
+            res = connection.execute(sql,{'id_source':id_source, 'shard':shard, 'num_records':num_records})
+            urls_inserted = res.first()['urls_inserted']
+
+            # log our update
+            logging.info(f'bulk_insert: id_source={id_source}, shard={shard}, urls_inserted={urls_inserted}, len(pages)={len(pages)}, num_records={num_records}')
+
+            # insert into the metahtml tables
+            insert(connection, id_source, pages)
+
+    start = time.time()
+    retry_deadlocks(transaction, max_sleep=max_sleep)
+    metrics.observe('ingest_insert_seconds', time.time() - start)
+    metrics.inc('ingest_pages_inserted_total', len(pages))
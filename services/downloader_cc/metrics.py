@@ -0,0 +1,210 @@
+'''
+A minimal metrics registry for the downloader.
+
+The downloader and ingest code record metrics with the module level functions inc(), observe(), and set_gauge();
+these are cheap and thread-safe, and do nothing except update in-memory values.
+The values can then be exported in two ways:
+1. serve() starts an HTTP server that answers with the prometheus text format,
+   so that a running job can be scraped or simply inspected with curl;
+1. dump_periodically() writes the values as json to a file at a fixed interval.
+
+Each metric has a name and optional labels,
+so for example the retries are counted separately for each exception type:
+
+>>> registry = Registry()
+>>> registry.inc('retries_total', exception='TimeoutError')
+>>> registry.inc('retries_total', 2, exception='ClientConnectorError')
+>>> registry.set_gauge('in_flight', 7)
+>>> registry.observe('request_seconds', 0.3, buckets=(0.1, 1))
+>>> print(registry.render_text())
+# TYPE in_flight gauge
+in_flight 7
+# TYPE request_seconds histogram
+request_seconds_bucket{le="0.1"} 0
+request_seconds_bucket{le="1"} 1
+request_seconds_bucket{le="+Inf"} 1
+request_seconds_sum 0.3
+request_seconds_count 1
+# TYPE retries_total counter
+retries_total{exception="ClientConnectorError"} 2
+retries_total{exception="TimeoutError"} 1
+<BLANKLINE>
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# the default histogram buckets are in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    '''
+    Holds the current value of every metric.
+    Metrics are keyed by the tuple (name, labels), where labels is a sorted tuple of (key, value) pairs.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': list(buckets),
+                    'counts': [0] * len(buckets),
+                    'sum': 0,
+                    'count': 0,
+                    }
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def to_dict(self):
+        '''
+        Returns the values of all metrics as a json-serializable dictionary.
+        '''
+        def fmt(key):
+            name, labels = key
+            if len(labels) == 0:
+                return name
+            return name + '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+        with self.lock:
+            return {
+                'time': time.time(),
+                'counters': { fmt(key): value for key, value in self.counters.items() },
+                'gauges': { fmt(key): value for key, value in self.gauges.items() },
+                'histograms': {
+                    fmt(key): {
+                        'buckets': dict(zip(map(str, histogram['buckets']), histogram['counts'])),
+                        'sum': histogram['sum'],
+                        'count': histogram['count'],
+                        }
+                    for key, histogram in self.histograms.items()
+                    },
+                }
+
+    def render_text(self):
+        '''
+        Returns the values of all metrics in the prometheus text format.
+        '''
+        def fmt_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if len(labels) == 0:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+        lines = []
+        with self.lock:
+            metrics = []
+            for key, value in self.counters.items():
+                metrics.append((key, 'counter', value))
+            for key, value in self.gauges.items():
+                metrics.append((key, 'gauge', value))
+            for key, value in self.histograms.items():
+                metrics.append((key, 'histogram', value))
+            metrics.sort(key=lambda metric: metric[0])
+
+            last_name = None
+            for (name, labels), kind, value in metrics:
+                if name != last_name:
+                    lines.append(f'# TYPE {name} {kind}')
+                    last_name = name
+                if kind == 'histogram':
+                    for bound, count in zip(value['buckets'], value['counts']):
+                        lines.append(f'{name}_bucket{fmt_labels(labels, [("le", bound)])} {count}')
+                    lines.append(f'{name}_bucket{fmt_labels(labels, [("le", "+Inf")])} {value["count"]}')
+                    lines.append(f'{name}_sum{fmt_labels(labels)} {value["sum"]}')
+                    lines.append(f'{name}_count{fmt_labels(labels)} {value["count"]}')
+                else:
+                    lines.append(f'{name}{fmt_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# the registry used by the module level functions below
+REGISTRY = Registry()
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    REGISTRY.set_gauge(name, value, **labels)
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    REGISTRY.observe(name, value, buckets, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/metrics.json':
+            body = json.dumps(self.server.registry.to_dict()).encode()
+            content_type = 'application/json'
+        else:
+            body = self.server.registry.render_text().encode()
+            content_type = 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    '''
+    Serves the metrics at http://host:port/metrics (text format) and http://host:port/metrics.json
+    from a daemon thread, and returns the server.
+    '''
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info(f'serving metrics on http://{host}:{server.server_address[1]}/metrics')
+    return server
+
+
+def dump_periodically(path, interval=60, registry=REGISTRY):
+    '''
+    Writes the metrics as json to path every `interval` seconds from a daemon thread.
+    Each dump replaces the previous one atomically, so the file can be read at any time.
+    '''
+    def loop():
+        while True:
+            time.sleep(interval)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(registry.to_dict(), f)
+            os.replace(tmp_path, path)
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+'''
+Re-parses the WARC files written by downloader.py when the installed metahtml version changes.
+
+The metahtml table stores the version of metahtml that produced each row in `jsonb->'version'`
+(see the metahtml_versions materialized view),
+and the warc_new2 directory holds the original WARC records for every row that the downloader loaded.
+For each batch of records in a WARC file, we:
+1. look up the stored version of each record's row in metahtml;
+1. re-run parse_page only on the records whose stored version differs from the installed version;
+1. replace the jsonb of those rows in metahtml, and their rows in metahtml_view.
+Rows where metahtml.parse raised an exception have no version in their jsonb,
+so they are reparsed once by the first reprocessing and then stored with the installed version (see stamp_version).
+Records whose row is not in the database (or is already up to date) are never parsed,
+so rerunning the reprocessing after a crash only redoes the unfinished work.
+
+The WARC files are processed in parallel, one file per worker process;
+each worker parses its own records, so the throughput scales with the number of cores.
+'''
+
+import glob
+import itertools
+import json
+import logging
+import os
+import sqlalchemy
+import time
+
+import metahtml
+
+from collections import Counter
+from warcio.archiveiterator import ArchiveIterator
+
+from ingest import copy_rows, copy_view, parallel_map, parse_page, record_to_page, retry_deadlocks
+
+
+def get_installed_version():
+    '''
+    Returns the version that the installed metahtml stores in the `version` field of its output, encoded as json.
+    '''
+    meta = metahtml.parse(b'<html></html>', 'https://example.com/')
+    return json.dumps(meta['version'], default=str)
+
+
+def mk_connection():
+    dburl = f'postgresql://{os.environ["POSTGRES_USER"]}:{os.environ["POSTGRES_PASSWORD"]}@pg:5432/{os.environ["POSTGRES_NAME"]}'
+    engine = sqlalchemy.create_engine(dburl, connect_args={
+        'application_name': 'metahtml_reprocess',
+        'connect_timeout': 60*60
+        })
+    return engine.connect()
+
+
+def find_stale(connection, pages, version):
+    '''
+    Returns the set of positions in pages (a list of (position, url, accessed_at, html) tuples)
+    whose row in metahtml was produced by a metahtml version other than `version`.
+
+    The rows are matched on both url and accessed_at,
+    so that the same url downloaded in different crawls is matched to the right record;
+    the url_hostpath_surt(url) condition lets postgres use the index on metahtml.
+    '''
+    with connection.begin():
+        connection.execute(sqlalchemy.sql.text('''
+            CREATE TEMPORARY TABLE reprocess_keys (
+                position INTEGER,
+                url TEXT,
+                accessed_at TIMESTAMPTZ
+            ) ON COMMIT DROP;
+            '''))
+        copy_rows(connection, 'reprocess_keys', ['position', 'url', 'accessed_at'], [
+            (position, url, accessed_at)
+            for position, url, accessed_at, html in pages
+            ])
+        res = connection.execute(sqlalchemy.sql.text('''
+            SELECT DISTINCT reprocess_keys.position
+            FROM reprocess_keys
+            JOIN metahtml ON
+                url_hostpath_surt(metahtml.url) = url_hostpath_surt(reprocess_keys.url) AND
+                metahtml.url = reprocess_keys.url AND
+                metahtml.accessed_at = reprocess_keys.accessed_at
+            WHERE metahtml.jsonb->'version' IS DISTINCT FROM CAST(:version AS JSONB);
+            '''), {'version': version})
+        stale = set(row['position'] for row in res)
+        connection.execute(sqlalchemy.sql.text('''
+            DROP TABLE reprocess_keys;
+            '''))
+        return stale
+
+
+def stamp_version(page, version):
+    '''
+    Adds `version` to the jsonb of a page where metahtml.parse raised an exception,
+    so that find_stale does not consider the page stale again until the installed version changes.
+    '''
+    if page.jsonb is not None:
+        meta = json.loads(page.jsonb)
+        if 'version' not in meta:
+            meta['version'] = json.loads(version)
+            page.jsonb = json.dumps(meta)
+    return page
+
+
+def upsert_pages(connection, pages):
+    '''
+    Replaces the jsonb of the pages' rows in metahtml, and updates metahtml_view for the pages that it was built from.
+
+    metahtml_view has a single row per hostpath for all of the crawls,
+    and the downloader inserts the newest crawls first (see downloader.get_cdx_paths);
+    so the view row of a hostpath is only changed when the page is the newest record of the hostpath in metahtml.
+    Otherwise, WARC files of different crawls (which are reprocessed in parallel)
+    would overwrite each other's view rows, and the last writer would win.
+    A newest page that no longer has a view with the installed metahtml version has its view row deleted.
+    '''
+    def transaction():
+        with connection.begin():
+            connection.execute(sqlalchemy.sql.text('''
+                CREATE TEMPORARY TABLE reprocess_pages (
+                    position INTEGER,
+                    url TEXT,
+                    accessed_at TIMESTAMPTZ,
+                    jsonb JSONB,
+                    has_view BOOLEAN
+                ) ON COMMIT DROP;
+                '''))
+            copy_rows(connection, 'reprocess_pages', ['position', 'url', 'accessed_at', 'jsonb', 'has_view'], [
+                (page.position, page.url, page.accessed_at, page.jsonb, page.has_view)
+                for page in pages
+                ])
+            connection.execute(sqlalchemy.sql.text('''
+                UPDATE metahtml
+                SET jsonb = reprocess_pages.jsonb
+                FROM reprocess_pages
+                WHERE
+                    url_hostpath_surt(metahtml.url) = url_hostpath_surt(reprocess_pages.url) AND
+                    metahtml.url = reprocess_pages.url AND
+                    metahtml.accessed_at = reprocess_pages.accessed_at;
+                '''))
+
+            # the newest record of a hostpath is the one with the largest (accessed_at, url),
+            # so that exactly one record is chosen even when two urls have the same hostpath and accessed_at
+            res = connection.execute(sqlalchemy.sql.text('''
+                SELECT position
+                FROM reprocess_pages
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM metahtml
+                    WHERE
+                        url_hostpath_surt(metahtml.url) = url_hostpath_surt(reprocess_pages.url) AND
+                        (metahtml.accessed_at, metahtml.url) > (reprocess_pages.accessed_at, reprocess_pages.url)
+                    );
+                '''))
+            newest = set(row['position'] for row in res)
+            connection.execute(sqlalchemy.sql.text('''
+                DELETE FROM metahtml_view
+                WHERE hostpath_surt IN (
+                    SELECT url_hostpath_surt(url)
+                    FROM reprocess_pages
+                    WHERE NOT has_view AND position = ANY(:newest)
+                    );
+                '''), {'newest': list(newest)})
+            connection.execute(sqlalchemy.sql.text('''
+                DROP TABLE reprocess_pages;
+                '''))
+            copy_view(connection, [ page for page in pages if page.position in newest ], update=True)
+    retry_deadlocks(transaction)
+
+
+def reprocess_warc(args):
+    '''
+    Reprocesses a single WARC file, and returns the tuple (warc_path, stats) where stats is a Counter describing the run.
+    The input is the tuple (warc_path, version, batch_size) so that this function can be used with parallel_map.
+    '''
+    warc_path, version, batch_size = args
+    connection = mk_connection()
+    stats = Counter()
+    start = time.time()
+    with open(warc_path, 'rb') as stream:
+
+        # record_to_page reads each record's content before the iterator advances past it
+        pageitr = (
+            (position,) + contents
+            for position, contents in enumerate(record_to_page(record, filter_records=True) for record in ArchiveIterator(stream))
+            if contents is not None
+            )
+        while True:
+            batch = list(itertools.islice(pageitr, batch_size))
+            if len(batch) == 0:
+                break
+            stats['records'] += len(batch)
+
+            stale = find_stale(connection, batch, version)
+            stats['stale'] += len(stale)
+            if len(stale) == 0:
+                continue
+
+            parse_start = time.time()
+            pages = [ stamp_version(parse_page(page), version) for page in batch if page[0] in stale ]
+            stats['parse_sec'] += time.time() - parse_start
+            upsert_pages(connection, pages)
+
+    connection.close()
+    stats['runtime_sec'] = time.time() - start
+    return warc_path, stats
+
+
+def reprocess(*warc_paths, data_dir='/data/common-crawl', workers:int=None, batch_size:int=1000):
+    '''
+    Reprocesses the given WARC files (by default, every file in data_dir/warc_new2) with the installed metahtml.
+
+    workers:
+        The number of WARC files processed at the same time;
+        by default, one per core.
+    '''
+    if len(warc_paths) == 0:
+        warc_paths = sorted(glob.glob(data_dir + '/warc_new2/*.warc.gz'))
+    version = get_installed_version()
+    logging.info(f'reprocess: len(warc_paths)={len(warc_paths)}, version={version}')
+    if workers is None:
+        workers = os.cpu_count()
+
+    # the throughput per core is the number of reparsed records per second of worker time
+    totals = Counter()
+    start = time.time()
+    args = [ (warc_path, version, batch_size) for warc_path in warc_paths ]
+    for warc_path, stats in parallel_map(reprocess_warc, args, num_workers=workers, ordered=False, queuesize=workers):
+        totals.update(stats)
+        logging.info(f"warc_path={warc_path}; records={stats['records']}; stale={stats['stale']}; runtime_sec={stats['runtime_sec']:.2f}; stale/sec={stats['stale']/stats['runtime_sec']:.2f}")
+        elapsed = time.time() - start
+        logging.info(f"totals: records={totals['records']}; stale={totals['stale']}; records/sec={totals['records']/elapsed:.2f}; stale/sec/core={totals['stale']/max(totals['runtime_sec'],1e-9):.2f}; parse/sec/core={totals['stale']/max(totals['parse_sec'],1e-9):.2f}")
+
+
+################################################################################
+# standalone executable code
+################################################################################
+
+if __name__ == '__main__':
+
+    # setup logging
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        )
+
+    from clize import run
+    run(reprocess)
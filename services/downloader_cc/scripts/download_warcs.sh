@@ -6,6 +6,9 @@ num_workers=20
 logdir=$LOGDIR/$surt
 mkdir -p $logdir
 
+# split the cdx files once so that each worker only reads the lines it owns
+python3 ./downloader.py --plan-shards $surt --num-workers=$num_workers > $logdir/plan_shards.$surt 2>&1
+
 for worker in $(seq 0 $(( $num_workers - 1)) ); do
     cmd="python3 ./downloader.py $surt --load-pg --worker=$worker --num-workers=$num_workers"
     echo $cmd
@@ -0,0 +1,113 @@
+'''
+A local stand-in for commoncrawl.s3.amazonaws.com.
+
+The server holds a dictionary mapping paths to bytes and answers HTTP GET requests,
+including requests with a `Range:` header.
+It also counts the number of requests and TCP connections it has served,
+which lets the tests check that connections are actually being reused.
+
+To test the downloader's handling of an overloaded server,
+the server can answer with `503 Slow Down` (like S3 does) whenever more than `max_concurrent` requests are active,
+and can add a `delay` to every response.
+'''
+
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class CCHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 is required for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.active += 1
+            throttled = self.server.max_concurrent is not None and self.server.active > self.server.max_concurrent
+            if throttled:
+                self.server.stats['throttled'] += 1
+        try:
+            if throttled:
+                body = b'<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>'
+                self.send_response(503)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                time.sleep(self.server.delay)
+                self.send_file()
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def send_file(self):
+        path = self.path.lstrip('/')
+        if path not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = self.server.files[path]
+
+        # parse the range header, if present
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            match = re.fullmatch(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(match.group(1))
+            stop = int(match.group(2)) if match.group(2) else len(data)-1
+            data = data[start:stop+1]
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CCServer(ThreadingHTTPServer):
+    '''
+    Usage:
+
+    >>> with CCServer({'a/b.txt': b'hello world'}) as server:
+    ...     import urllib.request
+    ...     request = urllib.request.Request(server.base_url + 'a/b.txt', headers={'Range': 'bytes=6-10'})
+    ...     urllib.request.urlopen(request).read()
+    b'world'
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, files, max_concurrent=None, delay=0):
+        super().__init__(('127.0.0.1', 0), CCHandler)
+        self.files = files
+        self.max_concurrent = max_concurrent
+        self.delay = delay
+        self.active = 0
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'throttled': 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}/'
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
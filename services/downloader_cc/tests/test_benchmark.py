@@ -0,0 +1,210 @@
+'''
+End-to-end benchmarks of the ingest pipeline against a local stand-in for the common crawl.
+
+The WARC files are synthetic and served by tests/cc_standin.py with range support,
+and the matching cdx file is written to a temporary data_dir,
+so the benchmarks never touch S3.
+Each benchmark logs the throughput of the stages of the pipeline:
+1. fetch: downloading the WARC ranges (cdxiter_to_warcitr);
+1. read: decompressing and reading the records with warcio (record_to_page);
+1. parse: running metahtml.parse;
+1. lemmatize: running the lemmatizer on the title and text;
+1. insert: loading the pages into postgres (bulk_insert).
+The results are only visible with `pytest -o log_cli=true --log-cli-level=INFO tests/test_benchmark.py`.
+
+The benchmarks that load into postgres (download_warc and downloader_warc.insert_warc) only run when
+the BENCHMARK_DB_URL environment variable is the url of a scratch database with the schema in services/pg/sql;
+these benchmarks commit their rows, so BENCHMARK_DB_URL must never be the production database.
+'''
+
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+
+import pytest
+import sqlalchemy
+
+import downloader
+import ingest
+import metrics
+import warc_index
+from tests.cc_standin import CCServer
+from tests.test_downloader import mk_warc_record
+
+
+SURT = 'com,example)'
+CRAWL = 'CC-MAIN-2021-04'
+
+
+@pytest.fixture
+def db_url():
+    if 'BENCHMARK_DB_URL' not in os.environ:
+        pytest.skip('requires a scratch database in BENCHMARK_DB_URL')
+    return os.environ['BENCHMARK_DB_URL']
+
+
+def mk_html(i):
+    '''
+    Returns a news-article-like html page, so that metahtml finds a title and content to lemmatize.
+    '''
+    paragraphs = ''.join(
+        f'<p>Paragraph {j} of article {i}: officials met on Tuesday to discuss the economy, the weather, and the elections.</p>'
+        for j in range(20)
+        )
+    return (
+        f'<html><head><title>Benchmark article {i}</title>'
+        f'<meta name="description" content="The description of benchmark article {i}">'
+        f'<meta property="article:published_time" content="2021-01-{1+i%28:02}T12:00:00Z"></head>'
+        f'<body><article><h1>Benchmark article {i}</h1>{paragraphs}</article></body></html>'
+        ).encode()
+
+
+def mk_crawl(data_dir, num_records, host, records_per_file=500):
+    '''
+    Writes the cdx file for SURT/CRAWL into data_dir,
+    and returns the dictionary of WARC files that it indexes (to be served by CCServer).
+    The urls are on `host`, so that the rows of different runs never collide in the database.
+    '''
+    files = {}
+    lines = []
+    for i in range(num_records):
+        filename = f'crawl-data/{CRAWL}/segments/{i//records_per_file}/warc/{CRAWL}-{i//records_per_file:05}.warc.gz'
+        url = f'https://{host}/article/{i}.html'
+        record = mk_warc_record(url, mk_html(i))
+        data = files.get(filename, b'')
+        lines.append(f'{warc_index.url_to_surt(url)} 20210101000000 ' + json.dumps({
+            'url': url,
+            'mime': 'text/html',
+            'mime-detected': 'text/html',
+            'status': '200',
+            'digest': f'{i:032}',
+            'length': str(len(record)),
+            'offset': str(len(data)),
+            'filename': filename,
+            }) + '\n')
+        files[filename] = data + record
+
+    cdx_path = downloader.get_cdx_paths(SURT, CRAWL, data_dir)[0]
+    os.makedirs(os.path.dirname(cdx_path), exist_ok=True)
+    with gzip.open(cdx_path, 'wt') as f:
+        f.writelines(sorted(lines))
+    return files
+
+
+def log_rates(name, rates):
+    '''
+    The rates are records per second, except for fetch_mb which is MB per second.
+    '''
+    logging.info(f'{name}: ' + '; '.join(f'{stage}/sec={rate:.2f}' for stage, rate in rates.items()))
+
+
+def metrics_rates(before, after, runtime):
+    '''
+    Returns the throughput of each stage from two snapshots of metrics.REGISTRY.to_dict().
+    The stages run concurrently, so each stage's rate is the number of records per second spent in that stage;
+    the fetch rate is the number of MB per second of wall clock time.
+    '''
+    def diff(kind, name, key=None):
+        value_after = after[kind].get(name, {} if key else 0)
+        value_before = before[kind].get(name, {} if key else 0)
+        if key:
+            return value_after.get(key, 0) - value_before.get(key, 0)
+        return value_after - value_before
+
+    rates = {}
+    rates['fetch_mb'] = diff('counters', 'downloader_bytes_total') / 1024**2 / runtime
+    for stage in ['read', 'parse', 'lemmatize']:
+        seconds = diff('histograms', f'ingest_{stage}_seconds', 'sum')
+        if seconds > 0:
+            rates[stage] = diff('histograms', f'ingest_{stage}_seconds', 'count') / seconds
+    seconds = diff('histograms', 'ingest_insert_seconds', 'sum')
+    if seconds > 0:
+        rates['insert'] = diff('counters', 'ingest_pages_inserted_total') / seconds
+    return rates
+
+
+@pytest.mark.parametrize('num_records', [1000])
+def test_benchmark_stages(tmp_path, num_records):
+    '''
+    Runs the stages of the pipeline one after the other, so that each stage is timed in isolation.
+    '''
+    data_dir = str(tmp_path)
+    files = mk_crawl(data_dir, num_records, 'www.example.com')
+    cdx_paths = downloader.get_cdx_paths(SURT, CRAWL, data_dir)
+    rates = {}
+
+    # the fetch stage includes reading the cdx file
+    with CCServer(files) as server:
+        start = time.time()
+        cdxiter = downloader.mk_cdxiter(cdx_paths)
+        warc_entries = list(downloader.cdxiter_to_warcitr(cdxiter, ordered=True, base_url=server.base_url))
+        runtime = time.time() - start
+    assert len(warc_entries) == num_records
+    rates['fetch'] = num_records / runtime
+    rates['fetch_mb'] = sum(map(len, warc_entries)) / 1024**2 / runtime
+
+    start = time.time()
+    contents = [ ingest.record_to_page(record) for record in downloader.warcitr_to_recorditr(warc_entries) ]
+    rates['read'] = num_records / (time.time() - start)
+    assert sorted(url for url, accessed_at, html in contents) == sorted(f'https://www.example.com/article/{i}.html' for i in range(num_records))
+
+    pages = [ ingest.parse_page((position,) + content) for position, content in enumerate(contents) ]
+    rates['parse'] = num_records / sum(page.parse_sec for page in pages)
+    lemmatized = [ page for page in pages if page.lemmatize_sec is not None ]
+    if len(lemmatized) > 0:
+        rates['lemmatize'] = len(lemmatized) / sum(page.lemmatize_sec for page in lemmatized)
+
+    log_rates(f'stages num_records={num_records}', rates)
+
+
+@pytest.mark.parametrize('num_records', [1000])
+def test_benchmark_download_warc(tmp_path, db_url, num_records):
+    '''
+    Runs the full downloader (download_warc with load_pg) against the stand-in and the scratch database.
+    '''
+    data_dir = str(tmp_path)
+    files = mk_crawl(data_dir, num_records, f'{uuid.uuid4().hex}.bench.example.com')
+    before = metrics.REGISTRY.to_dict()
+    with CCServer(files) as server:
+        start = time.time()
+        downloader.download_warc(SURT, crawl=CRAWL, load_pg=True, write_warcfile=True, data_dir=data_dir, base_url=server.base_url, db_url=db_url)
+        runtime = time.time() - start
+    after = metrics.REGISTRY.to_dict()
+
+    inserted = after['counters']['ingest_pages_inserted_total'] - before['counters'].get('ingest_pages_inserted_total', 0)
+    assert inserted == num_records
+    rates = metrics_rates(before, after, runtime)
+    rates['total'] = num_records / runtime
+    log_rates(f'download_warc num_records={num_records}', rates)
+
+
+@pytest.mark.parametrize('num_records', [1000])
+def test_benchmark_insert_warc(tmp_path, db_url, num_records):
+    '''
+    Runs downloader_warc.insert_warc on local WARC files against the scratch database;
+    this path has no fetch stage.
+    '''
+    import downloader_warc
+    files = mk_crawl(str(tmp_path), num_records, f'{uuid.uuid4().hex}.bench.example.com')
+    warc_paths = []
+    for filename, data in files.items():
+        warc_path = str(tmp_path / os.path.basename(filename))
+        with open(warc_path, 'wb') as f:
+            f.write(data)
+        warc_paths.append(warc_path)
+
+    connection = sqlalchemy.create_engine(db_url).connect()
+    before = metrics.REGISTRY.to_dict()
+    start = time.time()
+    for warc_path in warc_paths:
+        downloader_warc.insert_warc(connection, warc_path)
+    runtime = time.time() - start
+    after = metrics.REGISTRY.to_dict()
+    connection.close()
+
+    rates = metrics_rates(before, after, runtime)
+    rates['total'] = num_records / runtime
+    log_rates(f'insert_warc num_records={num_records}', rates)
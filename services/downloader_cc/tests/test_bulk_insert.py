@@ -0,0 +1,183 @@
+'''
+Benchmarks the insert functions in ingest.py against a live postgres database.
+These tests only run when the POSTGRES_* environment variables are set (e.g. inside the downloader_cc container);
+all changes are made inside a transaction that is rolled back, so the database is left unmodified.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+
+import pytest
+import sqlalchemy
+
+import ingest
+
+pytestmark = pytest.mark.skipif('POSTGRES_USER' not in os.environ, reason='requires a postgres database')
+
+
+@pytest.fixture
+def engine():
+    dburl = f'postgresql://{os.environ["POSTGRES_USER"]}:{os.environ["POSTGRES_PASSWORD"]}@pg:5432/{os.environ["POSTGRES_NAME"]}'
+    return sqlalchemy.create_engine(dburl)
+
+
+@pytest.fixture
+def connection(engine):
+    connection = engine.connect()
+    transaction = connection.begin()
+    yield connection
+    transaction.rollback()
+    connection.close()
+
+
+def mk_pages(prefix, size):
+    pages = []
+    for i in range(size):
+        url = f'https://{prefix}.bench.example.com/article/{i}'
+        title = f'benchmark article {i}'
+        content = f'the\tcontent of\n{prefix} article {i} \\ with special characters'
+        page = ingest.Page(i, url, '2021-01-01T00:00:00Z', json.dumps({'title': {'best': {'value': title}}, 'content': content}))
+        page.language = 'en'
+        page.timestamp_published = '2021-01-01 00:00:00+00:00'
+        page.title = title
+        page.content = content
+        page.tsv_title = f'benchmark:1 article:2 {i}:3'
+        page.tsv_content = f'content:2 article:4 {i}:5'
+        pages.append(page)
+    return pages
+
+
+@pytest.mark.parametrize('batch_size', [100, 1000, 5000])
+def test_bulk_insert_benchmark(connection, batch_size):
+    rates = {}
+    for insert in [ingest.insert_values, ingest.insert_copy]:
+        prefix = f'{insert.__name__}-{batch_size}'
+        pages = mk_pages(prefix, batch_size)
+        start = time.time()
+        insert(connection, -1, pages)
+        rates[insert.__name__] = batch_size / (time.time() - start)
+
+        # both methods must insert the same rows
+        sql = sqlalchemy.sql.text('''
+        SELECT count(*) FROM metahtml WHERE url LIKE :pattern;
+        ''')
+        assert connection.execute(sql, {'pattern': f'https://{prefix}.%'}).scalar() == batch_size
+        sql = sqlalchemy.sql.text('''
+        SELECT count(*) FROM metahtml_view WHERE content = :content;
+        ''')
+        assert connection.execute(sql, {'content': pages[0].content}).scalar() == 1
+
+    logging.info(f'batch_size={batch_size}; ' + '; '.join(f'{name}={rate:.2f} rows/sec' for name, rate in rates.items()))
+
+
+@pytest.mark.parametrize('num_workers', [1, 2, 4, 8])
+def test_bulk_insert_workers_benchmark(engine, num_workers, num_batches=5, batch_size=1000):
+    '''
+    Each worker loads its own shard of the same source concurrently;
+    because the workers never update the same source_progress row,
+    the total throughput should grow with the number of workers.
+    '''
+    barrier = threading.Barrier(num_workers)
+    errors = []
+
+    def worker(shard):
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            sql = sqlalchemy.sql.text('''
+            INSERT INTO source_progress (id_source, shard) VALUES (-1, :shard);
+            ''')
+            connection.execute(sql, {'shard': shard})
+            barrier.wait()
+            for i in range(num_batches):
+                pages = mk_pages(f'workers-{num_workers}-{shard}-{i}', batch_size)
+                ingest.bulk_insert(connection, -1, pages, shard=shard)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            transaction.rollback()
+            connection.close()
+
+    threads = [ threading.Thread(target=worker, args=(shard,)) for shard in range(num_workers) ]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    runtime = time.time() - start
+
+    assert errors == []
+    logging.info(f'num_workers={num_workers}; rate={num_workers*num_batches*batch_size/runtime:.2f} rows/sec')
+
+
+def test_reprocess_upsert(connection):
+    '''
+    Rows produced by another metahtml version are found by find_stale and replaced by upsert_pages;
+    rows that are already up to date are left alone.
+    A page whose reparse raises an exception loses its metahtml_view row, and is not stale afterwards;
+    reparsing an older crawl of a hostpath never changes the view row, which was built from the newest crawl.
+    '''
+    import reprocess
+    pages = mk_pages('reprocess', 10)
+    for page in pages[:5]:
+        page.jsonb = json.dumps({'version': 'old'})
+    for page in pages[5:]:
+        page.jsonb = json.dumps({'version': 'new'})
+    ingest.insert_copy(connection, -1, pages)
+
+    keys = [ (page.position, page.url, page.accessed_at, None) for page in pages ]
+    assert reprocess.find_stale(connection, keys, json.dumps('new')) == set(range(5))
+
+    new_pages = mk_pages('reprocess', 5)
+    for page in new_pages:
+        page.jsonb = json.dumps({'version': 'new'})
+        page.title = 'reprocessed ' + page.title
+    new_pages[1] = ingest.Page(1, new_pages[1].url, new_pages[1].accessed_at, json.dumps({'exception': {'type': 'ValueError'}}))
+    reprocess.stamp_version(new_pages[1], json.dumps('new'))
+    reprocess.upsert_pages(connection, new_pages)
+    assert reprocess.find_stale(connection, keys, json.dumps('new')) == set()
+    sql = sqlalchemy.sql.text('''
+    SELECT count(*) FROM metahtml_view WHERE title LIKE 'reprocessed %' AND hostpath_surt = url_hostpath_surt(:url);
+    ''')
+    assert connection.execute(sql, {'url': new_pages[0].url}).scalar() == 1
+    sql = sqlalchemy.sql.text('''
+    SELECT count(*) FROM metahtml_view WHERE hostpath_surt = url_hostpath_surt(:url);
+    ''')
+    assert connection.execute(sql, {'url': new_pages[1].url}).scalar() == 0
+
+    older = mk_pages('reprocess', 3)[2]
+    older.position = 10
+    older.accessed_at = '2020-01-01T00:00:00Z'
+    older.jsonb = json.dumps({'version': 'new'})
+    older.title = 'older ' + older.title
+    ingest.insert_copy(connection, -1, [older])
+    reprocess.upsert_pages(connection, [older])
+    sql = sqlalchemy.sql.text('''
+    SELECT title FROM metahtml_view WHERE hostpath_surt = url_hostpath_surt(:url);
+    ''')
+    assert connection.execute(sql, {'url': older.url}).scalar() == 'reprocessed benchmark article 2'
+
+
+def test_check_sources(connection):
+    '''
+    download_warc must refuse to load a surt/crawl whose progress is stored under the old per-worker source names,
+    or under a different num_workers.
+    '''
+    import downloader
+    data_dir = '/tmp/test_check_sources'
+    downloader.check_sources(connection, 'com,example)', 'CC-MAIN-2021-04', 4, data_dir)
+    ingest.get_source(connection, data_dir + '/warc_new2/com,example)-CC-MAIN-2021-04-0001-of-0004.warc.gz')
+    with pytest.raises(ValueError, match='old downloader'):
+        downloader.check_sources(connection, 'com,example)', 'CC-MAIN-2021-04', 4, data_dir)
+
+    source_name = data_dir + '/warc_new2/com,example)-CC-MAIN-2021-05-of-0004'
+    id_source, urls_inserted, finished_at = ingest.get_source(connection, source_name, shard=2)
+    connection.execute(sqlalchemy.sql.text('''
+    UPDATE source_progress SET urls_inserted = 10 WHERE id_source = :id_source;
+    '''), {'id_source': id_source})
+    downloader.check_sources(connection, 'com,example)', 'CC-MAIN-2021-05', 4, data_dir)
+    with pytest.raises(ValueError, match='different num_workers'):
+        downloader.check_sources(connection, 'com,example)', 'CC-MAIN-2021-05', 8, data_dir)
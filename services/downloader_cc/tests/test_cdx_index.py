@@ -0,0 +1,119 @@
+import asyncio
+import gzip
+import logging
+import random
+import time
+
+import pytest
+
+import cdx_index
+from tests.cc_standin import CCServer
+
+
+def test_locate_blocks(tmp_path):
+    '''
+    Compares the binary search against a linear scan of a random index.
+    '''
+    random.seed(0)
+    keys = sorted(set(
+        ''.join(random.choice('abc,)/') for i in range(random.randint(1, 6)))
+        for j in range(500)
+        ))
+    lines = [ f'{key} 20210101000000\tcdx-{i//100:05}.gz\t{i}\t1\t{i}' for i, key in enumerate(keys) ]
+    idx_path = tmp_path / 'cluster.idx'
+    idx_path.write_text('\n'.join(lines) + '\n')
+
+    for surt in keys[::7] + ['', 'a', 'c)', 'zzz']:
+        # a block is needed if the range of keys it covers overlaps the keys with the surt prefix
+        expected = []
+        for i, key in enumerate(keys):
+            next_key = keys[i+1] if i+1 < len(keys) else None
+            if (key.startswith(surt)
+                    or (key < surt and (next_key is None or next_key >= surt))):
+                expected.append((f'cdx-{i//100:05}.gz', i, 1))
+        assert cdx_index.locate_blocks(idx_path, surt) == expected, surt
+
+
+def mk_cdx_files(tmp_path, crawl, num_files=4, blocks_per_file=25, lines_per_block=100):
+    '''
+    Creates a fake cluster.idx in tmp_path and returns the fake CDX files it indexes together with their sorted lines.
+    Just like in the common crawl, each block of a CDX file is a separate gzip member.
+    '''
+    hosts = [ f'com,host{i:03})' for i in range(num_files * blocks_per_file * lines_per_block // 50) ]
+    lines = sorted(
+        f'{host}/page{j:02} 20210101000000 {{"url": "https://{host}/page{j:02}"}}'
+        for host in hosts
+        for j in range(50)
+        )
+    files = {}
+    idx_lines = []
+    prefix = f'cc-index/collections/{crawl}/indexes/'
+    for i in range(num_files):
+        filename = f'cdx-{i:05}.gz'
+        data = b''
+        for j in range(blocks_per_file):
+            k = (i * blocks_per_file + j) * lines_per_block
+            block_lines = lines[k:k+lines_per_block]
+            block = gzip.compress(''.join(line + '\n' for line in block_lines).encode())
+            idx_lines.append(f'{block_lines[0].split(" ")[0]} 20210101000000\t{filename}\t{len(data)}\t{len(block)}\t{len(idx_lines)}')
+            data += block
+        files[prefix + filename] = data
+
+    idx_dir = tmp_path / prefix
+    idx_dir.mkdir(parents=True)
+    (idx_dir / 'cluster.idx').write_text('\n'.join(idx_lines) + '\n')
+    return files, lines
+
+
+@pytest.mark.parametrize('semsize', [1, 100])
+def test_download_cdx(tmp_path, semsize):
+    '''
+    Checks that download_cdx extracts exactly the lines for the surt;
+    semsize=1 downloads one block at a time (like the old shell script) and serves as the baseline for the timing.
+    '''
+    crawl = 'CC-MAIN-2021-04'
+    files, lines = mk_cdx_files(tmp_path, crawl)
+    with CCServer(files) as server:
+        for surt in ['com,host0', 'com,host012)', 'com,host999']:
+            start = time.perf_counter()
+            outfile = cdx_index.download_cdx(crawl, surt, data_dir=str(tmp_path), semsize=semsize, base_url=server.base_url)
+            runtime = time.perf_counter() - start
+            with gzip.open(outfile, 'rt') as f:
+                assert f.read().splitlines() == [ line for line in lines if line.startswith(surt) ]
+            logging.info(f'semsize={semsize}, surt={surt}, runtime={runtime:0.4f}')
+
+        # existing outputs are not downloaded again
+        requests = server.stats['requests']
+        cdx_index.download_cdx(crawl, 'com,host0', data_dir=str(tmp_path), base_url=server.base_url)
+        assert server.stats['requests'] == requests
+    assert [ path.name for path in (tmp_path / 'cdx' / 'com,host0').iterdir() ] == [f'com,host0-{crawl}.cdx.gz']
+
+
+def test_download_cdx_missing(tmp_path):
+    '''
+    A block that can never be downloaded (here a 404) must fail immediately instead of being retried forever,
+    and must not leave a temporary file behind.
+    '''
+    crawl = 'CC-MAIN-2021-04'
+    files, lines = mk_cdx_files(tmp_path, crawl)
+    files.pop(f'cc-index/collections/{crawl}/indexes/cdx-00000.gz')
+    with CCServer(files) as server:
+        with pytest.raises(cdx_index.FetchError, match='status=404'):
+            cdx_index.download_cdx(crawl, 'com,host0', data_dir=str(tmp_path), base_url=server.base_url)
+    assert list((tmp_path / 'cdx' / 'com,host0').iterdir()) == []
+
+
+@pytest.mark.parametrize('window', [1, 3])
+def test_fetch_blocks_window(tmp_path, window):
+    '''
+    The blocks are written in order even when the window is smaller than the number of downloads allowed in flight.
+    '''
+    crawl = 'CC-MAIN-2021-04'
+    files, lines = mk_cdx_files(tmp_path, crawl)
+    blocks = cdx_index.locate_blocks(tmp_path / f'cc-index/collections/{crawl}/indexes/cluster.idx', 'com,host0')
+    written = []
+    with CCServer(files) as server:
+        url_prefix = server.base_url + f'cc-index/collections/{crawl}/indexes/'
+        num_lines = asyncio.run(cdx_index.fetch_blocks(blocks, url_prefix, 'com,host0', written.extend, semsize=10, window=window))
+    assert [ line.decode() for line in written ] == [ line for line in lines if line.startswith('com,host0') ]
+    assert num_lines == len(written)
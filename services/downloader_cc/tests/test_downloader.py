@@ -0,0 +1,483 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+import aiohttp
+import pytest
+
+import downloader
+import metrics
+import warc_cache
+import warc_index
+from warc_cache import RangeCache
+from tests.cc_standin import CCServer
+
+
+def mk_warc_files(num_files=4, records_per_file=200, record_size=1024):
+    '''
+    Returns a dictionary of fake warc files and a list of cdx entries that index into them.
+    Each record is a separate gzip member, just like in the common crawl.
+    '''
+    files = {}
+    cdx = []
+    for i in range(num_files):
+        filename = f'crawl-data/segment/warc/file{i}.warc.gz'
+        data = b''
+        for j in range(records_per_file):
+            record = gzip.compress(f'{filename} record {j} '.encode().ljust(record_size, b'x'))
+            cdx.append({
+                'filename': filename,
+                'offset': str(len(data)),
+                'length': str(len(record)),
+                })
+            data += record
+        files[filename] = data
+    return files, cdx
+
+
+def test_get_pooled():
+    '''
+    Compares the old behavior (one session per request) against a single pooled session.
+    The pooled session should serve every request over far fewer connections.
+    '''
+    files, cdx = mk_warc_files()
+
+    async def get_unpooled(url, offset, length):
+        async with aiohttp.ClientSession() as session:
+            return await downloader.get(session, url, offset, length)
+
+    async def run(server, pooled):
+        session = await downloader.mk_session(limit=20)
+        try:
+            tasks = []
+            for data in cdx:
+                url = server.base_url + data['filename']
+                if pooled:
+                    tasks.append(downloader.get(session, url, data['offset'], data['length']))
+                else:
+                    tasks.append(get_unpooled(url, data['offset'], data['length']))
+            return await asyncio.gather(*tasks)
+        finally:
+            await session.close()
+
+    stats = {}
+    for pooled in [False, True]:
+        with CCServer(files) as server:
+            start = time.time()
+            contents = asyncio.run(run(server, pooled))
+            runtime = time.time() - start
+            stats[pooled] = dict(server.stats)
+            logging.info(f'pooled={pooled}; requests/sec={len(cdx)/runtime:.2f}; server.stats={server.stats}')
+
+        # every range must decompress to the correct record
+        for data, content in zip(cdx, contents):
+            assert gzip.decompress(content).startswith(data['filename'].encode())
+
+    assert stats[False]['connections'] == len(cdx)
+    assert stats[True]['connections'] <= 20
+
+
+@pytest.mark.parametrize('max_gap', [None, 4096])
+def test_cdxiter_to_warcitr(max_gap):
+    files, cdx = mk_warc_files()
+    with CCServer(files) as server:
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, max_gap=max_gap, base_url=server.base_url)
+        contents = sorted(gzip.decompress(content) for content in warcitr)
+        assert contents == sorted(gzip.decompress(files[data['filename']][int(data['offset']):int(data['offset'])+int(data['length'])]) for data in cdx)
+        assert server.stats['connections'] <= 10
+
+        # merging adjacent records should reduce the number of requests to one per file
+        if max_gap is None:
+            assert server.stats['requests'] == len(cdx)
+        else:
+            assert server.stats['requests'] == len(files)
+
+
+@pytest.mark.parametrize('max_gap', [None, 4096])
+def test_cdxiter_to_warcitr_ordered(max_gap):
+    files, cdx = mk_warc_files()
+
+    # interleave the files so that the merged ranges are out of order with respect to the cdx entries
+    cdx.sort(key=lambda data: (int(data['offset']), data['filename']))
+
+    stats = Counter()
+    with CCServer(files) as server:
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, batchsize=100, max_gap=max_gap, ordered=True, stats=stats, base_url=server.base_url)
+        for data, content in zip(cdx, warcitr):
+            assert gzip.decompress(content).startswith(data['filename'].encode())
+    assert stats['urls_downloaded'] == len(cdx)
+
+
+def test_cdxiter_to_warcitr_reader():
+    '''
+    The cdxiter must never be read on the event loop's thread,
+    and an exception from the cdxiter must be raised in the consumer.
+    '''
+    files, cdx = mk_warc_files()
+    on_loop = []
+    def cdxiter(fail=False):
+        for data in cdx:
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(data)
+            except RuntimeError:
+                pass
+            yield data
+        if fail:
+            raise ValueError('bad cdx file')
+
+    with CCServer(files) as server:
+        warcitr = downloader.cdxiter_to_warcitr(cdxiter(), semsize=10, ordered=True, base_url=server.base_url)
+        assert len(list(warcitr)) == len(cdx)
+        assert on_loop == []
+        with pytest.raises(ValueError, match='bad cdx file'):
+            list(downloader.cdxiter_to_warcitr(cdxiter(fail=True), semsize=10, base_url=server.base_url))
+
+
+def test_cdxiter_to_warcitr_close():
+    '''
+    The consumer may stop iterating before all downloads have finished;
+    this should stop the background thread without hanging.
+    '''
+    files, cdx = mk_warc_files()
+    with CCServer(files) as server:
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, max_gap=None, queuesize=1, base_url=server.base_url)
+        next(warcitr)
+        warcitr.close()
+        assert server.stats['requests'] < len(cdx)
+
+
+def test_cdxiter_to_warcitr_close_slow(tmp_path):
+    '''
+    Stopping must cancel the requests in flight instead of waiting for a slow server to answer them;
+    the first entry is cached, so it arrives while the other requests are still waiting on the server.
+    '''
+    files, cdx = mk_warc_files()
+    cache = RangeCache(str(tmp_path))
+    data = cdx[0]
+    cache.put(data['filename'], int(data['offset']), int(data['length']), files[data['filename']][int(data['offset']):int(data['offset'])+int(data['length'])])
+    with CCServer(files, delay=5) as server:
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, max_gap=None, cache=cache, base_url=server.base_url)
+        next(warcitr)
+        start = time.time()
+        warcitr.close()
+        assert time.time() - start < 2
+
+
+def test_cdxiter_to_warcitr_cache(tmp_path):
+    '''
+    A second pass over the same cdx entries should be served entirely from the cache,
+    and a pass over a partially cached range should download only the uncached span.
+    '''
+    files, cdx = mk_warc_files()
+    cache = RangeCache(str(tmp_path))
+    expected = sorted(files[data['filename']][int(data['offset']):int(data['offset'])+int(data['length'])] for data in cdx)
+    with CCServer(files) as server:
+        stats0 = Counter()
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx[:100]), semsize=10, stats=stats0, cache=cache, base_url=server.base_url)
+        assert len(list(warcitr)) == 100
+        assert stats0['cache_misses'] == 100
+
+        stats1 = Counter()
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, stats=stats1, cache=cache, base_url=server.base_url)
+        assert sorted(warcitr) == expected
+        assert stats1['cache_hits'] == 100
+        assert stats1['cache_misses'] == len(cdx) - 100
+        assert stats1['cache_bytes_saved'] == sum(int(data['length']) for data in cdx[:100])
+        requests = server.stats['requests']
+
+        stats2 = Counter()
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, stats=stats2, cache=cache, base_url=server.base_url)
+        assert sorted(warcitr) == expected
+        assert server.stats['requests'] == requests
+        assert stats2['cache_hits'] == len(cdx)
+        assert stats2['requests_made'] == 0
+
+
+def test_cdxiter_to_warcitr_metrics():
+    '''
+    The downloads must be visible on the metrics endpoint.
+    '''
+    import urllib.request
+    files, cdx = mk_warc_files()
+    registry = metrics.Registry()
+    metrics_server = metrics.serve(0, registry=registry)
+    metrics.REGISTRY, old_registry = registry, metrics.REGISTRY
+    try:
+        with CCServer(files) as server:
+            warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=10, max_gap=None, base_url=server.base_url)
+            assert len(list(warcitr)) == len(cdx)
+        assert registry.counters[('downloader_requests_total', ())] == len(cdx)
+        assert registry.counters[('downloader_bytes_total', ())] == sum(int(data['length']) for data in cdx)
+        assert registry.histograms[('downloader_request_seconds', ())]['count'] == len(cdx)
+
+        port = metrics_server.server_address[1]
+        text = urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics').read().decode()
+        assert f'downloader_requests_total {len(cdx)}' in text
+        assert 'downloader_in_flight 0' in text
+    finally:
+        metrics.REGISTRY = old_registry
+        metrics_server.shutdown()
+
+
+def mk_warc_record(url, html):
+    '''
+    Returns a single gzipped WARC response record, in the same format as the entries in the common crawl.
+    '''
+    from warcio.statusandheaders import StatusAndHeaders
+    from warcio.warcwriter import WARCWriter
+    output = io.BytesIO()
+    writer = WARCWriter(output, gzip=True)
+    http_headers = StatusAndHeaders('200 OK', [('Content-Type', 'text/html')], protocol='HTTP/1.1')
+    record = writer.create_warc_record(url, 'response', payload=io.BytesIO(html), http_headers=http_headers)
+    writer.write_record(record)
+    return output.getvalue()
+
+
+def test_warcitr_to_recorditr():
+    '''
+    Entries that cannot be parsed must still produce an output
+    so that positions in the recorditr match positions in the cdxiter.
+    '''
+    warcitr = [
+        mk_warc_record('https://example.com/0', b'<html>0</html>'),
+        b'not a gzip file',
+        mk_warc_record('https://example.com/2', b'<html>2</html>'),
+        ]
+    # the record contents must be read before advancing the iterator
+    htmls = []
+    for record in downloader.warcitr_to_recorditr(warcitr):
+        htmls.append(None if record is None else record.content_stream().read())
+    assert htmls == [b'<html>0</html>', None, b'<html>2</html>']
+
+
+
+def test_warcitr_to_warcfile_index(tmp_path):
+    '''
+    The sidecar index must let us read back any single record without scanning the WARC file.
+    '''
+    warcitr = [ mk_warc_record(f'https://www.example.com/{i}', f'<html>{i}</html>'.encode()) for i in range(100) ]
+    warc_path = str(tmp_path / 'test.warc.gz')
+    assert list(downloader.warcitr_to_warcfile(warcitr, warc_path, flush_every=7)) == warcitr
+
+    index = list(warc_index.read_index(warc_path))
+    assert [ entry['surt'] for entry in index ] == sorted(f'com,example)/{i}' for i in range(100))
+    index = { entry['url']: entry for entry in index }
+    assert index['https://www.example.com/42']['surt'] == 'com,example)/42'
+    assert index['https://www.example.com/42']['digest'].startswith('sha1:')
+    assert warc_index.lookup(warc_path, url='https://www.example.com/420') == []
+    assert warc_index.lookup(warc_path, surt='com,example)/7') == [warcitr[7]]
+
+    entries = warc_index.lookup(warc_path, url='https://www.example.com/42')
+    assert entries == [warcitr[42]]
+    for record in downloader.warcitr_to_recorditr(entries):
+        assert record.content_stream().read() == b'<html>42</html>'
+
+
+def test_warcitr_to_warcfile_flush_order(tmp_path):
+    '''
+    While the files are being written, the index on disk must only refer to records that are already in the WARC file on disk.
+    '''
+    warcitr = [ mk_warc_record(f'https://www.example.com/{i}', f'<html>{i}</html>'.encode()) for i in range(20) ]
+    warc_path = str(tmp_path / 'test.warc.gz')
+    entries = downloader.warcitr_to_warcfile(iter(warcitr), warc_path, flush_every=7)
+    for i in range(10):
+        next(entries)
+    with open(warc_path + '.idx') as f:
+        lines = [ line.split('\t') for line in f ]
+    assert len(lines) == 7
+    assert max(int(fields[2]) + int(fields[3]) for fields in lines) <= os.path.getsize(warc_path)
+    entries.close()
+    assert len(list(warc_index.read_index(warc_path))) == 10
+
+
+def mk_cdx_file(path, num_lines):
+    '''
+    Writes a synthetic cdx file with num_lines entries in the common crawl's format;
+    roughly a third of the entries will be removed by the mime/status filters.
+    '''
+    mimes = ['text/html', 'text/html', 'text/html', 'application/pdf', 'image/jpeg']
+    statuses = ['200', '200', '200', '200', '301', '404']
+    with gzip.open(path, 'wt') as f:
+        for i in range(num_lines):
+            url = f'https://www.example.com/section{i%97}/article{i}.html'
+            f.write(
+                f'com,example)/section{i%97}/article{i}.html 20210101{i%1000000:06} '
+                f'{{"url": "{url}", "mime": "{mimes[i%len(mimes)]}", "mime-detected": "{mimes[i%len(mimes)]}", '
+                f'"status": "{statuses[i%len(statuses)]}", "digest": "ABCDEFGHIJKLMNOPQRSTUVWXYZ{i:06}", '
+                f'"length": "{10000+i%5000}", "offset": "{i*20000}", '
+                f'"filename": "crawl-data/CC-MAIN-2021-04/segments/{i%100}/warc/CC-MAIN-{i%640:05}.warc.gz", '
+                f'"charset": "UTF-8", "languages": "eng"}}\n'
+                )
+
+
+# the large benchmarks take minutes, and so they only run when the RUN_BENCHMARKS environment variable is set
+large_benchmark = pytest.mark.skipif('RUN_BENCHMARKS' not in os.environ, reason='set RUN_BENCHMARKS to run the large benchmarks')
+
+
+@pytest.mark.parametrize('num_lines', [10**5, pytest.param(2*10**6, marks=large_benchmark)])
+def test_mk_cdxiter_benchmark(tmp_path, num_lines):
+    '''
+    Compares parsing the raw cdx lines with prefiltering against fully json decoding every line;
+    the small case checks that both paths give the same entries.
+    '''
+    path = tmp_path / 'bench.cdx.gz'
+    mk_cdx_file(path, num_lines)
+
+    results = {}
+    runtimes = {}
+    for prefilter in [False, True]:
+        start = time.perf_counter()
+        results[prefilter] = list(downloader.mk_cdxiter([path], prefilter=prefilter))
+        runtimes[prefilter] = time.perf_counter() - start
+        logging.info(f'num_lines={num_lines}, prefilter={prefilter}, runtime={runtimes[prefilter]:0.2f}, lines/sec={num_lines/runtimes[prefilter]:0.0f}')
+
+    # both paths must keep the same entries with the same values
+    assert len(results[True]) == len(results[False]) > 0
+    for fast, slow in zip(results[True], results[False]):
+        assert fast == { k: slow[k] for k in downloader.CDX_FIELDS }
+    logging.info(f'num_lines={num_lines}, speedup={runtimes[False]/runtimes[True]:0.2f}')
+
+
+def test_mk_cdxiter_bloom(tmp_path, caplog, monkeypatch):
+    '''
+    The BloomFilter dedup must never keep a duplicate,
+    and should drop only about the estimated number of new urls;
+    the filters are allocated once per call, not once per cdx file.
+    '''
+    allocations = []
+    class BloomFilter(downloader.BloomFilter):
+        def __init__(self, *args):
+            allocations.append(args)
+            super().__init__(*args)
+    monkeypatch.setattr(downloader, 'BloomFilter', BloomFilter)
+
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'{i}.cdx.gz'
+        mk_cdx_file(path, 20000)
+        paths.append(path)
+    exact = list(downloader.mk_cdxiter(paths, dedup_error_rate=None))
+    assert len(exact) > 0
+
+    for dedup_capacity in [10**5, 2000]:
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            allocations.clear()
+            bloom = list(downloader.mk_cdxiter(paths, dedup_capacity=dedup_capacity, dedup_error_rate=0.01))
+        assert len(allocations) == 2
+        urls = [ x['url'] for x in bloom ]
+        assert len(urls) == len(set(urls))
+        assert set(urls) <= set(x['url'] for x in exact)
+
+        false_positives = len(exact) - len(bloom)
+        message = [ r.message for r in caplog.records if 'false_positives' in r.message ][0]
+        estimate = float(message.split('~= ')[1].split()[0])
+        logging.info(f'dedup_capacity={dedup_capacity}, false_positives={false_positives}, estimate={estimate:0.2f}')
+        assert false_positives <= 3*estimate + 5
+
+
+def test_plan_shards(tmp_path):
+    '''
+    The workers must partition exactly the entries of an unsharded run,
+    and reading the planned shard files must give the same entries as skipping lines on the fly.
+    '''
+    surt = 'com,example)'
+    cdx_dir = tmp_path / 'cdx' / surt
+    cdx_dir.mkdir(parents=True)
+    for crawl in ['CC-MAIN-2020-05', 'CC-MAIN-2021-04']:
+        mk_cdx_file(cdx_dir / f'{surt}-{crawl}.cdx.gz', 5000)
+    data_dir = str(tmp_path)
+    cdx_paths = downloader.get_cdx_paths(surt, data_dir=data_dir)
+    expected = list(downloader.mk_cdxiter(cdx_paths, dedup_error_rate=None))
+
+    num_workers = 4
+    downloader.plan_shards(surt, num_workers=num_workers, data_dir=data_dir)
+    entries = []
+    for worker in range(num_workers):
+        skipped = list(downloader.mk_cdxiter(cdx_paths, dedup_error_rate=None, worker=worker, num_workers=num_workers))
+        shard_paths = [ downloader.get_shard_path(cdx_path, worker, num_workers, data_dir) for cdx_path in cdx_paths ]
+        planned = list(downloader.mk_cdxiter(shard_paths, dedup_error_rate=None))
+        assert skipped == planned
+        assert len(planned) > 0
+        entries.extend(planned)
+
+    key = lambda x: (x['filename'], x['offset'])
+    assert sorted(entries, key=key) == sorted(expected, key=key)
+
+
+def test_cdxiter_to_warcitr_throttled(tmp_path):
+    '''
+    A server that answers `503 Slow Down` whenever it is overloaded should make the limiter back off,
+    while still delivering every entry;
+    entries that can never be downloaded should go to the dead letter file.
+    '''
+    files, cdx = mk_warc_files()
+    missing = [ dict(data, filename='crawl-data/segment/warc/missing.warc.gz') for data in cdx[:3] ]
+    cdx = missing + cdx
+    dead_letter_path = str(tmp_path / 'dead_letter.jsonl')
+    limiter = downloader.AdaptiveLimiter(initial=50, max_limit=100, cooldown=0.05)
+    stats = Counter()
+    with CCServer(files, max_concurrent=8, delay=0.01) as server:
+        warcitr = downloader.cdxiter_to_warcitr(iter(cdx), semsize=100, max_gap=None, ordered=True, stats=stats, limiter=limiter, max_attempts=20, dead_letter_path=dead_letter_path, base_url=server.base_url)
+        contents = list(warcitr)
+        logging.info(f'server.stats={server.stats}; limiter.limit={limiter.limit}')
+        assert server.stats['throttled'] > 0
+
+    # the limiter should settle near the server's capacity
+    assert limiter.limit < 50
+    assert contents[:3] == [None, None, None]
+    for data, content in zip(cdx[3:], contents[3:]):
+        assert gzip.decompress(content).startswith(data['filename'].encode())
+    assert stats['dead_letters'] == 3
+    with open(dead_letter_path) as f:
+        assert [ json.loads(line)['filename'] for line in f ] == [ data['filename'] for data in missing ]
+
+
+def test_warcitr_to_warcfile_append(tmp_path):
+    '''
+    After a crash, appending must keep every record already in the file,
+    index the records that were written without their index lines,
+    and drop a partially written record.
+    '''
+    warcitr = [ mk_warc_record(f'https://www.example.com/{i}', f'<html>{i}</html>'.encode()) for i in range(30) ]
+    warc_path = str(tmp_path / 'test.warc.gz')
+    list(downloader.warcitr_to_warcfile(warcitr[:20], warc_path))
+
+    # simulate the crash;
+    # before the crash, the index is still in the order of the WARC file
+    with open(warc_path, 'ab') as f:
+        f.write(warcitr[20][:len(warcitr[20])//2])
+    with open(warc_path + '.idx') as f:
+        lines = sorted(f.readlines(), key=lambda line: int(line.split('\t')[2]))
+    with open(warc_path + '.idx', 'w') as f:
+        f.writelines(lines[:15])
+        f.write(lines[15][:10])
+
+    assert list(downloader.warcitr_to_warcfile(warcitr[20:], warc_path, append=True)) == warcitr[20:]
+    index = list(warc_index.read_index(warc_path))
+    assert [ entry['surt'] for entry in index ] == sorted(f'com,example)/{i}' for i in range(30))
+    for i in [0, 17, 20, 29]:
+        assert warc_index.lookup(warc_path, url=f'https://www.example.com/{i}') == [warcitr[i]]
+
+
+def test_range_cache_overwrite(tmp_path):
+    '''
+    Overwriting a record must not count its size twice,
+    and the eviction must never remove another writer's temporary files.
+    '''
+    cache = RangeCache(str(tmp_path), max_bytes=100)
+    cache.put('a.warc.gz', 0, 10, b'0123456789')
+    cache.put('a.warc.gz', 0, 10, b'0123456789')
+    assert cache.total_bytes == 10
+
+    tmp_file = tmp_path / warc_cache.TMP_PREFIX
+    tmp_file.write_bytes(b'x' * 1000)
+    cache.evict()
+    assert tmp_file.exists()
+    assert cache.total_bytes == 10
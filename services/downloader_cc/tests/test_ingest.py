@@ -0,0 +1,69 @@
+import psycopg2
+import pytest
+import sqlalchemy
+
+import ingest
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_map_parse_page(num_workers, ordered):
+    pages = [ (i, f'https://example.com/{i}', '2021-01-01T00:00:00Z', f'<html><title>{i}</title></html>'.encode()) for i in range(50) ]
+    pages[7] = (7, None, None, None)
+    results = list(ingest.parallel_map(ingest.parse_page, pages, num_workers=num_workers, ordered=ordered, queuesize=4))
+    if not ordered:
+        results.sort(key=lambda page: page.position)
+    assert [ page.position for page in results ] == list(range(50))
+    assert results[7].jsonb is None
+    for page in results[8:]:
+        assert page.url == f'https://example.com/{page.position}'
+        assert isinstance(page.jsonb, str)
+
+
+def test_parse_page_lemma_cache(monkeypatch):
+    '''
+    Pages that share a title are only lemmatized once.
+    '''
+    def parse(html, url):
+        return {
+            'language': {'best': {'value': 'en'}},
+            'timestamp.published': {'best': {'value': {'lo': None}}},
+            'title': {'best': {'value': 'the shared title'}},
+            'description': {'best': {'value': None}},
+            'content': {'best': {'value': {'html': html.decode(), 'text': html.decode()}}},
+            }
+    calls = []
+    def lemmatize(lang, text):
+        calls.append(text)
+        return text
+    monkeypatch.setattr(ingest.metahtml, 'parse', parse)
+    monkeypatch.setattr(ingest, 'lemma_cache', ingest.LemmaCache(lemmatize))
+
+    pages = [ ingest.parse_page((i, f'https://example.com/{i}', '2021-01-01T00:00:00Z', f'content {i%5}'.encode())) for i in range(20) ]
+    assert [ page.tsv_title for page in pages ] == ['the shared title'] * 20
+    assert [ page.tsv_content for page in pages ] == [ f'content {i%5}' for i in range(20) ]
+    assert len(calls) == 6
+    assert sum(page.lemmatize_cache_hits for page in pages) == 34
+    assert ingest.lemma_cache.hit_rate == 34 / 40
+
+
+def test_retry_deadlocks(monkeypatch):
+    '''
+    Deadlocks are retried both when sqlalchemy wraps them and when they come directly from psycopg2 (as in copy_rows);
+    other errors are raised.
+    '''
+    monkeypatch.setattr(ingest.time, 'sleep', lambda sleep_time: None)
+    errors = [
+        psycopg2.errors.DeadlockDetected(),
+        sqlalchemy.exc.OperationalError('INSERT', {}, psycopg2.errors.DeadlockDetected()),
+        ]
+    def func():
+        if errors:
+            raise errors.pop()
+        return 'done'
+    assert ingest.retry_deadlocks(func) == 'done'
+
+    def func():
+        raise sqlalchemy.exc.OperationalError('INSERT', {}, psycopg2.errors.QueryCanceled())
+    with pytest.raises(sqlalchemy.exc.OperationalError):
+        ingest.retry_deadlocks(func)
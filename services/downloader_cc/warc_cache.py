@@ -0,0 +1,164 @@
+'''
+An on-disk cache of WARC records downloaded from the common crawl.
+
+Every record is stored in its own file, named by a hash of the record's (filename, offset, length) triple,
+inside a two-level sharded directory so that no single directory grows too large.
+The files of the common crawl never change, so a cached record never needs to be invalidated;
+it only needs to be evicted when the cache grows beyond its size limit.
+
+The cache can be shared by many processes:
+files are written to a temporary name and then renamed into place,
+and the eviction rescans the directory so that it sees the files written by every process.
+
+All of the methods do blocking file I/O,
+so async code should call them with loop.run_in_executor;
+they are thread-safe.
+'''
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import Counter
+
+
+# the prefix of the temporary files written by RangeCache.put
+TMP_PREFIX = '.tmp'
+
+
+class RangeCache:
+    '''
+    A size-bounded cache with LRU eviction.
+
+    >>> cache = RangeCache(tempfile.mkdtemp(), max_bytes=25)
+    >>> cache.get('a.warc.gz', 0, 10) is None
+    True
+    >>> cache.put('a.warc.gz', 0, 10, b'0123456789')
+    >>> cache.get('a.warc.gz', 0, 10)
+    b'0123456789'
+    >>> dict(cache.stats)
+    {'misses': 1, 'hits': 1, 'bytes_saved': 10}
+
+    When the cache is over max_bytes, the least recently used records are evicted
+    (the sleeps ensure that the file mtimes differ):
+
+    >>> cache.put('a.warc.gz', 10, 10, b'abcdefghij'); time.sleep(0.1)
+    >>> _ = cache.get('a.warc.gz', 0, 10); time.sleep(0.1)
+    >>> cache.put('a.warc.gz', 20, 10, b'ABCDEFGHIJ')
+    >>> cache.get('a.warc.gz', 10, 10) is None
+    True
+    >>> cache.get('a.warc.gz', 0, 10)
+    b'0123456789'
+    '''
+
+    def __init__(self, cache_dir, max_bytes=100*1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # scanning a large cache directory is slow,
+        # so the size of the cache is only computed by the first put
+        self.total_bytes = None
+
+    def _path(self, filename, offset, length):
+        key = hashlib.sha1(f'{filename}:{offset}:{length}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key)
+
+    def _scan(self):
+        '''
+        Returns a list of (path, size, mtime) tuples for every record in the cache.
+        '''
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                # skip the temporary files that are still being written by put
+                if filename.startswith(TMP_PREFIX):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, filename, offset, length):
+        '''
+        Returns the cached bytes of the record, or None if the record is not in the cache.
+        '''
+        path = self._path(filename, offset, length)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the mtime of a file is its last access time for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.stats['misses'] += 1
+            return None
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += len(data)
+        return data
+
+    def put(self, filename, offset, length, data):
+        '''
+        Stores the bytes of a record in the cache, evicting old records if needed.
+        '''
+        path = self._path(filename, offset, length)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        # overwriting a record (e.g. one that another process also downloaded) must not count its size twice
+        try:
+            old_size = os.stat(path).st_size
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for path, size, mtime in self._scan())
+            else:
+                self.total_bytes += len(data) - old_size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self, ratio=0.9):
+        '''
+        Removes the least recently used records until the cache uses at most ratio*max_bytes;
+        evicting below max_bytes means that the directory doesn't need to be rescanned on every put.
+        '''
+        # only one thread evicts at a time; the others keep using the cache
+        if not self.evict_lock.acquire(blocking=False):
+            return
+        try:
+            start = time.time()
+            entries = self._scan()
+            entries.sort(key=lambda entry: entry[2])
+            total_bytes = sum(size for path, size, mtime in entries)
+            evictions = 0
+            for path, size, mtime in entries:
+                if total_bytes <= ratio * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                evictions += 1
+            with self.lock:
+                self.total_bytes = total_bytes
+                self.stats['evictions'] += evictions
+        finally:
+            self.evict_lock.release()
+        logging.info(f'RangeCache.evict: total_bytes={self.total_bytes}, evictions={self.stats["evictions"]}, runtime={time.time()-start:0.2f}')
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+'''
+A sidecar index for the WARC files written by downloader.py.
+
+For every WARC file `X.warc.gz`, the file `X.warc.gz.idx` contains one line per record with the tab-separated fields
+
+    surt    url    offset    length    digest
+
+where offset and length are the position of the record's gzip member within the WARC file.
+The index is written at the same time as the WARC file (see downloader.warcitr_to_warcfile),
+and is sorted by SURT when the WARC file is closed,
+so we can binary search it for a url and then seek directly to the record
+instead of decompressing the whole WARC file.
+'''
+
+import logging
+import mmap
+import os
+import zlib
+
+from urllib.parse import urlsplit
+
+
+def url_to_surt(url):
+    '''
+    Returns the SURT form of url, in (approximately) the same format as the keys of the common crawl's cdx files.
+
+    >>> url_to_surt('https://www.Example.com/path/a.html?b=1')
+    'com,example)/path/a.html?b=1'
+    >>> url_to_surt('http://news.example.co.uk:8080/')
+    'uk,co,example,news:8080)/'
+    '''
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    surt = ','.join(reversed(host.split('.')))
+    if parts.port is not None:
+        surt += f':{parts.port}'
+    surt += ')' + (parts.path or '/').lower()
+    if parts.query:
+        surt += '?' + parts.query.lower()
+    return surt
+
+
+def warc_entry_headers(warc_entry, chunk_size=4096):
+    '''
+    Returns a dictionary of the WARC headers of a gzipped WARC record;
+    only the beginning of the record is decompressed.
+    '''
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data = decompressor.decompress(warc_entry, chunk_size)
+    while b'\r\n\r\n' not in data and decompressor.unconsumed_tail:
+        data += decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    headers = {}
+    for line in data.split(b'\r\n\r\n', 1)[0].split(b'\r\n')[1:]:
+        key, _, value = line.decode('utf-8', errors='replace').partition(':')
+        headers[key.strip()] = value.strip()
+    return headers
+
+
+def index_line(warc_entry, offset):
+    '''
+    Returns the line of the sidecar index for a gzipped WARC record that starts at `offset` in the WARC file.
+    '''
+    try:
+        headers = warc_entry_headers(warc_entry)
+    except zlib.error:
+        logging.warning(f'zlib.error in the WARC record at offset={offset}')
+        headers = {}
+    url = headers.get('WARC-Target-URI', '')
+    digest = headers.get('WARC-Payload-Digest', headers.get('WARC-Block-Digest', ''))
+    return f'{url_to_surt(url)}\t{url}\t{offset}\t{len(warc_entry)}\t{digest}\n'
+
+
+def read_index(warc_path):
+    '''
+    Generator function that yields a dictionary for each record in the sidecar index of warc_path.
+
+    Index lines that point past the end of the WARC file are skipped;
+    these can only occur when the writer crashed before flushing the WARC file.
+    '''
+    warc_size = os.path.getsize(warc_path)
+    with open(warc_path + '.idx') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 5:
+                continue
+            surt, url, offset, length, digest = fields
+            offset = int(offset)
+            length = int(length)
+            if offset + length > warc_size:
+                logging.warning(f'index entry past the end of {warc_path}: url={url}')
+                continue
+            yield {
+                'surt': surt,
+                'url': url,
+                'offset': offset,
+                'length': length,
+                'digest': digest,
+                }
+
+
+def format_index_line(entry):
+    return f"{entry['surt']}\t{entry['url']}\t{entry['offset']}\t{entry['length']}\t{entry['digest']}\n"
+
+
+def _sort_key(line):
+    fields = line.split('\t')
+    return fields[0], int(fields[2])
+
+
+def write_index(warc_path, lines):
+    '''
+    Atomically replaces the sidecar index of warc_path with the lines sorted by (surt, offset).
+    '''
+    tmp_path = warc_path + '.idx.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(sorted(lines, key=_sort_key))
+    os.replace(tmp_path, warc_path + '.idx')
+
+
+def sort_index(warc_path):
+    '''
+    Sorts the sidecar index of warc_path by surt;
+    the index is written in the order of the WARC file, and lookup requires it to be sorted.
+    '''
+    write_index(warc_path, map(format_index_line, read_index(warc_path)))
+
+
+def repair(warc_path, chunk_size=2**16):
+    '''
+    Makes warc_path and its sidecar index consistent after a crash, and returns the size of the repaired WARC file.
+
+    The WARC file is always flushed before the index (see downloader.warcitr_to_warcfile),
+    so after a crash the WARC file can contain complete records that are missing from the index,
+    followed by a partially written record.
+    The missing records are added to the index, and the partial record is truncated,
+    so that new records can be appended to both files.
+    '''
+    entries = list(read_index(warc_path)) if os.path.exists(warc_path + '.idx') else []
+    end = max((entry['offset'] + entry['length'] for entry in entries), default=0)
+
+    # find the complete gzip members after the last indexed record
+    with open(warc_path, 'rb') as f:
+        f.seek(end)
+        tail = memoryview(f.read())
+    pos = 0
+    new_lines = []
+    while pos < len(tail):
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        consumed = 0
+        try:
+            while not decompressor.eof and pos + consumed < len(tail):
+                chunk = tail[pos+consumed : pos+consumed+chunk_size]
+                decompressor.decompress(chunk)
+                consumed += len(chunk)
+        except zlib.error:
+            break
+        if not decompressor.eof:
+            break
+        length = consumed - len(decompressor.unused_data)
+        new_lines.append(index_line(bytes(tail[pos:pos+length]), end + pos))
+        pos += length
+    if len(new_lines) > 0 or pos < len(tail):
+        logging.warning(f'repair({warc_path}): indexed {len(new_lines)} records, truncated {len(tail)-pos} bytes')
+
+    # the index is rewritten so that partially written lines are removed;
+    # the lines of the interrupted run are in the order of the WARC file, so it also needs sorting
+    write_index(warc_path, [ format_index_line(entry) for entry in entries ] + new_lines)
+    os.truncate(warc_path, end + pos)
+    return end + pos
+
+
+def _line_bounds(mm, pos):
+    '''
+    Returns the (start, stop) byte offsets of the line in mm that contains position pos;
+    the stop offset does not include the newline.
+    '''
+    start = mm.rfind(b'\n', 0, pos) + 1
+    stop = mm.find(b'\n', pos)
+    if stop == -1:
+        stop = len(mm)
+    return start, stop
+
+
+def _bisect_left(mm, key):
+    '''
+    Returns the byte offset of the first line in mm whose surt is >= key,
+    or len(mm) if there is no such line.
+    '''
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start, stop = _line_bounds(mm, mid)
+        line_key = mm[start:stop].split(b'\t', 1)[0]
+        if line_key < key:
+            lo = stop + 1
+        else:
+            hi = start
+    return min(lo, len(mm))
+
+
+def lookup(warc_path, url=None, surt=None):
+    '''
+    Returns a list of the gzipped WARC records in warc_path for the given url (or surt).
+    Each record can be parsed with downloader.warcitr_to_recorditr.
+
+    The sorted index is memory-mapped and binary searched (like cdx_index.locate_blocks),
+    so a lookup reads O(log n) lines of the index instead of the whole file.
+    An index that is still being written (or was left by a crash) is not sorted;
+    warc_index.repair sorts it.
+    '''
+    if surt is None:
+        surt = url_to_surt(url)
+    key = surt.encode()
+    warc_size = os.path.getsize(warc_path)
+    entries = []
+    with open(warc_path + '.idx', 'rb') as fidx, open(warc_path, 'rb') as fwarc:
+        if os.fstat(fidx.fileno()).st_size == 0:
+            return entries
+        with mmap.mmap(fidx.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = _bisect_left(mm, key)
+            while pos < len(mm):
+                start, stop = _line_bounds(mm, pos)
+                pos = stop + 1
+                fields = mm[start:stop].decode().split('\t')
+                if fields[0] != surt:
+                    break
+                if len(fields) != 5 or (url is not None and fields[1] != url):
+                    continue
+                offset = int(fields[2])
+                length = int(fields[3])
+                if offset + length > warc_size:
+                    continue
+                fwarc.seek(offset)
+                entries.append(fwarc.read(length))
+    return entries
+
+
+def show(warc_path, url):
+    '''
+    Prints the decompressed WARC records in warc_path for the url.
+    '''
+    import gzip
+    for warc_entry in lookup(warc_path, url=url):
+        print(gzip.decompress(warc_entry).decode('utf-8', errors='replace'))
+
+
+################################################################################
+# standalone executable code
+################################################################################
+
+if __name__ == '__main__':
+
+    # setup logging
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        )
+
+    from clize import run
+    run(show)
@@ -0,0 +1,71 @@
+/*
+ * Migrates a database created before the source_progress table existed;
+ * new databases get the same schema from sql/schema.sql and do not need this file.
+ *
+ * The loading progress used to be stored in the urls_inserted and finished_at columns of the source table.
+ * This migration moves it into source_progress as shard 0 of each source (so that source_summary still reports it),
+ * and then drops the old columns.
+ * It is safe to run more than once.
+ *
+ * The migrated progress can NOT be resumed:
+ * the old sources are named after each worker's warcfile,
+ * while downloader.download_warc now uses a single source name for all of its workers
+ * and partitions the cdx lines between them differently.
+ * download_warc refuses to load a surt/crawl that has an old source (see downloader.check_sources),
+ * since starting over would insert duplicate rows into metahtml.
+ *
+ * Usage:
+ *
+ *     $ psql -v ON_ERROR_STOP=1 -f services/pg/migrations/0001_source_progress.sql
+ */
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS source_progress (
+    id_source INTEGER NOT NULL REFERENCES source(id),
+    shard INTEGER NOT NULL DEFAULT 0,
+    urls_inserted INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ,
+    PRIMARY KEY (id_source, shard)
+);
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = 'source'
+          AND column_name = 'urls_inserted'
+    ) THEN
+        -- the id=-1 'metahtml' source is a placeholder that was never loaded by the downloader
+        INSERT INTO source_progress (id_source, shard, urls_inserted, finished_at)
+        SELECT id, 0, urls_inserted, finished_at
+        FROM source
+        WHERE id <> -1
+        ON CONFLICT (id_source, shard) DO NOTHING;
+
+        ALTER TABLE source DROP COLUMN urls_inserted;
+        ALTER TABLE source DROP COLUMN finished_at;
+    END IF;
+END
+$$;
+
+CREATE OR REPLACE VIEW source_summary AS (
+    SELECT
+        source.id,
+        source.name,
+        source.inserted_at,
+        count(source_progress.shard) AS shards,
+        coalesce(sum(source_progress.urls_inserted), 0) AS urls_inserted,
+        count(source_progress.finished_at) AS shards_finished,
+        CASE WHEN count(source_progress.shard) > 0 AND count(source_progress.finished_at) = count(source_progress.shard)
+            THEN max(source_progress.finished_at)
+        END AS finished_at
+    FROM source
+    LEFT JOIN source_progress ON source.id = source_progress.id_source
+    GROUP BY source.id
+);
+
+COMMIT;
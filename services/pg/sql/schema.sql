@@ -746,12 +746,45 @@ CREATE VIEW qualitifyingnewsmediabias_summary AS (
 CREATE TABLE source (
     id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     inserted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
-    urls_inserted INTEGER NOT NULL DEFAULT 0,
-    finished_at TIMESTAMPTZ,
     name TEXT UNIQUE NOT NULL
 );
 INSERT INTO source (id,name) VALUES (-1,'metahtml');
 
+/*
+ * stores the loading progress of each worker (shard) of a source;
+ * every worker only updates its own row,
+ * so concurrent workers loading the same source never contend on a lock;
+ * databases created before this table existed must be upgraded with migrations/0001_source_progress.sql
+ */
+CREATE TABLE source_progress (
+    id_source INTEGER NOT NULL REFERENCES source(id),
+    shard INTEGER NOT NULL DEFAULT 0,
+    urls_inserted INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ,
+    PRIMARY KEY (id_source, shard)
+);
+
+/*
+ * aggregates the progress of all shards of a source;
+ * a source is finished only once every shard has finished
+ */
+CREATE VIEW source_summary AS (
+    SELECT
+        source.id,
+        source.name,
+        source.inserted_at,
+        count(source_progress.shard) AS shards,
+        coalesce(sum(source_progress.urls_inserted), 0) AS urls_inserted,
+        count(source_progress.finished_at) AS shards_finished,
+        CASE WHEN count(source_progress.shard) > 0 AND count(source_progress.finished_at) = count(source_progress.shard)
+            THEN max(source_progress.finished_at)
+        END AS finished_at
+    FROM source
+    LEFT JOIN source_progress ON source.id = source_progress.id_source
+    GROUP BY source.id
+);
+
 /*
  * The primary table for storing extracted content
  */
@@ -10,6 +10,11 @@ from flask import Flask, send_from_directory, render_template, g, request
 app = Flask(__name__)
 app.config.from_object('project.config.Config')
 
+# when the app is imported by `gunicorn --preload`,
+# the spacy models preloaded here are shared copy-on-write by all of the workers
+if os.environ.get('PSPACY_PRELOAD'):
+    pspacy.preload(os.environ['PSPACY_PRELOAD'].split(','))
+
 ################################################################################
 # routes
 ################################################################################
@@ -51,12 +56,18 @@ def before_request():
     g.start = time.time()
     g.connection = engine.connect()
     g.queries = []
+    g.parses = []
 
 
 @app.after_request
 def after_request(response):
     diff = time.time() - g.start
     diff_str = f'{"%0.3f"%diff} seconds'
+
+    # log the time spent parsing queries separately, so that its share of the latency can be measured from the logs
+    parses = getattr(g, 'parses', [])
+    parse_runtime = sum(parse['runtime'] for parse in parses)
+    app.logger.info(f'path={request.path}; runtime={diff:0.3f}; parse_runtime={parse_runtime:0.3f}; parses_cached={sum(parse["cached"] for parse in parses)}/{len(parses)}')
     if ((response.response) and
         (200 <= response.status_code < 300) and
         (response.content_type.startswith('text/html'))):
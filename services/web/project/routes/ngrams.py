@@ -4,6 +4,7 @@ from project import app
 import pspacy
 from sqlalchemy.sql import text
 from flask import request, g, render_template
+from project.utils import parse_query
 
 
 @app.route('/ngrams')
@@ -13,7 +14,7 @@ def ngrams():
     if query is None:
         return index()
 
-    ts_query = pspacy.lemmatize_query('en', query)
+    ts_query = parse_query('query', pspacy.lemmatize_query, 'en', query)
 
     terms = [ term for term in ts_query.split() if term != '&' ]
 
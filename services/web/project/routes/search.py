@@ -1,5 +1,5 @@
 from project import app
-from project.utils import do_query, render_template
+from project.utils import do_query, parse_query, render_template
 import chajda
 import chajda.tsquery
 from flask import request
@@ -7,6 +7,25 @@ import itertools
 import logging
 
 
+def parse_search_query(lang, query):
+    '''
+    Returns the parts of chajda.tsquery.parse(lang, query) that the search route uses.
+    The filtertree is not json serializable, so only the hosts of its site: filters are kept;
+    this lets the result be stored in the query_cache.
+    '''
+    parse = chajda.tsquery.parse(lang, query)
+    try:
+        filters = list(parse['filtertree'].find_data('filter'))
+        filter_hosts = [ str(t.children[1]) for t in filters if t.children[0] == 'site' ]
+    except:
+        filter_hosts = []
+    return {
+        'tsquery': parse['tsquery'],
+        'terms': parse['terms'],
+        'filter_hosts': filter_hosts,
+        }
+
+
 @app.route('/search')
 def search():
 
@@ -18,13 +37,9 @@ def search():
 
     # extract the key information from the query
     query = request.args.get('query')
-    parse = chajda.tsquery.parse('en', query)
+    parse = parse_query('query', parse_search_query, 'en', query)
     tsquery = parse['tsquery']
-    try:
-        filters = list(parse['filtertree'].find_data('filter'))
-        filter_hosts = [ t.children[1] for t in filters if t.children[0] == 'site' ]
-    except:
-        filter_hosts = []
+    filter_hosts = parse['filter_hosts']
     terms = parse['terms']
 
     # extract other query params
@@ -48,7 +63,7 @@ def search():
         terms_combinations_pretty.append((selected,term_pretty))
     if 'query:' in normalize:
         normalize_terms_raw = normalize.split(':')[1]
-        parse = chajda.tsquery.parse('en', normalize_terms_raw)
+        parse = parse_query('normalize', parse_search_query, 'en', normalize_terms_raw)
         terms_normalize = parse['terms']
     else:
         terms_normalize = None
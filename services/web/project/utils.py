@@ -1,4 +1,10 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
 import time
+from collections import Counter, OrderedDict
 from sqlalchemy.sql import text
 from flask import Flask, send_from_directory, g, request
 import flask
@@ -11,6 +17,7 @@ def render_template(name, **kwargs):
     return flask.render_template(
         name,
         queries=g.queries,
+        parses=g.parses,
         **kwargs
         )
 
@@ -32,3 +39,162 @@ def do_query(name, sql, binds):
         })
     return res
 
+
+
+class QueryCache:
+    '''
+    A bounded LRU cache of parsed search queries, keyed by the parse function, the language, and the raw query text.
+
+    Parsing a query runs the spacy pipeline,
+    but the queries are overwhelmingly repeated,
+    so most requests can skip the parse entirely.
+    Every gunicorn worker has its own in-memory cache of at most max_entries queries;
+    if cache_dir is given, then the parsed queries are also written to that directory,
+    so that a query parsed by one worker is a cache hit for all of the others.
+    When the files in cache_dir grow past max_bytes, the least recently used files are deleted.
+
+    The values are stored as json, so the parse function must return json serializable values
+    (other values are returned but never cached).
+    Every call returns a fresh copy of the value, so a request can modify its parse without affecting other requests;
+    and unlike pickle, loading a file that another process wrote into cache_dir can never run code.
+
+    >>> cache = QueryCache(max_entries=2)
+    >>> parse = lambda lang, text: text.split()
+    >>> cache.parse(parse, 'en', 'a b'), cache.parse(parse, 'en', 'a b'), cache.parse(parse, 'en', 'c')
+    (['a', 'b'], ['a', 'b'], ['c'])
+    >>> cache.parse(parse, 'en', 'c').append('d')
+    >>> cache.parse(parse, 'en', 'c')
+    ['c']
+    >>> _ = cache.parse(parse, 'es', 'a b')
+    >>> _ = cache.parse(parse, 'en', 'a b')
+    >>> dict(cache.stats)
+    {'misses': 4, 'hits': 3, 'evictions': 2}
+    '''
+
+    def __init__(self, max_entries=10000, cache_dir=None, max_bytes=64*1024**2):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.stats = Counter()
+        self.bytes_since_evict = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(json.dumps(key).encode()).hexdigest())
+
+    def _load(self, key):
+        '''
+        Returns the json text of the value for key from cache_dir, or None if it is not stored.
+        '''
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                stored_key, value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        # a hash collision must not return another query's parse
+        if stored_key != list(key):
+            return None
+        return value
+
+    def _store(self, key, value):
+        if self.cache_dir is None:
+            return
+        data = json.dumps([key, value])
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logging.warning(f'QueryCache could not store key={key}: {e}')
+
+        # every worker writes to cache_dir, so the size of the directory can only be known by scanning it;
+        # the scan is done after each worker has written a tenth of max_bytes
+        self.bytes_since_evict += len(data)
+        if self.bytes_since_evict > self.max_bytes // 10:
+            self.bytes_since_evict = 0
+            self.evict()
+
+    def evict(self):
+        '''
+        Deletes the least recently used files in cache_dir until their total size is at most max_bytes.
+        '''
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total_bytes = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+            self.stats['disk_evictions'] += 1
+
+    def parse(self, func, lang, text):
+        '''
+        Returns func(lang, text), computing it only if it is not already cached.
+        '''
+        key = (func.__module__ + '.' + func.__qualname__, lang, text)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return json.loads(self.entries[key])
+
+        value = self._load(key)
+        if value is not None:
+            self.stats['shared_hits'] += 1
+        else:
+            self.stats['misses'] += 1
+            result = func(lang, text)
+            try:
+                value = json.dumps(result)
+            except (TypeError, ValueError) as e:
+                logging.warning(f'QueryCache could not cache key={key}: {e}')
+                return result
+            self._store(key, value)
+
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+        return json.loads(value)
+
+
+# the cache used by the routes;
+# the QUERY_CACHE_DIR should be a directory that every worker can write to (e.g. in /tmp)
+query_cache = QueryCache(
+    max_entries=int(os.environ.get('QUERY_CACHE_SIZE', 10000)),
+    cache_dir=os.environ.get('QUERY_CACHE_DIR'),
+    max_bytes=int(os.environ.get('QUERY_CACHE_DIR_BYTES', 64*1024**2)),
+    )
+
+
+def parse_query(name, func, lang, query):
+    '''
+    Returns func(lang, query) using the query_cache,
+    and records the runtime of the parse as debug information like the do_query function.
+    '''
+    start = time.time()
+    misses = query_cache.stats['misses']
+    res = query_cache.parse(func, lang, query)
+    g.parses.append({
+        'name': name,
+        'runtime': time.time()-start,
+        'cached': query_cache.stats['misses'] == misses,
+        })
+    return res
@@ -1,7 +1,11 @@
+import gc
 import pkgutil
 import importlib
 import inspect
+import os
 import spacy
+import threading
+from collections import Counter, OrderedDict, defaultdict
 
 # initialize logging
 import logging
@@ -73,26 +77,185 @@ def load_all_langs(langs=None):
     '''
     In typical usage, we want spacy's languages loaded lazily.
     When debugging and testing, however, it can be useful to force the immediate loading of all languages.
+    Languages beyond nlp.max_bytes are still evicted, so set nlp.max_bytes=None first to keep every language loaded.
     '''
     if langs is None:
         langs = valid_langs
 
     for lang in langs:
-        nlp[lang] = load_lang(lang)
+        nlp.load(lang, load_lang)
 
 
-# the nlp dictionary will hold the loaded spacy models,
-# and entry of None indicates that the model still needs to be loaded
-from collections import defaultdict
-nlp = defaultdict(lambda: None)
-nlp['xx'] = load_lang('xx')
+def preload(langs=('en', 'xx')):
+    '''
+    Loads and pins the given languages, and then freezes the garbage collector.
+
+    This should be called in a parent process before it forks its workers
+    (e.g. when the web app is imported by `gunicorn --preload`, or before creating a multiprocessing pool);
+    the workers then share the memory pages of these models copy-on-write instead of each loading their own copy.
+    gc.freeze moves every existing object out of the garbage collector's generations,
+    so that collections in the workers do not write to (and thereby copy) the models' pages.
+    '''
+    for lang in langs:
+        nlp.pinned.add(lang)
+        get_nlp(lang)
+    gc.freeze()
+
+
+def rss_bytes():
+    '''
+    Returns the resident memory of the current process, or 0 where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
 
-# create a table of Unicode special characters for filtering
-# this variable is used within the lemmatize function,
-# but we precompute it outside the function for efficiency
+
+class ModelRegistry:
+    '''
+    Holds the loaded spacy models with a least-recently-used eviction policy.
+
+    The memory used by each model is estimated as the growth of the process's resident memory while the model was loading.
+    Whenever the total size of the loaded models exceeds max_bytes (if max_bytes is not None),
+    the least recently used models are evicted, except for the languages in pinned and the model that was just loaded.
+    The number of times each language was loaded and evicted is counted in loads and evictions;
+    a language with many loads is being evicted and reloaded, and so max_bytes is too small for the workload.
+
+    Indexing the registry returns None for a language that is not loaded.
+
+    >>> registry = ModelRegistry(max_bytes=100, pinned=['xx'])
+    >>> registry.load('xx', lambda lang: 'model_' + lang, size=60)
+    'model_xx'
+    >>> registry.load('de', lambda lang: 'model_' + lang, size=30)
+    'model_de'
+    >>> registry.load('es', lambda lang: 'model_' + lang, size=30)
+    'model_es'
+    >>> registry['de'] is None
+    True
+    >>> sorted(registry.models)
+    ['es', 'xx']
+    >>> dict(registry.loads), dict(registry.evictions)
+    ({'xx': 1, 'de': 1, 'es': 1}, {'de': 1})
+    '''
+
+    def __init__(self, max_bytes=None, pinned=()):
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.models = OrderedDict()
+        self.sizes = {}
+        self.loads = Counter()
+        self.evictions = Counter()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, lang):
+        with self.lock:
+            model = self.models.get(lang)
+            if model is not None:
+                self.models.move_to_end(lang)
+            return model
+
+    def __setitem__(self, lang, model):
+        with self.lock:
+            self.models[lang] = model
+            self.models.move_to_end(lang)
+            self.sizes.setdefault(lang, 0)
+
+    def __contains__(self, lang):
+        return lang in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    def pop(self, lang, default=None):
+        with self.lock:
+            self.sizes.pop(lang, None)
+            return self.models.pop(lang, default)
+
+    @property
+    def total_bytes(self):
+        return sum(self.sizes.values())
+
+    def load(self, lang, loader, size=None):
+        '''
+        Loads the model for lang with loader(lang), adds it to the registry, and returns it.
+        If size is None, then the model's size is measured with rss_bytes.
+        '''
+        rss_before = rss_bytes()
+        model = loader(lang)
+        if size is None:
+            size = max(0, rss_bytes() - rss_before)
+        with self.lock:
+            self.models[lang] = model
+            self.models.move_to_end(lang)
+            self.sizes[lang] = size
+            self.loads[lang] += 1
+        logger.info(f'loaded lang={lang}, size={size/1024**2:.1f}MB, total_bytes={self.total_bytes/1024**2:.1f}MB')
+        self.evict(keep=lang)
+        return model
+
+    def evict(self, keep=None):
+        '''
+        Evicts the least recently used models until the registry fits in max_bytes.
+        '''
+        if self.max_bytes is None:
+            return
+        evicted = False
+        with self.lock:
+            for lang in list(self.models):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if lang in self.pinned or lang == keep:
+                    continue
+                del self.models[lang]
+                self.sizes.pop(lang)
+                self.evictions[lang] += 1
+                evicted = True
+                logger.info(f'evicted lang={lang}, total_bytes={self.total_bytes/1024**2:.1f}MB')
+
+        # the models contain reference cycles, so their memory is only released by the garbage collector
+        if evicted:
+            gc.collect()
+
+
+# the nlp registry will hold the loaded spacy models;
+# no models are loaded on import (not even 'xx'), so that importing this module is fast;
+# the memory budget (in MB) and the pinned languages can be set with environment variables
+nlp = ModelRegistry(
+    max_bytes=int(os.environ.get('PSPACY_MAX_MB', 4096)) * 1024**2,
+    pinned=os.environ.get('PSPACY_PINNED', 'en,xx').split(','),
+    )
+
+
+# the table of Unicode special characters for filtering with str.translate;
+# this variable is used within the lemmatize function
 import unicodedata
-import sys
-unicode_CPS = dict.fromkeys(i for i in range(0, sys.maxunicode + 1) if unicodedata.category(chr(i)).startswith(('P', 'S', 'C')))
+class UnicodeFilter(dict):
+    '''
+    A translation table that deletes every character whose unicode category starts with one of the given prefixes.
+
+    Precomputing the full table requires calling unicodedata.category on all ~1.1M code points,
+    which took about half a second on every import;
+    instead, each code point's entry is computed the first time that str.translate looks it up,
+    and is then cached in the dictionary.
+    Texts only use a small number of distinct characters,
+    so the table stays small and the cached lookups are as fast as with the precomputed table.
+
+    >>> 'Hello, world! 🙂'.translate(UnicodeFilter())
+    'Hello world '
+    '''
+
+    def __init__(self, categories=('P', 'S', 'C')):
+        self.categories = categories
+
+    def __missing__(self, key):
+        # a value of None deletes the character, and mapping a code point to itself keeps it
+        value = None if unicodedata.category(chr(key)).startswith(self.categories) else key
+        self[key] = value
+        return value
+
+unicode_CPS = UnicodeFilter()
 
 
 def lemmatize_query(
@@ -138,51 +301,173 @@ def lemmatize(
         remove_special_chars=True,
         remove_stop_words=True,
         add_positions=True,
+        chunk_size=100000,
         ):
+    '''
+    Texts longer than chunk_size characters are split with split_text and lemmatized one chunk at a time,
+    so that only one chunk's spacy doc is in memory at once and texts beyond spacy's max_length can be lemmatized;
+    the positions continue across the chunks as if the text had been lemmatized in a single call.
+    If chunk_size is None, then the text is never split.
+    '''
 
     # if any input is None (NULL in postgres),
     # then we return None
     if lang is None or text is None:
         return None
 
-    # if the language is not yet loaded, then load it
-    # if the language is not supported, then use spacy's multilingual model ('xx')
-    if nlp[lang] is None:
+    nlp_lang = get_nlp(lang)
+
+    # process the text according to input flags
+    text = preprocess_text(text, lower_case, remove_special_chars)
+
+    if chunk_size is None or len(text) <= chunk_size:
+        chunks = [text]
+    else:
+        chunks = split_text(text, chunk_size)
+
+    results = []
+    position = 0
+    num_chunks = 0
+    num_errors = 0
+    for chunk in chunks:
+        num_chunks += 1
+        try:
+            doc = nlp_lang(chunk)
+        except ValueError as e:
+            # FIXME:
+            # How should we handle parsing errors?
+            # Currently we skip the chunk that contains the error,
+            # so the rest of a long text is still indexable from within postgres,
+            # but a text that fits in a single chunk becomes unindexable.
+            # A more sophisticated strategy might try to remove the offending portion of the chunk.
+            #
+            # Currently, the only known parsing error is that the Korean parser
+            # panics when there is an emoji in the input.
+            # It would be easy to manually remove emojis before passing to the Korean parser.
+            logger.error(str(e) + ' ; lang=' + lang + ', text=' + chunk)
+            num_errors += 1
+
+            # the positions of the skipped chunk's tokens are still counted with the model's tokenizer,
+            # so that the positions of the later chunks are the same as in the rest of the text;
+            # only when the tokenizer itself fails do we fall back to counting the words
+            try:
+                position += len(nlp_lang.make_doc(chunk))
+            except ValueError:
+                position += len(chunk.split())
+            continue
+
+        lemmas = doc_to_lemmas(
+            doc,
+            lang,
+            lower_case=lower_case,
+            remove_stop_words=remove_stop_words,
+            add_positions=add_positions,
+            start_position=position,
+            )
+        position += len(doc)
+        if len(lemmas) > 0:
+            results.append(lemmas)
+
+    if num_errors == num_chunks:
+        return None
+    return ' '.join(results)
+
+
+def split_text(text, chunk_size):
+    '''
+    Generator function that splits text into chunks of about chunk_size characters,
+    whose concatenation is exactly text.
+
+    Each chunk ends after its last run of whitespace, so that every chunk starts with a new word,
+    and spacy tokenizes each chunk the same way it would tokenize the words inside the full text.
+    Sentence boundaries are not used, since preprocess_text has already removed the punctuation.
+    Only a chunk without any whitespace is split in the middle of a word.
+    A chunk can be longer than chunk_size by the length of its final run of whitespace.
+
+    >>> list(split_text('the first chunk   the second chunk', 18))
+    ['the first chunk   ', 'the second chunk']
+    >>> list(split_text('no sentence ends in this text', 12))
+    ['no sentence ', 'ends in ', 'this text']
+    >>> list(split_text('abcdefghijklmnopqrstuvwxyz', 10))
+    ['abcdefghij', 'klmnopqrst', 'uvwxyz']
+    '''
+    start = 0
+    while len(text) - start > chunk_size:
+        end = start + chunk_size
+
+        # find the last whitespace in the chunk
+        split = max(text.rfind(' ', start, end), text.rfind('\n', start, end))
+
+        # split after the whitespace run, or in the middle of the word if there is no whitespace
+        if split <= start:
+            split = end
+        else:
+            split += 1
+            while split < len(text) and text[split].isspace():
+                split += 1
+
+        yield text[start:split]
+        start = split
+
+    if start < len(text):
+        yield text[start:]
+
+
+def get_nlp(lang):
+    '''
+    Returns the spacy model for lang, loading it if needed;
+    if the language is not supported, then spacy's multilingual model ('xx') is used.
+    '''
+    model = nlp[lang]
+    if model is None:
         if lang in valid_langs:
-            nlp[lang] = load_lang(lang)
+            model = nlp.load(lang, load_lang)
         else:
-            logger.warn('lang="' + lang + '" not in valid_langs, using lang="xx"')
-            nlp[lang] = nlp['xx']
+            # the unsupported languages are not stored in the registry,
+            # so that evicting 'xx' actually frees its memory
+            if lang not in unsupported_langs:
+                logger.warn('lang="' + lang + '" not in valid_langs, using lang="xx"')
+                unsupported_langs.add(lang)
+            model = get_nlp('xx')
+    return model
 
-    # process the text according to input flags
+
+# the unsupported languages that have already been warned about
+unsupported_langs = set()
+
+
+def preprocess_text(text, lower_case=True, remove_special_chars=True):
+    '''
+    Applies the input flags of lemmatize to the text before it is passed to spacy.
+    '''
     if lower_case:
         text = text.lower()
 
     if remove_special_chars:
         text = text.translate(unicode_CPS)
 
-    try:
-        doc = nlp[lang](text)
-    except ValueError as e:
-        # FIXME:
-        # How should we handle parsing errors?
-        # Currently we simply panic and return None.
-        # This means that the text will not be indexable from within postgres.
-        # A more sophisticated strategy might try to remove the offending portion of text
-        # so that the remainder of the text can still be indexed.
-        #
-        # Currently, the only known parsing error is that the Korean parser
-        # panics when there is an emoji in the input.
-        # It would be easy to manually remove emojis before passing to the Korean parser.
-        logger.error(str(e) + ' ; lang=' + lang + ', text=' + text)
-        return None
+    return text
+
+
+def doc_to_lemmas(
+        doc,
+        lang,
+        lower_case=True,
+        remove_stop_words=True,
+        add_positions=True,
+        start_position=0,
+        ):
+    '''
+    Formats a spacy doc as the output of lemmatize;
+    the positions are numbered starting after start_position.
+    '''
 
     def format_token(token, i):
         if add_positions:
             if token.lemma_ == ' ':
                 return ' '
             else:
-                return token.lemma_ + ':' + str(i + 1)
+                return token.lemma_ + ':' + str(start_position + i + 1)
         else:
             return token.lemma_
 
@@ -202,3 +487,69 @@ def lemmatize(
         lemmas_joined = lemmas_joined.lower()
 
     return lemmas_joined
+
+
+def lemmatize_batch(
+        lang,
+        texts,
+        lower_case=True,
+        remove_special_chars=True,
+        remove_stop_words=True,
+        add_positions=True,
+        batch_size=1000,
+        n_process=1,
+        chunk_size=100000,
+        ):
+    '''
+    Returns a list with the output of lemmatize for each text in texts.
+
+    Calling lemmatize once per text runs the spacy pipeline on one document at a time;
+    here the texts are grouped by language,
+    and each group is run through spacy's nlp.pipe in batches of batch_size documents,
+    which is much faster for large numbers of short texts (e.g. titles).
+    If n_process > 1, then nlp.pipe splits each group between that many processes.
+
+    The lang argument is either a single language used for every text,
+    or a list with one language per text.
+    Texts longer than chunk_size are lemmatized in chunks by lemmatize instead of being passed to nlp.pipe.
+
+    >>> texts = ['Abraham Lincoln was president of the United States', None, '      the United     States   ']
+    >>> lemmatize_batch('en', texts) == [lemmatize('en', text) for text in texts]
+    True
+    >>> langs = ['en', 'xx', None]
+    >>> lemmatize_batch(langs, texts) == [lemmatize(lang, text) for lang, text in zip(langs, texts)]
+    True
+    >>> lemmatize_batch('en', texts, add_positions=False, batch_size=1) == [lemmatize('en', text, add_positions=False) for text in texts]
+    True
+    '''
+    if isinstance(lang, str) or lang is None:
+        langs = [lang] * len(texts)
+    else:
+        langs = list(lang)
+
+    # group the positions of the texts by language;
+    # texts that lemmatize would return None for are not added to any group
+    results = [None] * len(texts)
+    groups = defaultdict(list)
+    for i, (text_lang, text) in enumerate(zip(langs, texts)):
+        if text_lang is not None and text is not None:
+            if chunk_size is not None and len(text) > chunk_size:
+                results[i] = lemmatize(text_lang, text, lower_case, remove_special_chars, remove_stop_words, add_positions, chunk_size)
+            else:
+                groups[text_lang].append(i)
+
+    for group_lang, positions in groups.items():
+        group_texts = [preprocess_text(texts[i], lower_case, remove_special_chars) for i in positions]
+        try:
+            docs = list(get_nlp(group_lang).pipe(group_texts, batch_size=batch_size, n_process=n_process))
+        except ValueError:
+            # a parsing error in a single text fails the whole batch,
+            # so we fall back to lemmatizing the group's texts one at a time;
+            # lemmatize handles (and logs) the texts with errors
+            for i in positions:
+                results[i] = lemmatize(group_lang, texts[i], lower_case, remove_special_chars, remove_stop_words, add_positions, chunk_size)
+            continue
+        for i, doc in zip(positions, docs):
+            results[i] = doc_to_lemmas(doc, group_lang, lower_case, remove_stop_words, add_positions)
+
+    return results
@@ -0,0 +1,187 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+import unicodedata
+
+import pytest
+
+import pspacy
+
+# the benchmarks take minutes and start subprocesses, and so they only run when the RUN_BENCHMARKS environment variable is set
+large_benchmark = pytest.mark.skipif('RUN_BENCHMARKS' not in os.environ, reason='set RUN_BENCHMARKS to run the benchmarks')
+
+
+def mk_texts(num_texts):
+    '''
+    Returns a list of short news-like texts, similar to the titles and descriptions that ingest lemmatizes.
+    '''
+    subjects = ['The president', 'North Korea', 'Officials in Seoul', 'The United Nations', 'Analysts']
+    verbs = ['announced', 'rejected', 'discussed', 'criticized', 'welcomed']
+    objects = ['new sanctions', 'the missile tests', 'a trade agreement', 'the election results', 'economic reforms']
+    return [
+        f'{subjects[i%5]} {verbs[i//5%5]} {objects[i//25%5]} on day {i} of the summit.'
+        for i in range(num_texts)
+        ]
+
+
+@pytest.mark.parametrize('n_process', [1, 2])
+@pytest.mark.parametrize('batch_size', [1, 7, 100])
+def test_lemmatize_batch(batch_size, n_process):
+    '''
+    lemmatize_batch must give exactly the same output as calling lemmatize once per text.
+    '''
+    texts = mk_texts(50)
+    assert pspacy.lemmatize_batch('en', texts, batch_size=batch_size, n_process=n_process) == [ pspacy.lemmatize('en', text) for text in texts ]
+
+
+@large_benchmark
+@pytest.mark.parametrize('n_process', [1, 2])
+@pytest.mark.parametrize('batch_size', [100, 1000])
+def test_lemmatize_batch_benchmark(batch_size, n_process, num_texts=5000):
+    '''
+    Compares lemmatizing one text per call against lemmatize_batch;
+    both must give exactly the same output.
+    '''
+    texts = mk_texts(num_texts)
+
+    # load the model before timing
+    pspacy.lemmatize('en', texts[0])
+
+    start = time.time()
+    single = [ pspacy.lemmatize('en', text) for text in texts ]
+    runtime_single = time.time() - start
+
+    start = time.time()
+    batched = pspacy.lemmatize_batch('en', texts, batch_size=batch_size, n_process=n_process)
+    runtime_batched = time.time() - start
+
+    assert batched == single
+    logging.info(f'batch_size={batch_size}; n_process={n_process}; single docs/sec={num_texts/runtime_single:.2f}; batched docs/sec={num_texts/runtime_batched:.2f}; speedup={runtime_single/runtime_batched:.2f}')
+
+
+def test_lemmatize_batch_langs():
+    '''
+    Texts in different languages (and unsupported languages) are grouped separately,
+    but the results must stay in the input order.
+    '''
+    texts = mk_texts(20) + [None]
+    langs = ['en', 'es', 'xx', 'not_a_lang'] * 5 + ['en']
+    assert pspacy.lemmatize_batch(langs, texts, batch_size=3) == [ pspacy.lemmatize(lang, text) for lang, text in zip(langs, texts) ]
+
+
+def import_runtime(statement):
+    '''
+    Returns the runtime of statement in a fresh python process, so that the modules are not already imported.
+    '''
+    start = time.time()
+    subprocess.run([sys.executable, '-c', statement], check=True)
+    return time.time() - start
+
+
+@large_benchmark
+def test_import_benchmark():
+    '''
+    Importing pspacy should cost little more than importing spacy itself;
+    no models are loaded and the unicode filter table is not precomputed.
+    The cost that the import used to have is measured directly by precomputing the full table.
+    '''
+    runtime_spacy = import_runtime('import spacy')
+    runtime_pspacy = import_runtime('import pspacy; assert len(pspacy.nlp) == 0')
+
+    start = time.time()
+    dict.fromkeys(i for i in range(0, sys.maxunicode + 1) if unicodedata.category(chr(i)).startswith(('P', 'S', 'C')))
+    runtime_table = time.time() - start
+
+    # the model may have been loaded by an earlier test
+    pspacy.nlp.pop('xx', None)
+    start = time.time()
+    pspacy.lemmatize('xx', 'the first call loads the model')
+    runtime_first_call = time.time() - start
+
+    logging.info(f'import spacy={runtime_spacy:.2f}s; import pspacy={runtime_pspacy:.2f}s; precomputed table={runtime_table:.2f}s; first lemmatize call={runtime_first_call:.2f}s')
+
+
+def test_model_registry_budget():
+    '''
+    With a small memory budget, the unpinned models are evicted in least recently used order.
+    '''
+    registry = pspacy.ModelRegistry(max_bytes=1, pinned=['en'])
+    for lang in ['en', 'es', 'de', 'es']:
+        registry.load(lang, pspacy.load_lang, size=1)
+    assert sorted(registry.models) == ['en', 'es']
+    assert registry.loads['es'] == 2
+    assert registry.evictions['es'] == 1
+    assert registry.evictions['de'] == 1
+    assert registry.evictions['en'] == 0
+
+
+def test_lemmatize_chunked():
+    '''
+    Lemmatizing in chunks must give the same tokens and positions as lemmatizing the whole text;
+    the xx model has no context dependent components, so the lemmas are also identical.
+    '''
+    text = ' '.join(mk_texts(200))
+    whole = pspacy.lemmatize('xx', text, chunk_size=None)
+    for chunk_size in [50, 500, 5000]:
+        assert pspacy.lemmatize('xx', text, chunk_size=chunk_size) == whole
+        assert pspacy.lemmatize_batch('xx', [text], chunk_size=chunk_size) == [whole]
+
+
+def test_lemmatize_chunked_errors():
+    '''
+    A parsing error only removes the lemmas of the chunk that contains it,
+    and the positions of the later chunks are the same as without the error;
+    the run of spaces in the failing chunk is a token of its own, so counting words would give the wrong positions.
+    '''
+    nlp_xx = pspacy.get_nlp('xx')
+    class Model:
+        def __call__(self, text):
+            if 'emoji' in text:
+                raise ValueError('emoji')
+            return nlp_xx(text)
+        def make_doc(self, text):
+            return nlp_xx.make_doc(text)
+    pspacy.nlp['broken'] = Model()
+    try:
+        text = 'the first chunk. the emoji    chunk. the last chunk.'
+        assert pspacy.lemmatize('broken', text, chunk_size=None) is None
+        lemmas = pspacy.lemmatize('broken', text, chunk_size=20, remove_stop_words=False)
+        whole = pspacy.lemmatize('xx', text, chunk_size=None, remove_stop_words=False)
+        assert lemmas.split()[:2] == ['the:1', 'first:2']
+        assert lemmas.split()[-1] == whole.split()[-1]
+        assert 'emoji' not in lemmas
+    finally:
+        pspacy.nlp.pop('broken')
+
+
+def peak_rss_mb(statement):
+    '''
+    Returns the peak resident memory of a fresh python process that runs statement after importing pspacy.
+    '''
+    output = subprocess.run([sys.executable, '-c', f'''
+import resource
+import pspacy
+{statement}
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''], check=True, capture_output=True, text=True).stdout
+    return int(output.split()[-1]) / 1024
+
+
+@large_benchmark
+@pytest.mark.parametrize('num_mb', [1, 5])
+def test_lemmatize_chunked_rss_benchmark(num_mb):
+    '''
+    Measures the peak memory of lemmatizing a multi-MB text in a single spacy call and in chunks.
+    '''
+    setup = f'''
+text = ' '.join(['officials met on tuesday to discuss the economy the weather and the elections'] * {num_mb * 13000})
+nlp = pspacy.get_nlp('en')
+nlp.max_length = len(text) + 1
+'''
+    rss_baseline = peak_rss_mb(setup)
+    rss_whole = peak_rss_mb(setup + 'pspacy.lemmatize("en", text, chunk_size=None)')
+    rss_chunked = peak_rss_mb(setup + 'pspacy.lemmatize("en", text)')
+    logging.info(f'num_mb={num_mb}; baseline peak rss={rss_baseline:.0f}MB; whole peak rss={rss_whole:.0f}MB; chunked peak rss={rss_chunked:.0f}MB')
+    assert rss_chunked < rss_whole
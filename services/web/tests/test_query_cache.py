@@ -0,0 +1,55 @@
+import logging
+import statistics
+import time
+
+import pytest
+
+import pspacy
+from project.utils import QueryCache
+
+
+def p50(func, queries):
+    '''
+    Returns the median runtime of func over queries.
+    '''
+    runtimes = []
+    for query in queries:
+        start = time.time()
+        func(query)
+        runtimes.append(time.time() - start)
+    return statistics.median(runtimes)
+
+
+@pytest.mark.parametrize('num_distinct', [10, 100])
+def test_query_cache_benchmark(tmp_path, num_distinct, num_requests=1000):
+    '''
+    Compares the median parse time of repeated queries with and without the cache;
+    a second cache on the same directory stands in for another gunicorn worker.
+    '''
+    queries = [ f'north korea missile test {i % num_distinct}' for i in range(num_requests) ]
+    cache = QueryCache(cache_dir=str(tmp_path))
+    other_worker = QueryCache(cache_dir=str(tmp_path))
+
+    p50_uncached = p50(lambda query: pspacy.lemmatize_query('en', query), queries)
+    p50_cached = p50(lambda query: cache.parse(pspacy.lemmatize_query, 'en', query), queries)
+    p50_shared = p50(lambda query: other_worker.parse(pspacy.lemmatize_query, 'en', query), queries)
+
+    assert cache.parse(pspacy.lemmatize_query, 'en', queries[0]) == pspacy.lemmatize_query('en', queries[0])
+    assert cache.stats['misses'] == num_distinct
+    assert other_worker.stats['misses'] == 0
+    assert other_worker.stats['shared_hits'] == num_distinct
+    logging.info(f'num_distinct={num_distinct}; p50 uncached={p50_uncached*1000:.3f}ms; p50 cached={p50_cached*1000:.3f}ms; p50 other worker={p50_shared*1000:.3f}ms')
+
+
+def test_query_cache_dir_bound(tmp_path):
+    '''
+    The files in cache_dir never grow much past max_bytes,
+    and the most recently used queries are the ones that are kept.
+    '''
+    cache = QueryCache(cache_dir=str(tmp_path), max_bytes=10000)
+    for i in range(1000):
+        cache.parse(pspacy.lemmatize_query, 'en', f'north korea missile test {i}')
+    assert sum(path.stat().st_size for path in tmp_path.iterdir()) <= 1.2 * 10000
+    other_worker = QueryCache(cache_dir=str(tmp_path))
+    other_worker.parse(pspacy.lemmatize_query, 'en', 'north korea missile test 999')
+    assert other_worker.stats['shared_hits'] == 1